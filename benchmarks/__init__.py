@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""本机回环基准测试
+
+    python -m <包名>.benchmarks -o result.json        # 运行全部场景, 结果以JSON输出
+    python -m <包名>.benchmarks --quick                # 缩小参数范围, 快速检查
+    python -m <包名>.benchmarks compare old.json new.json  # 比较两次运行的结果
+"""
+from .stats import LatencyRecorder, compareResults
+from .scenarios import SCENARIOS, runAll
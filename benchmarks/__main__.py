@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import argparse
+import contextlib
+import json
+import platform
+import sys
+import time
+from .stats import compareResults
+from .scenarios import SCENARIOS, BenchConfig, runAll
+
+
+def _run(args) -> int:
+    config = BenchConfig(quick=args.quick, duration=args.duration)
+    out = sys.stdout
+
+    def progress(result: dict):
+        print(json.dumps(result, ensure_ascii=False), file=sys.stderr, flush=True)
+
+    with contextlib.redirect_stdout(sys.stderr):  # server和client的日志不混入结果
+        results = runAll(config, args.scenario, progress)
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpu_count": __import__("os").cpu_count(),
+            "quick": args.quick,
+            "duration": config.duration,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=1, ensure_ascii=False)
+    else:
+        json.dump(report, out, indent=1, ensure_ascii=False)
+        out.write("\n")
+    return 1 if any("failed" in result for result in results) else 0
+
+
+def _compare(args) -> int:
+    with open(args.old, encoding="utf-8") as fp:
+        old = json.load(fp)
+    with open(args.new, encoding="utf-8") as fp:
+        new = json.load(fp)
+    changes, regressions = compareResults(old, new, args.threshold)
+    json.dump({"threshold": args.threshold, "regressions": regressions, "changes": changes}, sys.stdout, indent=1,
+              ensure_ascii=False)
+    sys.stdout.write("\n")
+    return 1 if regressions else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="loopback benchmarks")
+    sub = parser.add_subparsers(dest="command")
+    compare = sub.add_parser("compare", help="compare two result files")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    parser.add_argument("--quick", action="store_true", help="smaller sweep")
+    parser.add_argument("--duration", type=float, default=None, help="seconds per case")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="may be repeated, default: all")
+    parser.add_argument("-o", "--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        return _compare(args)
+    return _run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
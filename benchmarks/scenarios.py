@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+import copy
+import itertools
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Callable, Iterator, Optional
+from ..hserver import *
+from ..hclient import *
+from ..p2pclient import HTcpP2PClient, HUdpP2PClient
+from .stats import LatencyRecorder, Measurement, messageResult
+
+HOST = "127.0.0.1"
+OP_ECHO = 1
+OP_DOWNLOAD = 2
+OP_UPLOAD = 3
+OP_DOWNLOAD_STRIPED = 4
+UDP_MAX_PAYLOAD = 60000
+REPLY_TIMEOUT = 10.0
+
+TCP_SERVERS = {
+    "selector": HTcpSelectorServer,
+    "threading": HTcpThreadingServer,
+}
+
+
+class BenchConfig:
+    """扫描的参数范围"""
+
+    def __init__(self, quick: bool = False, duration: Optional[float] = None):
+        self.duration = duration if duration is not None else (0.3 if quick else 1.0)  # 每个用例的运行秒数
+        self.payloads = [16, 4096] if quick else [16, 1024, 65536]
+        self.content_types = ["json", "binary"] if quick else ["json", "binary", "text"]
+        self.connections = [1, 4] if quick else [1, 8, 32]
+        self.depths = [1, 8] if quick else [1, 16, 64]
+        self.file_size = (8 if quick else 64) * 1024 * 1024
+        self.file_rounds = 1 if quick else 3
+
+
+def freePort(type_=socket.SOCK_STREAM) -> int:
+    with socket.socket(socket.AF_INET, type_) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def waitListening(addr, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(addr, timeout=timeout):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+def makePayload(content_type: str, size: int):
+    if content_type == "binary":
+        return os.urandom(size)
+    if content_type == "json":
+        return "x" * max(size - len('{"data": ""}'), 0)
+    return "x" * size
+
+
+def makeMsg(content_type: str, payload, opcode: int = OP_ECHO, statuscode: int = 0) -> Message:
+    match content_type:
+        case "binary":
+            return Message.BinaryMsg(opcode, statuscode, payload)
+        case "json":
+            return Message.JsonMsg(opcode, statuscode, data=payload)
+        case _:
+            return Message.PlainTextMsg(opcode, statuscode, payload)
+
+
+def startTcpServer(kind: str, file_path: str = ""):
+    """启动回显server, 另外注册文件传输用的操作码"""
+    addr = (HOST, freePort())
+    server = TCP_SERVERS[kind](addr)
+    server.setOnMsgRecvByOpCodeCallback(OP_ECHO, lambda conn, msg: conn.sendMsg(msg) or True)
+    discard = CallbackSink(lambda data: None)
+    server.setOnMsgRecvByOpCodeCallback(OP_DOWNLOAD, lambda conn, msg: server.sendfile(conn, file_path, "bench.bin") or True)
+    server.setOnMsgRecvByOpCodeCallback(OP_UPLOAD, lambda conn, msg: server.recvfile(conn, discard) or True)
+    server.setOnMsgRecvByOpCodeCallback(
+        OP_DOWNLOAD_STRIPED,
+        lambda conn, msg: server.sendfilesStriped(conn, [file_path], ["bench.bin"], msg.statuscode()) or True)
+    threading.Thread(target=server.startserver, daemon=True).start()
+    waitListening(addr)
+    return server, addr
+
+
+def runThreads(count: int, target: Callable[[int], None]):
+    threads = [threading.Thread(target=target, args=(i,), daemon=True) for i in range(count)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+
+def benchTcpReqRes(server_kind: str, content_type: str, payload_size: int, connections: int, depth: int,
+                   duration: float) -> dict:
+    """HTcpReqResClient: depth为1时一问一答, 否则以submit()保持depth个请求未完成"""
+    server, addr = startTcpServer(server_kind)
+    payload = makePayload(content_type, payload_size)
+    clients = []
+    for _ in range(connections):
+        client = HTcpReqResClient()
+        client.connect(addr)
+        client.settimeout(REPLY_TIMEOUT)
+        clients.append(client)
+    recorders = [LatencyRecorder() for _ in range(connections)]
+    errors = [0] * connections
+
+    def worker(i: int):
+        client, recorder = clients[i], recorders[i]
+        msg = makeMsg(content_type, payload)
+        deadline = time.perf_counter() + duration
+        if depth <= 1:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                if client.request(msg).isValid():
+                    recorder.add(time.perf_counter() - start)
+                else:
+                    errors[i] += 1
+            return
+        window = deque()
+        while True:
+            if time.perf_counter() < deadline:
+                while len(window) < depth:
+                    window.append((time.perf_counter(), client.submit(copy.copy(msg), REPLY_TIMEOUT)))
+            if not window:
+                break
+            start, future = window.popleft()
+            try:
+                future.result()
+                recorder.add(time.perf_counter() - start)
+            except Exception:
+                errors[i] += 1
+
+    try:
+        with Measurement() as measurement:
+            runThreads(connections, worker)
+    finally:
+        for client in clients:
+            client.close()
+        server.closeserver()
+    latency = LatencyRecorder()
+    for recorder in recorders:
+        latency.merge(recorder)
+    return messageResult(measurement, latency.count(), payload_size, latency, sum(errors))
+
+
+def benchTcpChannel(server_kind: str, content_type: str, payload_size: int, connections: int, depth: int,
+                    duration: float) -> dict:
+    """HTcpChannelClient: 每个连接最多depth个数据包未收到回显, 以状态码作为序号"""
+    server, addr = startTcpServer(server_kind)
+    payload = makePayload(content_type, payload_size)
+    recorders = [LatencyRecorder() for _ in range(connections)]
+    errors = [0] * connections
+
+    def worker(i: int):
+        recorder = recorders[i]
+        sent_at: dict[int, float] = {}
+        window = threading.Semaphore(depth)
+
+        def onMessage(msg: Message):
+            start = sent_at.pop(msg.statuscode(), None)
+            if start is not None:
+                recorder.add(time.perf_counter() - start)
+                window.release()
+
+        client = HTcpChannelClient()
+        client.setOnMessageReceivedCallback(onMessage)
+        client.connect(addr)
+        try:
+            deadline = time.perf_counter() + duration
+            seq = 0
+            while time.perf_counter() < deadline:
+                if not window.acquire(timeout=REPLY_TIMEOUT):
+                    errors[i] += len(sent_at)
+                    return
+                seq = (seq + 1) & 0xFFFF
+                sent_at[seq] = time.perf_counter()
+                client.sendmsg(makeMsg(content_type, payload, OP_ECHO, seq))
+            for _ in range(depth):  # 等待剩余的回显
+                if not window.acquire(timeout=REPLY_TIMEOUT):
+                    errors[i] += len(sent_at)
+                    return
+        finally:
+            client.close()
+
+    try:
+        with Measurement() as measurement:
+            runThreads(connections, worker)
+    finally:
+        server.closeserver()
+    latency = LatencyRecorder()
+    for recorder in recorders:
+        latency.merge(recorder)
+    return messageResult(measurement, latency.count(), payload_size, latency, sum(errors))
+
+
+def benchUdpReqRes(content_type: str, payload_size: int, connections: int, duration: float) -> dict:
+    """HUdpServer + HUdpReqResClient, 超时未收到回复计为错误"""
+    addr = (HOST, freePort(socket.SOCK_DGRAM))
+    server = HUdpServer(addr)
+    server.setOnMessageReceivedCallback(lambda msg, c_addr: server.sendto(msg, c_addr))
+    threading.Thread(target=server.startserver, daemon=True).start()
+    time.sleep(0.05)
+    payload = makePayload(content_type, payload_size)
+    recorders = [LatencyRecorder() for _ in range(connections)]
+    errors = [0] * connections
+
+    def worker(i: int):
+        client = HUdpReqResClient(addr)
+        client.settimeout(1.0)
+        msg = makeMsg(content_type, payload)
+        try:
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = client.request(msg)
+                if response is not None and response.isValid():
+                    recorders[i].add(time.perf_counter() - start)
+                else:
+                    errors[i] += 1
+        finally:
+            client.close()
+
+    try:
+        with Measurement() as measurement:
+            runThreads(connections, worker)
+    finally:
+        server.closeserver()
+    latency = LatencyRecorder()
+    for recorder in recorders:
+        latency.merge(recorder)
+    return messageResult(measurement, latency.count(), payload_size, latency, sum(errors))
+
+
+class _EchoTcpP2PClient(HTcpP2PClient):
+    def _messageHandle(self, msg: Message):
+        if msg.isValid():  # 对端关闭时收到空Message
+            self.send(msg)
+
+
+class _QueueTcpP2PClient(HTcpP2PClient):
+    def __init__(self):
+        super().__init__()
+        self.received: queue.Queue[Message] = queue.Queue()
+
+    def _messageHandle(self, msg: Message):
+        self.received.put(msg)
+
+
+class _EchoUdpP2PClient(HUdpP2PClient):
+    def _messageHandle(self, msg: Message):
+        self.send(msg)
+
+
+class _QueueUdpP2PClient(HUdpP2PClient):
+    def __init__(self):
+        super().__init__()
+        self.received: queue.Queue[Message] = queue.Queue()
+
+    def _messageHandle(self, msg: Message):
+        self.received.put(msg)
+
+
+def _pingPong(send: Callable[[Message], bool], received: queue.Queue, content_type: str, payload, depth: int,
+              duration: float, timeout: float) -> tuple[LatencyRecorder, int]:
+    """保持depth个数据包在途, 以状态码匹配回显"""
+    recorder = LatencyRecorder()
+    errors = 0
+    sent_at: dict[int, float] = {}
+    seq = 0
+    deadline = time.perf_counter() + duration
+    while True:
+        if time.perf_counter() < deadline:
+            while len(sent_at) < depth:
+                seq = (seq + 1) & 0xFFFF
+                sent_at[seq] = time.perf_counter()
+                send(makeMsg(content_type, payload, OP_ECHO, seq))
+        if not sent_at:
+            break
+        try:
+            msg = received.get(timeout=timeout)
+        except queue.Empty:  # 丢失的数据包
+            errors += len(sent_at)
+            sent_at.clear()
+            continue
+        start = sent_at.pop(msg.statuscode(), None)
+        if start is not None:
+            recorder.add(time.perf_counter() - start)
+    return recorder, errors
+
+
+def benchTcpP2P(content_type: str, payload_size: int, depth: int, duration: float) -> dict:
+    echo = _EchoTcpP2PClient()
+    echo.bind((HOST, 0))
+    addr = echo.getsockaddr()
+    waiter = threading.Thread(target=echo.wait, daemon=True)
+    waiter.start()
+    client = _QueueTcpP2PClient()
+    client.connect(addr)
+    waiter.join()
+    payload = makePayload(content_type, payload_size)
+    try:
+        with Measurement() as measurement:
+            latency, errors = _pingPong(client.send, client.received, content_type, payload, depth, duration,
+                                        REPLY_TIMEOUT)
+    finally:
+        client.close()
+        echo.close()
+    return messageResult(measurement, latency.count(), payload_size, latency, errors)
+
+
+def benchUdpP2P(content_type: str, payload_size: int, depth: int, duration: float) -> dict:
+    echo = _EchoUdpP2PClient()
+    client = _QueueUdpP2PClient()
+    echo.start((HOST, 0))
+    client.start((HOST, 0))
+    echo.setpeeraddr(client.getsockaddr())
+    client.setpeeraddr(echo.getsockaddr())
+    payload = makePayload(content_type, payload_size)
+    try:
+        with Measurement() as measurement:
+            latency, errors = _pingPong(client.send, client.received, content_type, payload, depth, duration, 1.0)
+    finally:
+        client.close()
+        echo.close()
+    return messageResult(measurement, latency.count(), payload_size, latency, errors)
+
+
+def benchFileTransfer(server_kind: str, direction: str, file_path: str, file_size: int, rounds: int) -> dict:
+    """经由临时传输连接的文件传输, 接收方丢弃数据以排除磁盘写入的影响(striped除外)"""
+    server, addr = startTcpServer(server_kind, file_path)
+    client = HTcpReqResClient()
+    client.connect(addr)
+    client.settimeout(REPLY_TIMEOUT)
+    discard = CallbackSink(lambda data: None)
+    seconds = []
+    errors = 0
+    cpu = 0.0
+    try:
+        for _ in range(rounds):
+            with Measurement() as measurement:
+                match direction:
+                    case "download":
+                        client.sendmsg(Message.HeaderOnlyMsg(OP_DOWNLOAD))
+                        ok = bool(client.recvfile(discard))
+                    case "upload":
+                        client.sendmsg(Message.HeaderOnlyMsg(OP_UPLOAD))
+                        client.sendfile(file_path, "bench.bin")
+                        ok = True
+                    case _:  # striped
+                        client.sendmsg(Message.HeaderOnlyMsg(OP_DOWNLOAD_STRIPED, 4))
+                        paths = client.recvfilesStriped()
+                        ok = len(paths) == 1
+                        for path in paths:
+                            os.remove(path)
+            if ok:
+                seconds.append(measurement.wall)
+                cpu += measurement.cpu
+            else:
+                errors += 1
+    finally:
+        client.close()
+        server.closeserver()
+    best = min(seconds) if seconds else None
+    return {
+        "rounds": rounds,
+        "errors": errors,
+        "seconds": round(sum(seconds), 3),
+        "mb_per_sec": round(file_size / best / 1e6, 1) if best else None,
+        "mean_mb_per_sec": round(file_size * len(seconds) / sum(seconds) / 1e6, 1) if seconds else None,
+        "cpu_sec_per_gb": round(cpu / (file_size * len(seconds)) * 1e9, 3) if seconds else None,
+    }
+
+
+def _tcpCases(config: BenchConfig, client: str) -> Iterator[tuple[dict, Callable[[], dict]]]:
+    bench = benchTcpReqRes if client == "HTcpReqResClient" else benchTcpChannel
+    for server_kind, content_type, payload, connections, depth in itertools.product(
+            TCP_SERVERS, config.content_types, config.payloads, config.connections, config.depths):
+        case = {"server": server_kind, "client": client, "content_type": content_type, "payload": payload,
+                "connections": connections, "depth": depth}
+        yield case, lambda c=case: bench(c["server"], c["content_type"], c["payload"], c["connections"],
+                                         c["depth"], config.duration)
+
+
+def _udpCases(config: BenchConfig) -> Iterator[tuple[dict, Callable[[], dict]]]:
+    for content_type, payload, connections in itertools.product(
+            config.content_types, config.payloads, config.connections):
+        if payload > UDP_MAX_PAYLOAD:
+            continue
+        case = {"server": "udp", "client": "HUdpReqResClient", "content_type": content_type, "payload": payload,
+                "connections": connections, "depth": 1}
+        yield case, lambda c=case: benchUdpReqRes(c["content_type"], c["payload"], c["connections"], config.duration)
+
+
+def _p2pCases(config: BenchConfig) -> Iterator[tuple[dict, Callable[[], dict]]]:
+    for kind, content_type, payload, depth in itertools.product(
+            ("tcp", "udp"), config.content_types, config.payloads, config.depths):
+        if kind == "udp" and payload > UDP_MAX_PAYLOAD:
+            continue
+        bench = benchTcpP2P if kind == "tcp" else benchUdpP2P
+        case = {"server": None, "client": "HTcpP2PClient" if kind == "tcp" else "HUdpP2PClient",
+                "content_type": content_type, "payload": payload, "connections": 1, "depth": depth}
+        yield case, lambda c=case, b=bench: b(c["content_type"], c["payload"], c["depth"], config.duration)
+
+
+def _fileCases(config: BenchConfig, file_path: str) -> Iterator[tuple[dict, Callable[[], dict]]]:
+    for server_kind, direction in itertools.product(TCP_SERVERS, ("download", "upload", "striped")):
+        case = {"server": server_kind, "client": "HTcpReqResClient", "direction": direction,
+                "file_size": config.file_size}
+        yield case, lambda c=case: benchFileTransfer(c["server"], c["direction"], file_path, config.file_size,
+                                                     config.file_rounds)
+
+
+SCENARIOS = ("tcp_reqres", "tcp_channel", "udp_reqres", "p2p", "file_transfer")
+
+
+def runAll(config: BenchConfig, scenarios: Optional[list[str]] = None,
+           progress: Optional[Callable[[dict], None]] = None) -> list[dict]:
+    """运行选定的场景(默认全部), 返回每个用例的结果"""
+    scenarios = scenarios or list(SCENARIOS)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="hsocket-bench-") as workdir:
+        download_path = SocketConfig.DEFAULT_DOWNLOAD_PATH
+        SocketConfig.DEFAULT_DOWNLOAD_PATH = os.path.join(workdir, "download")
+        file_path = os.path.join(workdir, "bench.bin")
+        try:
+            for scenario in scenarios:
+                match scenario:
+                    case "tcp_reqres":
+                        cases = _tcpCases(config, "HTcpReqResClient")
+                    case "tcp_channel":
+                        cases = _tcpCases(config, "HTcpChannelClient")
+                    case "udp_reqres":
+                        cases = _udpCases(config)
+                    case "p2p":
+                        cases = _p2pCases(config)
+                    case "file_transfer":
+                        with open(file_path, "wb") as fp:
+                            fp.write(os.urandom(config.file_size))
+                        cases = _fileCases(config, file_path)
+                    case _:
+                        raise ValueError("unknown scenario: {}".format(scenario))
+                for case, run in cases:
+                    result = {"scenario": scenario, **case}
+                    try:
+                        result.update(run())
+                    except Exception as e:  # 单个用例失败不影响其他用例
+                        result["failed"] = "{}: {}".format(type(e).__name__, e)
+                    results.append(result)
+                    if progress is not None:
+                        progress(result)
+        finally:
+            SocketConfig.DEFAULT_DOWNLOAD_PATH = download_path
+    return results
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import math
+import time
+from typing import Optional
+
+
+class LatencyRecorder:
+    """收集延迟样本(秒)并计算分位数, 每个线程使用各自的实例, 最后merge()"""
+
+    def __init__(self):
+        self.samples: list[float] = []
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def merge(self, other: "LatencyRecorder"):
+        self.samples.extend(other.samples)
+
+    def count(self) -> int:
+        return len(self.samples)
+
+    def summary(self) -> dict:
+        """以微秒为单位的延迟统计"""
+        if not self.samples:
+            return {}
+        samples = sorted(self.samples)
+
+        def percentile(p: float) -> float:
+            index = min(len(samples) - 1, max(0, math.ceil(p * len(samples)) - 1))
+            return round(samples[index] * 1e6, 1)
+
+        return {
+            "p50": percentile(0.50),
+            "p99": percentile(0.99),
+            "p999": percentile(0.999),
+            "max": round(samples[-1] * 1e6, 1),
+            "mean": round(sum(samples) / len(samples) * 1e6, 1),
+        }
+
+
+class Measurement:
+    """测量一段时间内的墙钟时间和进程CPU时间
+
+    server和client运行在同一进程中, CPU时间为两者之和。
+    """
+
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.__wall_start = 0.0
+        self.__cpu_start = 0.0
+
+    def __enter__(self) -> "Measurement":
+        self.__wall_start = time.perf_counter()
+        self.__cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.wall = time.perf_counter() - self.__wall_start
+        self.cpu = time.process_time() - self.__cpu_start
+
+
+def messageResult(measurement: Measurement, messages: int, payload: int, latency: LatencyRecorder,
+                  errors: int = 0) -> dict:
+    """消息类场景的统计结果"""
+    wall = measurement.wall or 1e-9
+    return {
+        "messages": messages,
+        "errors": errors,
+        "seconds": round(wall, 3),
+        "msgs_per_sec": round(messages / wall, 1),
+        "mb_per_sec": round(messages * payload / wall / 1e6, 2),
+        "cpu_us_per_msg": round(measurement.cpu / messages * 1e6, 2) if messages else None,
+        "latency_us": latency.summary(),
+    }
+
+
+IDENTITY_KEYS = ("scenario", "server", "client", "content_type", "payload", "connections", "depth", "direction",
+                 "file_size")
+METRICS = (  # (指标, 越大越好)
+    ("msgs_per_sec", True),
+    ("mb_per_sec", True),
+    ("cpu_us_per_msg", False),
+    ("latency_us.p50", False),
+    ("latency_us.p99", False),
+)
+
+
+def _identity(result: dict) -> tuple:
+    return tuple(result.get(key) for key in IDENTITY_KEYS)
+
+
+def _metric(result: dict, name: str) -> Optional[float]:
+    value = result
+    for part in name.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compareResults(old: dict, new: dict, threshold: float = 0.1) -> tuple[list[dict], int]:
+    """比较两次运行的结果
+
+    Args:
+        old (dict): 基准结果
+        new (dict): 新结果
+        threshold (float): 变差超过该比例时计为退化
+
+    Returns:
+        tuple[list[dict], int]: 每个指标的变化，退化的指标数
+    """
+    baseline = {_identity(result): result for result in old.get("results", [])}
+    changes = []
+    regressions = 0
+    for result in new.get("results", []):
+        base = baseline.get(_identity(result))
+        if base is None:
+            continue
+        for name, higher_is_better in METRICS:
+            before = _metric(base, name)
+            after = _metric(result, name)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regressed = (-change if higher_is_better else change) > threshold
+            regressions += regressed
+            changes.append({
+                "case": {key: value for key, value in zip(IDENTITY_KEYS, _identity(result)) if value is not None},
+                "metric": name,
+                "old": before,
+                "new": after,
+                "change": round(change, 4),
+                "regressed": regressed,
+            })
+    return changes, regressions
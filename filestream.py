@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+from typing import Optional, BinaryIO, Callable
+import threading
+import os
+from .hsocket import *
+from .message import *
+
+
+class FileStreamConfig:
+    CHUNK_SIZE = 65536  # 每个数据块的大小
+    MAX_QUEUED = 4 * 65536  # 发送队列中最多积压的字节数, 超过时暂停读取文件
+
+
+def isFileStreamMsg(msg: Message) -> bool:
+    return BuiltInOpCode.FT_STREAM_BEGIN <= msg.opcode() <= BuiltInOpCode.FT_STREAM_END
+
+
+class FileStreamSender:
+    """在已有连接上以分块数据包的形式发送文件
+
+    每个文件占用一个流ID(数据包的状态码), 多个文件的数据块由后台线程轮流发送,
+    并与连接上的普通数据包交错, 不需要额外的传输连接。
+    """
+    OnFinishedCallback = Callable[[int, bool], None]  # (流ID, 是否完整发送)
+
+    def __init__(self, conn: HTcpSocket, on_finished: Optional[OnFinishedCallback] = None):
+        self.__conn = conn
+        self.__on_finished = on_finished
+        self.__streams: dict[int, BinaryIO] = {}
+        self.__lock = threading.Lock()
+        self.__thread: Optional[threading.Thread] = None
+        self.__next_id = 1
+
+    def send(self, file: BinaryIO, filename: str) -> int:
+        """开始发送一个文件, 文件在发送结束后会被关闭
+
+        Raises:
+            OSError: 套接字异常时抛出。
+            RuntimeError: 同时进行的文件流过多时抛出。
+
+        Returns:
+            int: 流ID
+        """
+        file.seek(0, os.SEEK_END)
+        filesize = file.tell()
+        file.seek(0, os.SEEK_SET)
+        with self.__lock:
+            streamid = self.__allocateId()
+            self.__conn.sendMsg(Message.JsonMsg(BuiltInOpCode.FT_STREAM_BEGIN, streamid,
+                                                filename=filename, filesize=filesize))
+            self.__streams[streamid] = file
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__pump, daemon=True)
+                self.__thread.start()
+        return streamid
+
+    def activeCount(self) -> int:
+        return len(self.__streams)
+
+    def abort(self):
+        """放弃所有未发送完的文件"""
+        with self.__lock:
+            streams = self.__streams
+            self.__streams = {}
+        for streamid, file in streams.items():
+            file.close()
+            if self.__on_finished:
+                self.__on_finished(streamid, False)
+
+    def __allocateId(self) -> int:
+        for _ in range(0xFFFF):
+            streamid = self.__next_id
+            self.__next_id = self.__next_id % 0xFFFF + 1
+            if streamid not in self.__streams:
+                return streamid
+        raise RuntimeError("too many concurrent file streams")
+
+    def __waitWritable(self) -> bool:
+        """发送队列积压过多时等待其回落, 连接关闭时返回False"""
+        queue = self.__conn.sendQueue()
+        if queue is None:
+            return self.__conn.isValid()
+        while not queue.waitBelow(FileStreamConfig.MAX_QUEUED, 1.0):
+            if not self.__conn.isValid():
+                return False
+        return self.__conn.isValid()
+
+    def __pump(self):
+        while True:
+            with self.__lock:
+                streamids = list(self.__streams)
+                if not streamids:
+                    self.__thread = None
+                    return
+            for streamid in streamids:  # 每个文件流每轮发送一块
+                file = self.__streams.get(streamid)
+                if file is None:
+                    continue
+                try:
+                    if not self.__waitWritable():
+                        raise ConnectionError("connection closed")
+                    data = file.read(FileStreamConfig.CHUNK_SIZE)
+                    if data:
+                        self.__conn.sendMsg(Message.BinaryMsg(BuiltInOpCode.FT_STREAM_DATA, streamid, data))
+                        continue
+                    self.__conn.sendMsg(Message.JsonMsg(BuiltInOpCode.FT_STREAM_END, streamid, ok=True))
+                except OSError:  # 连接异常, 放弃所有文件流
+                    self.abort()
+                    with self.__lock:
+                        if not self.__streams:
+                            self.__thread = None
+                            return
+                    break
+                with self.__lock:
+                    self.__streams.pop(streamid, None)
+                file.close()
+                if self.__on_finished:
+                    self.__on_finished(streamid, True)
+
+
+class FileStreamReceiver:
+    """接收FileStreamSender发送的文件流"""
+
+    def __init__(self):
+        self.__streams: dict[int, tuple[BinaryIO, str]] = {}  # 流ID -> (文件, 保存路径)
+
+    def handle(self, msg: Message) -> Optional[str]:
+        """处理一个文件流数据包
+
+        Raises:
+            OSError: 文件写入异常时抛出。
+
+        Returns:
+            Optional[str]: 某个文件接收完毕时返回其保存路径, 否则返回None
+        """
+        streamid = msg.statuscode()
+        match msg.opcode():
+            case BuiltInOpCode.FT_STREAM_BEGIN:
+                self.__discard(streamid)
+                if not os.path.exists(SocketConfig.DEFAULT_DOWNLOAD_PATH):
+                    os.makedirs(SocketConfig.DEFAULT_DOWNLOAD_PATH)
+                filename = os.path.basename(msg.get("filename"))
+                down_path = os.path.join(SocketConfig.DEFAULT_DOWNLOAD_PATH, filename)
+                fp = open(down_path, 'wb')
+                self.__streams[streamid] = (fp, down_path)
+            case BuiltInOpCode.FT_STREAM_DATA:
+                stream = self.__streams.get(streamid)
+                if stream is not None:
+                    stream[0].write(msg.content())
+            case BuiltInOpCode.FT_STREAM_END:
+                stream = self.__streams.pop(streamid, None)
+                if stream is not None:
+                    fp, down_path = stream
+                    fp.close()
+                    if msg.get("ok"):
+                        return down_path
+                    os.remove(down_path)
+        return None
+
+    def close(self):
+        """丢弃所有未接收完的文件"""
+        for streamid in list(self.__streams):
+            self.__discard(streamid)
+
+    def __discard(self, streamid: int):
+        stream = self.__streams.pop(streamid, None)
+        if stream is not None:
+            fp, down_path = stream
+            fp.close()
+            try:
+                os.remove(down_path)
+            except OSError:
+                pass
+
+
+class StripedTransferConfig:
+    SPLIT_THRESHOLD = 8 * 1024 * 1024  # 超过该大小的文件被切分为多个片段并行传输
+
+
+def _planStripes(sizes: list[int], stripes: int) -> list[list[tuple[int, int, int]]]:
+    """把文件划分为片段并分配给各传输连接
+
+    Returns:
+        list[list[tuple[int, int, int]]]: 每个传输连接负责的 (文件序号, 偏移, 长度) 列表
+    """
+    ranges = []
+    for index, size in enumerate(sizes):
+        if size < StripedTransferConfig.SPLIT_THRESHOLD:
+            ranges.append((index, 0, size))
+            continue
+        part = -(-size // stripes)
+        for offset in range(0, size, part):
+            ranges.append((index, offset, min(part, size - offset)))
+    plan = [[] for _ in range(stripes)]
+    loads = [0] * stripes
+    for rng in sorted(ranges, key=lambda r: r[2], reverse=True):  # 大片段优先, 分给当前负载最小的连接
+        i = loads.index(min(loads))
+        plan[i].append(rng)
+        loads[i] += rng[2]
+    return plan
+
+
+def sendStriped(socks: list[HTcpSocket], paths: list[str], filenames: list[str]) -> int:
+    """经由多个传输连接并行发送多个文件, 大文件按字节范围切分后并行发送
+
+    Returns:
+        int: 完整发送的文件数
+    """
+    sizes = []
+    for path in paths:
+        try:
+            sizes.append(os.path.getsize(path))
+        except OSError as e:  # file error
+            print(e)
+            sizes.append(-1)
+    valid = [i for i, size in enumerate(sizes) if size >= 0]
+    plan = _planStripes([sizes[i] for i in valid], len(socks))
+    failed: set[int] = set(i for i, size in enumerate(sizes) if size < 0)
+    lock = threading.Lock()
+
+    def run(sock: HTcpSocket, ranges: list[tuple[int, int, int]]):
+        files: dict[int, BinaryIO] = {}
+        try:
+            for j, offset, length in ranges:
+                index = valid[j]
+                try:
+                    fin = files.get(index)
+                    if fin is None:
+                        fin = files[index] = open(paths[index], 'rb')
+                except OSError as e:  # file error
+                    print(e)
+                    with lock:
+                        failed.add(index)
+                    continue
+                sock.sendMsg(Message.JsonMsg(BuiltInOpCode.FT_STRIPE_RANGE, 0, index=index,
+                                             filename=filenames[index], filesize=sizes[index],
+                                             offset=offset, length=length))
+                if length > 0:
+                    sock.sendfile(fin, offset, length)
+            sock.sendMsg(Message.HeaderOnlyMsg(BuiltInOpCode.FT_STRIPE_END))
+        except OSError:
+            with lock:
+                failed.update(valid[j] for j, _, _ in ranges)
+        finally:
+            for fin in files.values():
+                fin.close()
+
+    threads = [threading.Thread(target=run, args=(sock, ranges), daemon=True) for sock, ranges in zip(socks, plan)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return len(paths) - len(failed)
+
+
+def recvStriped(socks: list[HTcpSocket]) -> list[str]:
+    """接收sendStriped发送的文件, 各片段以pwrite直接写入文件中的对应位置
+
+    Returns:
+        list[str]: 完整接收的文件路径, 按发送时的顺序排列
+    """
+    files: dict[int, list] = {}  # 文件序号 -> [fd, 保存路径, 文件大小, 已接收字节数]
+    lock = threading.Lock()
+    if not os.path.exists(SocketConfig.DEFAULT_DOWNLOAD_PATH):
+        os.makedirs(SocketConfig.DEFAULT_DOWNLOAD_PATH)
+
+    def openFile(index: int, filename: str, filesize: int) -> int:
+        with lock:
+            entry = files.get(index)
+            if entry is None:
+                down_path = os.path.join(SocketConfig.DEFAULT_DOWNLOAD_PATH, os.path.basename(filename))
+                fd = os.open(down_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+                preallocate(fd, filesize)
+                entry = files[index] = [fd, down_path, filesize, 0]
+            return entry[0]
+
+    def run(sock: HTcpSocket):
+        buf = memoryview(bytearray(SocketConfig.FILE_BUFFER_SIZE))
+        try:
+            while True:
+                msg = sock.recvMsg()
+                if msg.opcode() != BuiltInOpCode.FT_STRIPE_RANGE:  # FT_STRIPE_END或连接关闭
+                    return
+                index = msg.get("index")
+                fd = openFile(index, msg.get("filename"), msg.get("filesize"))
+                offset = msg.get("offset")
+                remaining = msg.get("length")
+                while remaining > 0:
+                    nbytes = sock.recv_into(buf[:min(remaining, len(buf))])
+                    if nbytes == 0:
+                        return
+                    os.pwrite(fd, buf[:nbytes], offset)
+                    offset += nbytes
+                    remaining -= nbytes
+                    with lock:
+                        files[index][3] += nbytes
+        except OSError as e:
+            print(e)
+
+    threads = [threading.Thread(target=run, args=(sock,), daemon=True) for sock in socks]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    down_path_list = []
+    for index in sorted(files):
+        fd, down_path, filesize, received = files[index]
+        os.close(fd)
+        if received == filesize:
+            down_path_list.append(down_path)
+    return down_path_list
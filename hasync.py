@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextvars
+import copy
+import inspect
+import time
+import traceback
+from collections import deque
+from typing import Callable, Awaitable
+from .message import *
+from .metrics import Metrics
+
+_reply_to: contextvars.ContextVar[Optional[tuple["HTcpAsyncConnection", int]]] = contextvars.ContextVar(
+    "hasync_reply_to", default=None)  # 当前正在处理的(连接, 请求ID)
+
+
+class HTcpAsyncConnection(asyncio.Protocol):
+    """基于asyncio.Protocol的TCP连接
+
+    收到的数据经MessageDecoder解码后依次交给on_message。
+    回调可以是普通函数或协程函数; 回调返回awaitable时, 同一连接之后的数据包会等待其完成后再处理。
+    处理带有请求ID的数据包期间, 经由该连接发送的不带请求ID的数据包都会附带这个ID(与 HTcpSocket.setReplyId 相同)。
+    """
+
+    def __init__(self, on_message: Callable[["HTcpAsyncConnection", Message], Optional[Awaitable]],
+                 on_connected: Optional[Callable[["HTcpAsyncConnection"], None]] = None,
+                 on_disconnected: Optional[Callable[["HTcpAsyncConnection"], None]] = None):
+        self.__on_message = on_message
+        self.__on_connected = on_connected
+        self.__on_disconnected = on_disconnected
+        self.__transport: Optional[asyncio.Transport] = None
+        self.__decoder = MessageDecoder()
+        self.__queue: deque[Message] = deque()  # 等待前一个协程回调完成的数据包
+        self.__task: Optional[asyncio.Task] = None
+        self.__can_write: Optional[asyncio.Event] = None
+        self.__peername = None
+        self.__codec = Codec.NONE  # 协商得到的压缩算法
+        self.__metrics: Optional[Metrics] = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.__transport = transport
+        self.__peername = transport.get_extra_info("peername")
+        self.__can_write = asyncio.Event()
+        self.__can_write.set()
+        if self.__on_connected:
+            self.__on_connected(self)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.__transport = None
+        self.__can_write.set()
+        if self.__on_disconnected:
+            self.__on_disconnected(self)
+
+    def pause_writing(self):
+        self.__can_write.clear()
+
+    def resume_writing(self):
+        self.__can_write.set()
+
+    def data_received(self, data: bytes):
+        try:
+            msgs = self.__decoder.feed(data)
+        except ValueError as e:  # 无法解码的数据包, 关闭该连接
+            print("decode error from {}: {}".format(self.__peername, e))
+            if self.__metrics is not None:
+                self.__metrics.inc("errors.decode")
+            self.close()
+            return
+        if self.__metrics is not None:
+            self.__metrics.inc("bytes_in", len(data))
+            self.__metrics.inc("msgs_in", len(msgs))
+        for msg in msgs:
+            if not msg.isValid():
+                continue
+            if self.__task is not None:  # 前一个协程回调尚未完成
+                self.__queue.append(msg)
+                continue
+            pending = self.__dispatch(msg)
+            if pending is not None:
+                self.__task = asyncio.ensure_future(self.__run(pending, msg.requestid()))
+
+    def __dispatch(self, msg: Message) -> Optional[Awaitable]:
+        """调用on_message, 同步回调抛出的异常只打印, 不影响之后的数据包"""
+        requestid = msg.requestid()
+        token = _reply_to.set((self, requestid)) if requestid is not None else None
+        try:
+            return self.__on_message(self, msg)
+        except Exception:
+            traceback.print_exc()
+            return None
+        finally:
+            if token is not None:
+                _reply_to.reset(token)
+
+    async def __run(self, pending: Optional[Awaitable], requestid: Optional[int]):
+        try:
+            while True:
+                if pending is not None:
+                    _reply_to.set(None if requestid is None else (self, requestid))  # 只影响该任务的上下文
+                    try:
+                        await pending
+                    except Exception:
+                        traceback.print_exc()
+                if not self.__queue:
+                    break
+                msg = self.__queue.popleft()
+                requestid = msg.requestid()
+                pending = self.__dispatch(msg)
+        finally:
+            self.__task = None
+
+    def isValid(self) -> bool:
+        return self.__transport is not None and not self.__transport.is_closing()
+
+    def getpeername(self) -> Optional[tuple]:
+        return self.__peername
+
+    def transport(self) -> Optional[asyncio.Transport]:
+        return self.__transport
+
+    def setCompression(self, codec: int):
+        """设置发送时使用的压缩算法(需与对端协商), Codec.NONE为不压缩"""
+        self.__codec = codec
+
+    def compression(self) -> int:
+        return self.__codec
+
+    def setMetrics(self, metrics: Optional[Metrics]):
+        """设置记录收发数据包数和字节数的指标注册表, 为None时不记录"""
+        self.__metrics = metrics
+
+    def sendMsg(self, msg: Message) -> bool:
+        """发送一个数据包(不阻塞)
+
+        Returns:
+            bool: 连接已关闭时返回False
+        """
+        if not self.isValid():
+            return False
+        reply_to = _reply_to.get()
+        if reply_to is not None and reply_to[0] is self and msg.requestid() is None:  # 回复时带上请求ID
+            msg = copy.copy(msg)
+            msg.setRequestId(reply_to[1])
+        buffers = msg.toBuffers(self.__codec)
+        self.__transport.writelines(buffers)
+        if self.__metrics is not None:
+            self.__metrics.inc("msgs_out")
+            self.__metrics.inc("bytes_out", sum(map(len, buffers)))
+        return True
+
+    async def drain(self):
+        """等待发送缓冲区回落到低水位以下"""
+        await self.__can_write.wait()
+
+    def close(self):
+        if self.__transport is not None:
+            self.__transport.close()
+
+
+def _dispatch(opcode_callbacks: dict, default_callback: Optional[Callable], opcode: int, *args) -> Optional[Awaitable]:
+    """按操作码分发, 语义与同步版本一致
+
+    回调返回awaitable时返回一个等待其完成的协程, 否则返回None。
+    """
+    callback = opcode_callbacks.get(opcode)
+    if callback is not None:
+        finished = callback(*args)
+        if inspect.isawaitable(finished):
+            return _dispatch_async(finished, default_callback, *args)
+        if finished:
+            return None
+    if default_callback:
+        ret = default_callback(*args)
+        if inspect.isawaitable(ret):
+            return ret
+    return None
+
+
+async def _dispatch_async(finished: Awaitable, default_callback: Optional[Callable], *args):
+    if await finished:
+        return
+    if default_callback:
+        ret = default_callback(*args)
+        if inspect.isawaitable(ret):
+            await ret
+
+
+def _timed(metrics: Optional[Metrics], opcode: int, dispatch: Callable[[], Optional[Awaitable]]) -> Optional[Awaitable]:
+    """执行dispatch并向metrics记录处理时间, 返回awaitable时记录到其完成为止"""
+    if metrics is None:
+        return dispatch()
+    start = time.perf_counter_ns()
+    try:
+        pending = dispatch()
+    except Exception:
+        metrics.inc("errors.handler")
+        metrics.observe("handler_us", (time.perf_counter_ns() - start) // 1000, opcode)
+        raise
+    if pending is None:
+        metrics.observe("handler_us", (time.perf_counter_ns() - start) // 1000, opcode)
+        return None
+    return _timed_async(metrics, opcode, start, pending)
+
+
+async def _timed_async(metrics: Metrics, opcode: int, start: int, pending: Awaitable):
+    try:
+        await pending
+    except Exception:
+        metrics.inc("errors.handler")
+        raise
+    finally:
+        metrics.observe("handler_us", (time.perf_counter_ns() - start) // 1000, opcode)
+
+
+class HTcpAsyncServer:
+    """以asyncio实现的TCP server
+
+    回调的签名与HTcpSelectorServer相同, conn为HTcpAsyncConnection, 回调可以是协程函数。
+    """
+    OnMsgRecvByOpCodeCallback = Callable[[HTcpAsyncConnection, Message], Union[bool, Awaitable[bool]]]  # 返回False时会继续进行OnMessageReceivedCallback
+    OnMessageReceivedCallback = Callable[[HTcpAsyncConnection, Message], Optional[Awaitable]]
+    OnConnectedCallback = Callable[[HTcpAsyncConnection, tuple], None]
+    OnDisconnectedCallback = Callable[[HTcpAsyncConnection, tuple], None]
+
+    def __init__(self, addr):
+        self._address = addr
+        self.__server: Optional[asyncio.Server] = None
+        self.__compression_codecs: Optional[list[int]] = None  # 允许协商使用的压缩算法, None为全部已注册的算法
+        self.__conn_count = 0
+        self.__metrics: Optional[Metrics] = None
+        self.set_metrics(Metrics())
+
+        self.__onMsgRecvByOpCodeCallbackDict: dict[int, self.OnMsgRecvByOpCodeCallback] = {}
+        self.__onMessageReceivedCallback: Optional[self.OnMessageReceivedCallback] = None
+        self.__onConnectedCallback: Optional[self.OnConnectedCallback] = None
+        self.__onDisconnectedCallback: Optional[self.OnDisconnectedCallback] = None
+
+    async def startserver(self, backlog: int = 100):
+        """启动server并一直运行到closeserver()"""
+        loop = asyncio.get_running_loop()
+        self.__server = await loop.create_server(self.__newConnection, self._address[0], self._address[1],
+                                                 backlog=backlog)
+        print("server start at {}".format(self._address))
+        try:
+            await self.__server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def closeserver(self):
+        if self.__server is not None:
+            self.__server.close()
+
+    def closeconn(self, conn: HTcpAsyncConnection):
+        """主动关闭一个连接(会触发 onDisconnected 回调)"""
+        conn.close()
+
+    def __newConnection(self) -> HTcpAsyncConnection:
+        conn = HTcpAsyncConnection(self._onMessageReceived, self.__connected, self.__disconnected)
+        conn.setMetrics(self.__metrics)
+        return conn
+
+    def __connected(self, conn: HTcpAsyncConnection):
+        print("connected: {}".format(conn.getpeername()))
+        self.__conn_count += 1
+        self._onConnected(conn, conn.getpeername())
+
+    def __disconnected(self, conn: HTcpAsyncConnection):
+        print("connection closed: {}".format(conn.getpeername()))
+        self.__conn_count -= 1
+        self._onDisconnected(conn, conn.getpeername())
+
+    def set_metrics(self, metrics: Optional[Metrics]):
+        """设置记录server指标的注册表, 为None时不记录也不响应STATS请求"""
+        if metrics is not None:
+            metrics.setGauge("connections", lambda: self.__conn_count)
+        self.__metrics = metrics
+
+    def metrics(self) -> Optional[Metrics]:
+        return self.__metrics
+
+    def set_compression_codecs(self, codecs: Optional[list[int]]):
+        """设置允许与client协商使用的压缩算法, 为None时允许所有已注册的算法, 为空列表时不压缩"""
+        self.__compression_codecs = codecs
+
+    def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMsgRecvByOpCodeCallback):
+        self.__onMsgRecvByOpCodeCallbackDict[opcode] = callback
+
+    def popOnMsgRecvByOpCodeCallback(self, opcode: int):
+        self.__onMsgRecvByOpCodeCallbackDict.pop(opcode)
+
+    def setOnMessageReceivedCallback(self, callback: OnMessageReceivedCallback):
+        self.__onMessageReceivedCallback = callback
+
+    def setOnConnectedCallback(self, callback: OnConnectedCallback):
+        self.__onConnectedCallback = callback
+
+    def setOnDisconnectedCallback(self, callback: OnDisconnectedCallback):
+        self.__onDisconnectedCallback = callback
+
+    def _onMessageReceived(self, conn: HTcpAsyncConnection, msg: Message) -> Optional[Awaitable]:
+        if msg.opcode() == BuiltInOpCode.COMPRESSION:
+            codec = Codec.choose(msg.get("codecs"), self.__compression_codecs)
+            reply = Message.JsonMsg(BuiltInOpCode.COMPRESSION, codec=codec)
+            reply.setRequestId(msg.requestid())
+            conn.sendMsg(reply)
+            conn.setCompression(codec)
+            return None
+        if msg.opcode() == BuiltInOpCode.HEARTBEAT:
+            if msg.statuscode() == 0:
+                conn.sendMsg(Message.HeaderOnlyMsg(BuiltInOpCode.HEARTBEAT, 1))
+            return None
+        if msg.opcode() == BuiltInOpCode.STATS and self.__metrics is not None:
+            reply = Message.JsonMsg(BuiltInOpCode.STATS, 0, self.__metrics.snapshot())
+            reply.setRequestId(msg.requestid())
+            conn.sendMsg(reply)
+            return None
+        return _timed(self.__metrics, msg.opcode(), lambda: _dispatch(
+            self.__onMsgRecvByOpCodeCallbackDict, self.__onMessageReceivedCallback, msg.opcode(), conn, msg))
+
+    def _onConnected(self, conn: HTcpAsyncConnection, addr):
+        if self.__onConnectedCallback:
+            self.__onConnectedCallback(conn, addr)
+
+    def _onDisconnected(self, conn: HTcpAsyncConnection, addr):
+        if self.__onDisconnectedCallback:
+            self.__onDisconnectedCallback(conn, addr)
+
+
+class HTcpAsyncClient:
+    """以asyncio实现的TCP client
+
+    回调的签名与HTcpChannelClient相同, 回调可以是协程函数。
+    """
+    OnMessageReceivedCallback = Callable[[Message], Optional[Awaitable]]
+    OnMsgRecvByOpCodeCallback = Callable[[Message], Union[bool, Awaitable[bool]]]  # 返回False时会继续进行OnMessageReceivedCallback
+    OnConnectedCallback = Callable[[], None]
+    OnDisconnectedCallback = Callable[[], None]
+
+    def __init__(self):
+        self.__conn: Optional[HTcpAsyncConnection] = None
+        self.__metrics: Optional[Metrics] = Metrics()
+
+        self.__onMessageReceivedCallback: Optional[self.OnMessageReceivedCallback] = None
+        self.__onMsgRecvByOpCodeCallbackDict: dict[int, self.OnMsgRecvByOpCodeCallback] = {}
+        self.__onConnectedCallback: Optional[self.OnConnectedCallback] = None
+        self.__onDisconnectedCallback: Optional[self.OnDisconnectedCallback] = None
+
+    def connection(self) -> Optional[HTcpAsyncConnection]:
+        return self.__conn
+
+    async def connect(self, addr):
+        loop = asyncio.get_running_loop()
+        protocol = HTcpAsyncConnection(lambda conn, msg: self._onMessageReceived(msg),
+                                       lambda conn: self._onConnected(),
+                                       lambda conn: self._onDisconnected())
+        protocol.setMetrics(self.__metrics)
+        await loop.create_connection(lambda: protocol, addr[0], addr[1])
+        self.__conn = protocol
+
+    def close(self):
+        if self.__conn is not None:
+            self.__conn.close()
+
+    def isclosed(self) -> bool:
+        return self.__conn is None or not self.__conn.isValid()
+
+    def set_metrics(self, metrics: Optional[Metrics]):
+        """设置记录client指标的注册表, 为None时不记录"""
+        self.__metrics = metrics
+        if self.__conn is not None:
+            self.__conn.setMetrics(metrics)
+
+    def metrics(self) -> Optional[Metrics]:
+        return self.__metrics
+
+    def requestStats(self) -> bool:
+        """向server请求指标(不等待回复), 回复以 BuiltInOpCode.STATS 为操作码交给回调"""
+        return self.sendmsg(Message.HeaderOnlyMsg(BuiltInOpCode.STATS))
+
+    def sendmsg(self, msg: Message) -> bool:
+        if self.__conn is None:
+            return False
+        return self.__conn.sendMsg(msg)
+
+    async def drain(self):
+        """等待发送缓冲区回落到低水位以下"""
+        if self.__conn is not None:
+            await self.__conn.drain()
+
+    def negotiateCompression(self, codecs: Optional[list[int]] = None) -> bool:
+        """向server请求启用压缩(不等待回复), server回复后开始压缩发送
+
+        Args:
+            codecs (Optional[list[int]]): 按偏好排列的可用算法, 为None时为所有已注册的算法
+        """
+        return self.sendmsg(Message.JsonMsg(BuiltInOpCode.COMPRESSION,
+                                            codecs=Codec.available() if codecs is None else codecs))
+
+    def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMsgRecvByOpCodeCallback):
+        self.__onMsgRecvByOpCodeCallbackDict[opcode] = callback
+
+    def popOnMsgRecvByOpCodeCallback(self, opcode: int):
+        self.__onMsgRecvByOpCodeCallbackDict.pop(opcode)
+
+    def setOnMessageReceivedCallback(self, callback: OnMessageReceivedCallback):
+        self.__onMessageReceivedCallback = callback
+
+    def setOnConnectedCallback(self, callback: OnConnectedCallback):
+        self.__onConnectedCallback = callback
+
+    def setOnDisconnectedCallback(self, callback: OnDisconnectedCallback):
+        self.__onDisconnectedCallback = callback
+
+    def _onMessageReceived(self, msg: Message) -> Optional[Awaitable]:
+        if msg.opcode() == BuiltInOpCode.COMPRESSION:
+            self.__conn.setCompression(msg.get("codec") or Codec.NONE)
+            return None
+        if msg.opcode() == BuiltInOpCode.HEARTBEAT:
+            if msg.statuscode() == 0:
+                self.sendmsg(Message.HeaderOnlyMsg(BuiltInOpCode.HEARTBEAT, 1))
+            return None
+        return _timed(self.__metrics, msg.opcode(), lambda: _dispatch(
+            self.__onMsgRecvByOpCodeCallbackDict, self.__onMessageReceivedCallback, msg.opcode(), msg))
+
+    def _onConnected(self):
+        if self.__onConnectedCallback:
+            self.__onConnectedCallback()
+
+    def _onDisconnected(self):
+        if self.__onDisconnectedCallback:
+            self.__onDisconnectedCallback()
+
+
+class HUdpAsyncEndpoint(asyncio.DatagramProtocol):
+    """以asyncio实现的UDP端点, 可作为server或client使用
+
+    回调的签名与HUdpServer相同, 回调可以是协程函数(以任务的形式执行)。
+    """
+    OnMsgRecvByOpCodeCallback = Callable[[Message, Optional[tuple]], Union[bool, Awaitable[bool]]]  # 返回False时会继续进行OnMessageReceivedCallback
+    OnMessageReceivedCallback = Callable[[Message, Optional[tuple]], Optional[Awaitable]]
+
+    def __init__(self):
+        self.__transport: Optional[asyncio.DatagramTransport] = None
+        self.__tasks: set[asyncio.Task] = set()
+
+        self.__onMsgRecvByOpCodeCallbackDict: dict[int, self.OnMsgRecvByOpCodeCallback] = {}
+        self.__onMessageReceivedCallback: Optional[self.OnMessageReceivedCallback] = None
+
+    async def open(self, local_addr=None, remote_addr=None):
+        """创建UDP端点
+
+        Args:
+            local_addr: 绑定的本地地址(作为server时使用)
+            remote_addr: 默认的对端地址(作为client时使用)
+        """
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=local_addr, remote_addr=remote_addr)
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.__transport = transport
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.__transport = None
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        self.__handle(Message.fromBytes(data), addr)
+
+    def error_received(self, exc: Exception):
+        self.__handle(Message(ContentType.ERROR_), None)
+
+    def __handle(self, msg: Message, addr: Optional[tuple]):
+        pending = self._onMessageReceived(msg, addr)
+        if pending is not None:
+            task = asyncio.ensure_future(pending)
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    def isclosed(self) -> bool:
+        return self.__transport is None or self.__transport.is_closing()
+
+    def close(self):
+        if self.__transport is not None:
+            self.__transport.close()
+
+    def sendto(self, msg: Message, addr=None):
+        """发送一个数据包, 省略addr时发往open()时指定的remote_addr"""
+        self.__transport.sendto(msg.toBytes(), addr)
+
+    def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMsgRecvByOpCodeCallback):
+        self.__onMsgRecvByOpCodeCallbackDict[opcode] = callback
+
+    def popOnMsgRecvByOpCodeCallback(self, opcode: int):
+        self.__onMsgRecvByOpCodeCallbackDict.pop(opcode)
+
+    def setOnMessageReceivedCallback(self, callback: OnMessageReceivedCallback):
+        self.__onMessageReceivedCallback = callback
+
+    def _onMessageReceived(self, msg: Message, addr: Optional[tuple]) -> Optional[Awaitable]:
+        return _dispatch(self.__onMsgRecvByOpCodeCallbackDict, self.__onMessageReceivedCallback, msg.opcode(), msg, addr)
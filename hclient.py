@@ -1,24 +1,49 @@
 # -*- coding: utf-8 -*-
 from abc import abstractmethod
 from typing import Callable
+from concurrent.futures import Future
 import threading
+import itertools
+import heapq
+import selectors
+import queue
+import time
+from contextlib import contextmanager
 from .hsocket import *
 from .message import *
-from .hserver import BuiltInOpCode
+from .filestream import *
+
+
+def _readable(sock: socket.socket, timeout: Optional[float]) -> bool:
+    """等待sock可读, 不受select()的文件描述符上限(FD_SETSIZE)限制
+
+    Raises:
+        ValueError: 套接字已关闭时抛出。
+    """
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        return bool(selector.select(timeout))
 
 
 class _HTcpClient:
     OnConnectedCallback = Callable[[], None]
     OnDisconnectedCallback = Callable[[], None]
+    OnFileReceivedCallback = Callable[[str], None]  # 经由文件流收到文件时调用, 参数为保存路径
 
     def __init__(self):
         self._tcp_socket: HTcpSocket = HTcpSocket()
         self._tcp_socket.setblocking(True)
         self._ft_server_ip = ""
         self._ft_server_port = 0
+        self._ft_stripes = 1  # server要求的并行传输连接数
+        self.__fs_sender = FileStreamSender(self._tcp_socket)
+        self.__fs_receiver = FileStreamReceiver()
+        self.__metrics: Optional[Metrics] = Metrics()
+        self._tcp_socket.setMetrics(self.__metrics)
 
         self.__onConnectedCallback: Optional[self.OnConnectedCallback] = None
         self.__onDisconnectedCallback: Optional[self.OnDisconnectedCallback] = None
+        self.__onFileReceivedCallback: Optional[self.OnFileReceivedCallback] = None
 
     def socket(self) -> HTcpSocket:
         return self._tcp_socket
@@ -26,12 +51,34 @@ class _HTcpClient:
     def settimeout(self, timeout):
         self._tcp_socket.settimeout(timeout)
 
+    def set_metrics(self, metrics: Optional[Metrics]):
+        """设置记录client指标的注册表, 为None时不记录"""
+        self.__metrics = metrics
+        self._tcp_socket.setMetrics(metrics)
+
+    def metrics(self) -> Optional[Metrics]:
+        return self.__metrics
+
+    def _countError(self, kind: str):
+        if self.__metrics is not None:
+            self.__metrics.inc("errors." + kind)
+
+    def _ftSocket(self) -> HTcpSocket:
+        """新建一个文件传输连接"""
+        ft_socket = HTcpSocket()
+        ft_socket.setMetrics(self.__metrics)
+        return ft_socket
+
     def connect(self, addr):
         self._tcp_socket.connect(addr)
         self._ft_server_ip = addr[0]
         self._onConnected()
 
     def close(self):
+        try:  # 其他线程阻塞在recv时, 仅close不会发出FIN, 也不会唤醒该线程
+            self._tcp_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self._tcp_socket.close()
 
     def isclosed(self) -> bool:
@@ -45,11 +92,12 @@ class _HTcpClient:
     def _get_ft_transfer_port(self) -> bool:
         ...
 
-    def sendfile(self, path: str, filename: str):
+    def sendfile(self, path: str, filename: str, resume: bool = False):
+        """发送一个文件, resume为True时从对端已有的部分续传"""
         if not self._get_ft_transfer_port():
             return
         # send
-        with HTcpSocket() as ft_socket:
+        with self._ftSocket() as ft_socket:
             try:
                 ft_socket.connect((self._ft_server_ip, self._ft_server_port))
             except OSError:
@@ -60,18 +108,23 @@ class _HTcpClient:
                 print(e)
                 return
             try:
-                ft_socket.sendFile(fin, filename)
+                ft_socket.sendFile(fin, filename, resume=resume, codec=self._tcp_socket.compression())
             finally:
                 fin.close()
 
-    def recvfile(self) -> str:
+    def recvfile(self, sink: Optional[RecvSink] = None) -> str:
+        """接收一个文件, sink为None时保存到默认下载目录
+
+        Returns:
+            str: sink.close()的返回值(默认为保存路径), 失败时返回空字符串
+        """
         if not self._get_ft_transfer_port():
             return ""
         # recv
         try:
-            with HTcpSocket() as ft_socket:
+            with self._ftSocket() as ft_socket:
                 ft_socket.connect((self._ft_server_ip, self._ft_server_port))
-                down_path = ft_socket.recvFile()
+                down_path = ft_socket.recvFile(sink)
             return down_path
         except OSError:
             return ""
@@ -83,7 +136,7 @@ class _HTcpClient:
             return 0
         # send
         count_sent = 0
-        with HTcpSocket() as ft_socket:
+        with self._ftSocket() as ft_socket:
             try:
                 ft_socket.connect((self._ft_server_ip, self._ft_server_port))
                 files_header_msg = Message.JsonMsg(BuiltInOpCode.FT_SEND_FILES_HEADER, 0, {"file_count": len(paths)})
@@ -99,7 +152,7 @@ class _HTcpClient:
                     print(e)
                     continue
                 try:
-                    ft_socket.sendFile(fin, filename)
+                    ft_socket.sendFile(fin, filename, codec=self._tcp_socket.compression())
                     count_sent += 1
                 except OSError:
                     return count_sent
@@ -113,7 +166,7 @@ class _HTcpClient:
         # recv
         down_path_list = []
         try:
-            with HTcpSocket() as ft_socket:
+            with self._ftSocket() as ft_socket:
                 ft_socket.connect((self._ft_server_ip, self._ft_server_port))
                 files_header_msg = ft_socket.recvMsg()
                 file_count = files_header_msg.get("file_count")
@@ -125,17 +178,115 @@ class _HTcpClient:
         except OSError:
             return down_path_list
 
+    def __connect_ft_stripes(self) -> list[HTcpSocket]:
+        ft_sockets = []
+        try:
+            for i in range(self._ft_stripes):
+                ft_socket = self._ftSocket()
+                ft_sockets.append(ft_socket)
+                ft_socket.connect((self._ft_server_ip, self._ft_server_port))
+        except OSError:
+            for ft_socket in ft_sockets:
+                ft_socket.close()
+            return []
+        return ft_sockets
+
+    def sendfilesStriped(self, paths: list[str], filenames: list[str]) -> int:
+        """经由server指定数量的传输连接并行发送多个文件, 大文件切分为多个片段并行发送
+
+        Returns:
+            int: 完整发送的文件数
+        """
+        if not self._get_ft_transfer_port():
+            return 0
+        if len(paths) != len(filenames):
+            return 0
+        ft_sockets = self.__connect_ft_stripes()
+        if not ft_sockets:
+            return 0
+        try:
+            return sendStriped(ft_sockets, paths, filenames)
+        finally:
+            for ft_socket in ft_sockets:
+                ft_socket.close()
+
+    def recvfilesStriped(self) -> list[str]:
+        """经由server指定数量的传输连接并行接收多个文件
+
+        Returns:
+            list[str]: 完整接收的文件路径
+        """
+        if not self._get_ft_transfer_port():
+            return []
+        ft_sockets = self.__connect_ft_stripes()
+        if not ft_sockets:
+            return []
+        try:
+            return recvStriped(ft_sockets)
+        finally:
+            for ft_socket in ft_sockets:
+                ft_socket.close()
+
+    def streamfile(self, path: str, filename: str) -> int:
+        """在主连接上以文件流的形式发送一个文件(不阻塞)
+
+        文件被切分为数据块, 与普通数据包交错发送, 同一连接上可以同时进行多个文件流。
+
+        Returns:
+            int: 流ID, 失败时返回0
+        """
+        try:
+            fin = open(path, 'rb')
+        except OSError as e:  # file error
+            print(e)
+            return 0
+        try:
+            return self.__fs_sender.send(fin, filename)
+        except (OSError, RuntimeError):
+            fin.close()
+            return 0
+
+    def _onHeartbeatMsg(self, msg: Message):
+        """收到server的ping时回复pong"""
+        if msg.statuscode() == 0:
+            try:
+                self.sendmsg(Message.HeaderOnlyMsg(BuiltInOpCode.HEARTBEAT, 1))
+            except OSError:  # 连接已断开, 由接收处理
+                pass
+
+    @staticmethod
+    def _compressionMsg(codecs: Optional[list[int]]) -> Message:
+        return Message.JsonMsg(BuiltInOpCode.COMPRESSION, codecs=Codec.available() if codecs is None else codecs)
+
+    def _onCompressionMsg(self, msg: Message):
+        """server回复了压缩协商的结果"""
+        self._tcp_socket.setCompression(msg.get("codec") or Codec.NONE)
+
+    def _onFileStreamMsg(self, msg: Message):
+        try:
+            down_path = self.__fs_receiver.handle(msg)
+        except OSError as e:  # file error
+            print(e)
+            return
+        if down_path and self.__onFileReceivedCallback:
+            self.__onFileReceivedCallback(down_path)
+
     def setOnConnectedCallback(self, callback: OnConnectedCallback):
         self.__onConnectedCallback = callback
 
     def setOnDisconnectedCallback(self, callback: OnDisconnectedCallback):
         self.__onDisconnectedCallback = callback
 
+    def setOnFileReceivedCallback(self, callback: OnFileReceivedCallback):
+        self.__onFileReceivedCallback = callback
+
     def _onConnected(self):
         if self.__onConnectedCallback:
             self.__onConnectedCallback()
 
     def _onDisconnected(self):
+        self.__fs_sender.abort()
+        self.__fs_receiver.close()
         if self.__onDisconnectedCallback:
             self.__onDisconnectedCallback()
 
@@ -164,6 +315,7 @@ class HTcpChannelClient(_HTcpClient):
             self.__th_message.join()  # make sure that '_onDisconnected' only runs once
             if not self.isclosed():
                 print("connection reset")
+                self._countError("conn_reset")
                 self._onDisconnected()
                 self.close()
             return False
@@ -172,6 +324,18 @@ class HTcpChannelClient(_HTcpClient):
     def set_ft_timeout(self, sec):
         self.__ft_timeout = sec
 
+    def negotiateCompression(self, codecs: Optional[list[int]] = None) -> bool:
+        """向server请求启用压缩(不等待回复), server回复后开始压缩发送
+
+        Args:
+            codecs (Optional[list[int]]): 按偏好排列的可用算法, 为None时为所有已注册的算法
+        """
+        return self.sendmsg(self._compressionMsg(codecs))
+
+    def requestStats(self) -> bool:
+        """向server请求指标(不等待回复), 回复以 BuiltInOpCode.STATS 为操作码交给回调"""
+        return self.sendmsg(Message.HeaderOnlyMsg(BuiltInOpCode.STATS))
+
     def _get_ft_transfer_port(self) -> bool:
         success = self.__con_ft_port.wait(self.__ft_timeout)  # wait for an FT_TRANSFER_PORT reply
         return success
@@ -184,14 +348,29 @@ class HTcpChannelClient(_HTcpClient):
                 continue
             except ConnectionResetError:
                 print("connection reset")
+                self._countError("conn_reset")
                 self._onDisconnected()
                 self.close()
                 break
+            except OSError:  # close()已在其他线程中调用
+                if self.isclosed():
+                    break
+                raise
             else:
+                if isFileStreamMsg(msg):
+                    self._onFileStreamMsg(msg)
+                    continue
                 if msg.opcode() == BuiltInOpCode.FT_TRANSFER_PORT:
                     self._ft_server_port = msg.get("port")
+                    self._ft_stripes = msg.get("stripes") or 1
                     self.__con_ft_port.notify()
                     continue
+                if msg.opcode() == BuiltInOpCode.COMPRESSION:
+                    self._onCompressionMsg(msg)
+                    continue
+                if msg.opcode() == BuiltInOpCode.HEARTBEAT:
+                    self._onHeartbeatMsg(msg)
+                    continue
                 self._onMessageReceived(msg)
 
     def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMessageReceivedCallback):
@@ -204,6 +383,20 @@ class HTcpChannelClient(_HTcpClient):
         self.__onMessageReceivedCallback = callback
 
     def _onMessageReceived(self, msg: Message):
+        metrics = self.metrics()
+        if metrics is None:
+            self.__dispatch(msg)
+            return
+        start = time.perf_counter_ns()
+        try:
+            self.__dispatch(msg)
+        except Exception:
+            metrics.inc("errors.handler")
+            raise
+        finally:
+            metrics.observe("handler_us", (time.perf_counter_ns() - start) // 1000, msg.opcode())
+
+    def __dispatch(self, msg: Message):
         opcode = msg.opcode()
         callback = self.__onMsgRecvByOpCodeCallbackDict.get(opcode)
         if callback is not None:
@@ -215,8 +408,21 @@ class HTcpChannelClient(_HTcpClient):
 
 
 class HTcpReqResClient(_HTcpClient):
+    """请求-响应模式的client
+
+    request()默认一问一答。调用submit()后切换为流水线模式: 每个请求带上请求ID,
+    由后台线程接收回复并按ID交给对应的Future, 同一连接上可以同时有多个请求未完成。
+    流水线模式需要server在回复中带回请求ID。
+    """
+
     def __init__(self):
         super().__init__()
+        self.__th_recv: Optional[threading.Thread] = None
+        self.__pending: dict[int, Future] = {}  # 请求ID -> 等待回复的Future
+        self.__deadlines: list[tuple[float, int]] = []  # (超时时刻, 请求ID)的小根堆
+        self.__pending_lock = threading.Lock()
+        self.__requestids = itertools.count(1)
+        self.__ft_port_queue: queue.Queue[Message] = queue.Queue()
 
     def sendmsg(self, msg: Message) -> bool:
         try:
@@ -224,39 +430,379 @@ class HTcpReqResClient(_HTcpClient):
         except ConnectionResetError:
             if not self.isclosed():
                 print("connection reset")
+                self._countError("conn_reset")
                 self._onDisconnected()
                 self.close()
             return False
         return True
 
     def request(self, msg: Message) -> Message:
+        if self.__th_recv is not None:  # 流水线模式
+            try:
+                return self.submit(msg, self._tcp_socket.gettimeout()).result()
+            except (TimeoutError, ConnectionError):
+                return Message(ContentType.ERROR_)
+        start = time.perf_counter_ns()
         if self.sendmsg(msg):
             try:
-                response = self._tcp_socket.recvMsg()
+                response = self.__recvReply()
             except TimeoutError:
+                self._countError("timeout")
                 return Message(ContentType.ERROR_)
             except ConnectionResetError:
                 print("connection reset")
+                self._countError("conn_reset")
                 self._onDisconnected()
                 self.close()
                 return Message(ContentType.ERROR_)
             else:
+                metrics = self.metrics()
+                if metrics is not None:
+                    metrics.observe("request_us", (time.perf_counter_ns() - start) // 1000, msg.opcode())
                 return response
         return Message(ContentType.ERROR_)
 
+    def __recvReply(self) -> Message:
+        """一问一答模式下接收回复, 期间收到的心跳直接回复, 文件流的帧交给文件流接收"""
+        while True:
+            response = self._tcp_socket.recvMsg()
+            if isFileStreamMsg(response):
+                self._onFileStreamMsg(response)
+            elif response.opcode() == BuiltInOpCode.HEARTBEAT:
+                self._onHeartbeatMsg(response)
+            else:
+                return response
+
+    def answerHeartbeats(self) -> bool:
+        """一问一答模式下回复空闲期间收到的心跳ping, 不阻塞
+
+        空闲时没有读取, server的ping会留在接收缓冲区中; 长时间空闲的连接可以定期调用以刷新server端的空闲时间。
+
+        Returns:
+            bool: 连接是否仍然可用, 对端已关闭、出错或收到了心跳和文件流以外的数据包时为False
+        """
+        if self.isclosed():
+            return False
+        if self.__th_recv is not None:  # 流水线模式下由后台线程回复
+            return True
+        try:
+            while _readable(self._tcp_socket, 0):
+                msgs, closed = self._tcp_socket.recvMsgs(single=True)
+                for msg in msgs:
+                    if isFileStreamMsg(msg):
+                        self._onFileStreamMsg(msg)
+                    elif msg.opcode() == BuiltInOpCode.HEARTBEAT:
+                        self._onHeartbeatMsg(msg)
+                    else:
+                        return False
+                if closed:
+                    return False
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def requestStats(self) -> dict:
+        """请求server的指标
+
+        Returns:
+            dict: server端 Metrics.snapshot() 的结果, 失败或server未开启指标时为空字典
+        """
+        response = self.request(Message.HeaderOnlyMsg(BuiltInOpCode.STATS))
+        if response.opcode() != BuiltInOpCode.STATS or response.contenttype() != ContentType.JSONOBJRCT:
+            return {}
+        return MessageConfig.JSON_LOADS(response.content())
+
+    def negotiateCompression(self, codecs: Optional[list[int]] = None) -> int:
+        """与server协商压缩算法, 之后正文较大的数据包压缩发送
+
+        Args:
+            codecs (Optional[list[int]]): 按偏好排列的可用算法, 为None时为所有已注册的算法
+
+        Returns:
+            int: 选定的算法编号, 失败或server不支持时为Codec.NONE
+        """
+        response = self.request(self._compressionMsg(codecs))
+        if response.opcode() != BuiltInOpCode.COMPRESSION:
+            return Codec.NONE
+        self._onCompressionMsg(response)
+        return self._tcp_socket.compression()
+
+    def submit(self, msg: Message, timeout: Optional[float] = None) -> Future:
+        """以流水线模式发送一个请求, 不等待回复
+
+        Args:
+            msg (Message): 请求, 发送时会被设置请求ID
+            timeout (Optional[float]): 超时秒数, 超时后Future抛出TimeoutError
+
+        Returns:
+            Future: 结果为回复的Message; 连接断开时抛出ConnectionError
+        """
+        if self.__th_recv is None:
+            with self.__pending_lock:  # 多个线程同时首次调用时只启动一个接收线程
+                if self.__th_recv is None:
+                    self.__th_recv = threading.Thread(target=self.__recv_handle, daemon=True)
+                    self.__th_recv.start()
+        future = Future()
+        metrics = self.metrics()
+        if metrics is not None:
+            start, opcode = time.perf_counter_ns(), msg.opcode()
+
+            def observe(f: Future):
+                if not f.cancelled() and f.exception() is None:
+                    metrics.observe("request_us", (time.perf_counter_ns() - start) // 1000, opcode)
+            future.add_done_callback(observe)
+        requestid = next(self.__requestids) & 0xFFFFFFFF
+        msg.setRequestId(requestid)
+        with self.__pending_lock:
+            self.__pending[requestid] = future
+            if timeout is not None:
+                heapq.heappush(self.__deadlines, (time.monotonic() + timeout, requestid))
+        if not self.sendmsg(msg):
+            self.__fail(requestid, ConnectionError("connection reset"))
+        return future
+
+    def __fail(self, requestid: int, exc: Exception):
+        with self.__pending_lock:
+            future = self.__pending.pop(requestid, None)
+        if future is not None and not future.done():
+            future.set_exception(exc)
+
+    def __expire(self) -> float:
+        """使已超时的请求失败, 返回距下一个超时的秒数"""
+        now = time.monotonic()
+        expired = []
+        with self.__pending_lock:
+            while self.__deadlines and self.__deadlines[0][0] <= now:
+                deadline, requestid = heapq.heappop(self.__deadlines)
+                future = self.__pending.pop(requestid, None)
+                if future is not None:
+                    expired.append(future)
+            wait = self.__deadlines[0][0] - now if self.__deadlines else 1.0
+        for future in expired:
+            if not future.done():
+                self._countError("timeout")
+                future.set_exception(TimeoutError("request timed out"))
+        return min(wait, 1.0)
+
+    def __recv_handle(self):
+        """流水线模式的接收线程, 每次唤醒取走已到达的全部数据包"""
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(self._tcp_socket, selectors.EVENT_READ)
+        except ValueError:  # 套接字已关闭
+            pass
+        while not self.isclosed():
+            wait = self.__expire()
+            try:
+                if not selector.select(wait):
+                    continue
+                msgs, closed = self._tcp_socket.recvMsgs(single=True)
+            except TimeoutError:
+                continue
+            except (OSError, ValueError):  # ValueError: 数据包无法解码
+                msgs, closed = [], True
+            for msg in msgs:
+                if not msg.isValid():
+                    closed = True
+                    break
+                self.__onReply(msg)
+            if closed:
+                if not self.isclosed():
+                    print("connection reset")
+                    self._onDisconnected()
+                    self.close()
+                break
+        selector.close()
+        with self.__pending_lock:
+            pending = list(self.__pending.values())
+            self.__pending.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(ConnectionError("connection closed"))
+
+    def __onReply(self, msg: Message):
+        if isFileStreamMsg(msg):  # 控制帧按操作码处理, 即使带有请求ID
+            self._onFileStreamMsg(msg)
+            return
+        if msg.opcode() == BuiltInOpCode.FT_TRANSFER_PORT:
+            self.__ft_port_queue.put(msg)
+            return
+        requestid = msg.requestid()
+        if requestid is None:
+            if msg.opcode() == BuiltInOpCode.HEARTBEAT:
+                self._onHeartbeatMsg(msg)
+            return
+        with self.__pending_lock:
+            future = self.__pending.pop(requestid, None)
+        if future is not None and not future.done():
+            future.set_result(msg)
+
     def _get_ft_transfer_port(self) -> bool:
         try:
-            msg = self._tcp_socket.recvMsg()
+            if self.__th_recv is not None:  # 流水线模式下由后台线程接收
+                msg = self.__ft_port_queue.get(timeout=self._tcp_socket.gettimeout())
+            else:
+                msg = self.__recvReply()
             if msg.opcode() == BuiltInOpCode.FT_TRANSFER_PORT:
                 self._ft_server_port = msg.get("port")
+                self._ft_stripes = msg.get("stripes") or 1
                 print(self._ft_server_port)
                 return True
             else:
                 return False
-        except OSError:
+        except (OSError, queue.Empty):
             return False
 
 
+class HTcpClientPool:
+    """线程安全的HTcpReqResClient连接池
+
+    连接在需要时才创建, 数量不超过max_size; 空闲超过idle_timeout的连接会被关闭, 但至少保留min_size个。
+    取出连接时检查其是否仍然可用, 不可用的连接会被静默替换。
+    """
+
+    def __init__(self, addr, min_size: int = 0, max_size: int = 8, idle_timeout: float = 60.0,
+                 timeout: Optional[float] = None):
+        """
+        Args:
+            addr: server地址
+            min_size (int): 空闲回收时至少保留的连接数
+            max_size (int): 最大连接数
+            idle_timeout (float): 空闲连接的回收秒数
+            timeout (Optional[float]): 每个连接的套接字超时
+        """
+        self._address = addr
+        self.__min_size = min_size
+        self.__max_size = max_size
+        self.__idle_timeout = idle_timeout
+        self.__timeout = timeout
+        self.__idle: list[tuple[HTcpReqResClient, float]] = []  # (连接, 归还时刻), 最近归还的在末尾
+        self.__size = 0  # 已创建且未关闭的连接数
+        self.__closed = False
+        self.__cond = threading.Condition()
+
+    def size(self) -> int:
+        """当前连接数(含借出的连接)"""
+        return self.__size
+
+    def acquire(self, timeout: Optional[float] = None) -> HTcpReqResClient:
+        """借出一个连接, 用完后需要调用release()归还
+
+        Raises:
+            TimeoutError: 连接数已达上限且等待超时时抛出。
+            OSError: 创建新连接失败时抛出。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.__cond:
+                while True:
+                    if self.__closed:
+                        raise RuntimeError("pool is closed")
+                    expired = self.__evictIdle()
+                    client = self.__idle.pop()[0] if self.__idle else None
+                    if client is not None or expired:
+                        break
+                    if self.__size < self.__max_size:  # 占用一个新连接的名额
+                        self.__size += 1
+                        break
+                    wait = None if deadline is None else deadline - time.monotonic()
+                    if wait is not None and wait <= 0:
+                        raise TimeoutError("no available connection in pool")
+                    self.__cond.wait(wait)
+            # 检查连接和关闭连接都涉及网络I/O, 在锁外进行
+            for expired_client in expired:
+                expired_client.close()
+            if client is not None:
+                if self.__isHealthy(client):
+                    return client
+                self.__discard(client)
+            elif not expired:
+                break
+        try:  # 在锁外建立连接
+            return self.__connect()
+        except BaseException:
+            with self.__cond:
+                self.__size -= 1
+                self.__cond.notify()
+            raise
+
+    def release(self, client: HTcpReqResClient, discard: bool = False):
+        """归还一个连接, 已关闭的连接会被丢弃
+
+        Args:
+            client (HTcpReqResClient): 借出的连接
+            discard (bool): 关闭该连接而不放回, 用于请求超时或出错之后, 以免迟到的回复被下一个借用者收到
+        """
+        with self.__cond:
+            if not (discard or self.__closed or client.isclosed()):
+                self.__idle.append((client, time.monotonic()))
+                self.__cond.notify()
+                return
+        self.__discard(client)
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """以with语句借出并自动归还一个连接, with块中抛出异常时该连接被丢弃"""
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except BaseException:
+            self.release(client, discard=True)
+            raise
+        self.release(client)
+
+    def request(self, msg: Message) -> Message:
+        """借出一个连接发送请求并等待回复, 超时或出错(返回ERROR_)时丢弃该连接"""
+        client = self.acquire()
+        try:
+            response = client.request(msg)
+        except BaseException:
+            self.release(client, discard=True)
+            raise
+        self.release(client, discard=response.contenttype() == ContentType.ERROR_)
+        return response
+
+    def close(self):
+        """关闭所有空闲连接, 借出的连接归还时关闭"""
+        with self.__cond:
+            self.__closed = True
+            idle = [client for client, _ in self.__idle]
+            self.__idle.clear()
+            self.__cond.notify_all()
+        for client in idle:
+            self.__discard(client)
+
+    def __connect(self) -> HTcpReqResClient:
+        client = HTcpReqResClient()
+        client.settimeout(self.__timeout)
+        client.connect(self._address)
+        return client
+
+    def __discard(self, client: HTcpReqResClient):
+        """关闭一个连接并从连接数中扣除, 在锁外调用"""
+        client.close()
+        with self.__cond:
+            self.__size -= 1
+            self.__cond.notify()
+
+    def __evictIdle(self) -> list[HTcpReqResClient]:
+        """取出空闲过久的连接并从连接数中扣除, 由调用者在锁外关闭; idle列表按归还时间排序, 最早的在前"""
+        expire = time.monotonic() - self.__idle_timeout
+        expired = []
+        while self.__idle and self.__size > self.__min_size and self.__idle[0][1] < expire:
+            client, _ = self.__idle.pop(0)
+            self.__size -= 1
+            expired.append(client)
+        if expired:
+            self.__cond.notify(len(expired))
+        return expired
+
+    @staticmethod
+    def __isHealthy(client: HTcpReqResClient) -> bool:
+        """空闲连接只可能收到心跳ping, 回复之; 其他可读数据说明对端已关闭或残留了未取走的回复"""
+        return client.answerHeartbeats()
+
+
 class _HUdpClient:
     def __init__(self, addr):
         self._udp_socket: HUdpSocket = HUdpSocket()
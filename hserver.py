@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
 import selectors
+import threading
+import traceback
+import time
+import multiprocessing
+import multiprocessing.connection
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from socketserver import ThreadingTCPServer, BaseRequestHandler
 from abc import abstractmethod
-from typing import Callable
+from typing import Callable, Iterable
 from .hsocket import *
 from .message import *
+from .filestream import *
+from .timerwheel import Timer, TimerWheel
+from .ratelimit import RateLimitAction, RateLimit, ConnectionLimiter
 
 
-class BuiltInOpCode(IntEnum):
-    FT_TRANSFER_PORT = 60020  # 文件传输端口 {"port": port}
-    FT_SEND_FILES_HEADER = 62000  # 多文件传输时头部信息 {"file_count": 文件数}
+class SlowConsumerPolicy(IntEnum):
+    """广播/发布时, 发送队列超过上限的连接的处理方式"""
+    DROP = 0  # 丢弃该连接的这条数据包
+    DISCONNECT = 1  # 断开该连接
+    CONFLATE = 2  # 每个主题只保留最新的一条, 队列回落后再发送
+
+
+_REJECT_FULL = Message.HeaderOnlyMsg(BuiltInOpCode.REJECTED, RejectReason.CONNECTIONS_FULL).toBytes()  # 连接数已满时发送的拒绝帧
 
 
 class __HTcpServer:
@@ -17,15 +32,48 @@ class __HTcpServer:
     OnMessageReceivedCallback = Callable[[HTcpSocket, Message], None]
     OnConnectedCallback = Callable[[HTcpSocket, tuple], None]
     OnDisconnectedCallback = Callable[[HTcpSocket, tuple], None]
+    OnFileReceivedCallback = Callable[[HTcpSocket, str], None]  # 经由文件流收到文件时调用, 参数为保存路径
+    _PACED_READ = False  # 一次读取中解码出多个数据包, 需要按限速(DELAY)逐个放行(见 ConnectionLimiter 的pace)
 
     def __init__(self, addr):
         self._address: str = addr
+        self._reuse_port = False  # 绑定监听端口时是否设置SO_REUSEPORT
+        self._backlog = 128  # 监听队列长度
+        self.__max_connections: Optional[int] = None
+        self.__admitted: set[HTcpSocket] = set()  # 已占用连接数名额的连接, 在接受时加入, 断开时移除
+        self.__admit_lock = threading.Lock()
         self.__ft_timeout = 15
+        self.__compression_codecs: Optional[list[int]] = None  # 允许协商使用的压缩算法, None为全部已注册的算法
+        self.__workers: list[Optional[multiprocessing.Process]] = []
+        self.__supervising = False
 
         self.__onMsgRecvByOpCodeCallbackDict: dict[int, self.OnMsgRecvByOpCodeCallback] = {}
+        self.__pooledOpCodes: set[int] = set()  # 在线程池中执行回调的操作码
         self.__onMessageReceivedCallback: Optional[self.OnMessageReceivedCallback] = None
         self.__onConnectedCallback: Optional[self.OnConnectedCallback] = None
         self.__onDisconnectedCallback: Optional[self.OnDisconnectedCallback] = None
+        self.__onFileReceivedCallback: Optional[self.OnFileReceivedCallback] = None
+
+        self.__fs_senders: dict[HTcpSocket, FileStreamSender] = {}
+        self.__fs_receivers: dict[HTcpSocket, FileStreamReceiver] = {}
+        self.__fs_lock = threading.Lock()
+
+        self.__conns: dict[HTcpSocket, tuple] = {}  # 当前的连接 -> 对端地址
+        self.__topics: dict[str, set[HTcpSocket]] = {}  # 主题 -> 订阅的连接
+        self.__subscriptions: dict[HTcpSocket, set[str]] = {}  # 连接 -> 订阅的主题
+        self.__conflated: dict[HTcpSocket, dict[Optional[str], list]] = {}  # 连接 -> {主题: 被合并的最新数据}
+        self.__slow_consumer_policy = SlowConsumerPolicy.DROP
+        self.__slow_consumer_limit = 1024 * 1024
+        self.__pubsub_lock = threading.Lock()
+
+        self.__rate_limits: dict[Optional[int], RateLimit] = {}  # 操作码 -> 限速, None为整个连接的限速
+        self.__max_inflight: Optional[int] = None
+        self.__inflight_action = RateLimitAction.REJECT
+        self.__limiters: dict[HTcpSocket, ConnectionLimiter] = {}
+
+        self.__metrics: Optional[Metrics] = None
+        self.set_metrics(Metrics())
+        self.__profiler: Optional[Profiler] = Profiler()
 
     @abstractmethod
     def startserver(self):
@@ -41,24 +89,244 @@ class __HTcpServer:
         """主动关闭一个连接"""
         conn.close()
 
+    def startworkers(self, worker_count: int):
+        """以多进程模式启动server
+
+        启动worker_count个工作进程, 各自以SO_REUSEPORT绑定同一地址, 由内核在进程间分配连接。
+        当前进程作为监督进程, 重启意外退出的工作进程, 直到调用closeserver()。
+        已注册的回调随fork复制到各工作进程中, 无需改动。
+
+        Raises:
+            OSError: 平台不支持SO_REUSEPORT时抛出。
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise OSError("SO_REUSEPORT is not supported on this platform")
+        ctx = multiprocessing.get_context("fork")
+        self.__supervising = True
+        self.__workers = [None] * worker_count
+        print("supervisor start at {} with {} workers".format(self._address, worker_count))
+        try:
+            while self.__supervising:
+                for i, worker in enumerate(self.__workers):
+                    if not self.__supervising:
+                        break
+                    if worker is not None:
+                        if worker.is_alive():
+                            continue
+                        print("worker {} exited with code {}, restarting".format(worker.pid, worker.exitcode))
+                        time.sleep(1)  # 避免启动即崩溃的worker被不停重启
+                    worker = ctx.Process(target=self.__runworker, daemon=True)
+                    worker.start()
+                    self.__workers[i] = worker
+                multiprocessing.connection.wait([worker.sentinel for worker in self.__workers if worker is not None])
+        finally:
+            self._closeworkers()
+
+    def __runworker(self):
+        self._reuse_port = True
+        self.__supervising = False
+        self.__workers = []
+        self._prepareworker()
+        try:
+            self.startserver()
+        except KeyboardInterrupt:
+            pass
+
+    def _prepareworker(self):
+        """在新fork出的工作进程中调用, 重建不能与父进程共享的套接字等资源"""
+        ...
+
+    def _closeworkers(self) -> bool:
+        """关闭所有工作进程
+
+        Returns:
+            bool: 当前是否为多进程模式的监督进程
+        """
+        if not self.__workers:
+            return False
+        self.__supervising = False
+        workers = [worker for worker in self.__workers if worker is not None]
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+        return True
+
     def set_ft_timeout(self, sec):
         """设置文件传输超时时间"""
         self.__ft_timeout = sec
 
+    def set_compression_codecs(self, codecs: Optional[list[int]]):
+        """设置允许与client协商使用的压缩算法, 为None时允许所有已注册的算法, 为空列表时不压缩"""
+        self.__compression_codecs = codecs
+
+    def set_backlog(self, backlog: int):
+        """设置监听队列长度(listen的backlog, 受系统somaxconn限制), 在startserver()之前调用"""
+        self._backlog = backlog
+
+    def set_max_connections(self, count: Optional[int]):
+        """设置最大连接数, 已满时新连接收到 BuiltInOpCode.REJECTED 后立即被关闭, 为None时不限制"""
+        self.__max_connections = count
+
+    def _admit(self, conn: HTcpSocket, addr) -> bool:
+        """检查是否接受一个新连接, 接受时立即占用一个名额, 不接受时向其发送拒绝帧, 由调用者关闭
+
+        名额在接受时占用而不是在_onConnected()中, 以免同时到达的多个连接都通过检查而超出上限。
+        """
+        with self.__admit_lock:
+            if self.__max_connections is None or len(self.__admitted) < self.__max_connections:
+                self.__admitted.add(conn)
+                return True
+        print("connection rejected: {}".format(addr))
+        self._countError("rejected")
+        try:
+            conn.setblocking(False)
+            conn.send(_REJECT_FULL)
+        except OSError:
+            pass
+        return False
+
+    def _releaseSlot(self, conn: HTcpSocket):
+        """释放连接占用的名额, 可以重复调用"""
+        with self.__admit_lock:
+            self.__admitted.discard(conn)
+
+    def set_rate_limit(self, msgs_per_sec: Optional[float] = None, bytes_per_sec: Optional[float] = None,
+                       action: RateLimitAction = RateLimitAction.DROP, burst: float = 1.0,
+                       opcode: Optional[int] = None):
+        """设置每个连接的令牌桶限速, 两个限额都为None时取消; 对之后建立的连接生效
+
+        限速在报头接收完毕时检查, 被丢弃或拒绝的数据包的正文不会被保存或解码。
+
+        Args:
+            msgs_per_sec (Optional[float]): 每秒的数据包数
+            bytes_per_sec (Optional[float]): 每秒的字节数(含报头)
+            action (RateLimitAction): 超出时的处理方式, REJECT回复的状态码为 RejectReason.RATE_LIMITED
+            burst (float): 允许的突发量, 以秒计, 即令牌桶可以积累burst秒的限额
+            opcode (Optional[int]): 只限制该操作码的数据包(每个连接各自计算), 为None时限制连接的全部数据包
+        """
+        if msgs_per_sec is None and bytes_per_sec is None:
+            self.__rate_limits.pop(opcode, None)
+        else:
+            self.__rate_limits[opcode] = RateLimit(msgs_per_sec, bytes_per_sec, burst, action)
+
+    def set_max_inflight(self, count: Optional[int], action: RateLimitAction = RateLimitAction.REJECT):
+        """设置每个连接已接收但未处理完的数据包数上限, 为None时不限制; 对之后建立的连接生效
+
+        HTcpSelectorServer中, 一次读取的多个数据包和线程池中排队的数据包都计入; HTcpThreadingServer逐个处理,
+        只有处理中的一个。
+
+        Args:
+            count (Optional[int]): 上限
+            action (RateLimitAction): 达到上限时的处理方式, DELAY为暂停读取该连接直到有数据包处理完,
+                REJECT回复的状态码为 RejectReason.TOO_MANY_INFLIGHT
+        """
+        self.__max_inflight = count
+        self.__inflight_action = action
+
+    def _limiter(self, conn: HTcpSocket) -> Optional[ConnectionLimiter]:
+        return self.__limiters.get(conn)
+
+    def __filterHeader(self, conn: HTcpSocket, limiter: ConnectionLimiter, header: Header) -> bool:
+        """报头过滤器, 在接收数据的线程中调用, 返回False时跳过该数据包"""
+        verdict = limiter.check(header)
+        if verdict is None:
+            return True
+        action, reason = verdict
+        self._countLimited(action)
+        if action == RateLimitAction.DELAY:  # 照常处理, 由server暂停读取
+            return True
+        if action == RateLimitAction.REJECT:
+            reply = Message.HeaderOnlyMsg(BuiltInOpCode.REJECTED, reason)
+            reply.setRequestId(header.requestid)
+            try:
+                conn.sendMsg(reply)
+            except OSError:  # 连接已断开, 由接收处理
+                pass
+        return False
+
+    def _countLimited(self, action: RateLimitAction):
+        """记录一次被限制的数据包, 计数器为 ratelimit.drop/delay/reject"""
+        if self.__metrics is not None:
+            self.__metrics.inc("ratelimit." + action.name.lower())
+
+    def _onMessageDone(self, conn: HTcpSocket) -> bool:
+        """一个数据包处理完毕后由server调用
+
+        Returns:
+            bool: 是否应恢复读取该连接(因处理中的数据包达到上限而暂停的)
+        """
+        limiter = self.__limiters.get(conn)
+        return limiter is not None and limiter.done()
+
+    def set_metrics(self, metrics: Optional[Metrics]):
+        """设置记录server指标的注册表, 为None时不记录也不响应STATS请求
+
+        注册表会被加上 connections 和 send_queue_bytes 两个仪表, 已建立的连接不受影响。
+        """
+        if metrics is not None:
+            metrics.setGauge("connections", lambda: len(self.__conns))
+            metrics.setGauge("send_queue_bytes", self.__queuedBytes)
+        self.__metrics = metrics
+
+    def metrics(self) -> Optional[Metrics]:
+        return self.__metrics
+
+    def set_profiler(self, profiler: Optional[Profiler]):
+        """设置剖析器, 为None时关闭剖析相关的检查; 之后建立的连接生效"""
+        self.__profiler = profiler
+
+    def profiler(self) -> Optional[Profiler]:
+        """剖析器, 默认已设置但未开启, 调用 profiler().start() 即可在运行中开始剖析"""
+        return self.__profiler
+
+    def __queuedBytes(self) -> int:
+        total = 0
+        for conn in self.connections():
+            queue = conn.sendQueue()
+            if queue is not None:
+                total += queue.size()
+        return total
+
+    def _countError(self, kind: str):
+        """记录一次错误, kind如 "conn_reset" """
+        if self.__metrics is not None:
+            self.__metrics.inc("errors." + kind)
+
     def _get_ft_transfer_conn(self, conn: HTcpSocket) -> Optional[HTcpSocket]:
+        c_sockets = self._get_ft_transfer_conns(conn, 1)
+        return c_sockets[0] if c_sockets else None
+
+    def _get_ft_transfer_conns(self, conn: HTcpSocket, count: int) -> list[HTcpSocket]:
+        """开启临时端口并等待对端建立count个传输连接, 失败时返回空列表"""
+        c_sockets = []
         with HTcpSocket() as ft_socket:
             try:
                 ft_socket.bind((self._address[0], 0))
                 port = ft_socket.getsockname()[1]
-                conn.sendMsg(Message.JsonMsg(BuiltInOpCode.FT_TRANSFER_PORT, port=port))
                 ft_socket.settimeout(self.__ft_timeout)
-                ft_socket.listen(1)
-                c_socket, c_addr = ft_socket.accept()
-                return c_socket
+                ft_socket.listen(count)  # 先监听再通知对端, 避免对端连接时端口尚未监听
+                if count > 1:
+                    conn.sendMsg(Message.JsonMsg(BuiltInOpCode.FT_TRANSFER_PORT, port=port, stripes=count))
+                else:
+                    conn.sendMsg(Message.JsonMsg(BuiltInOpCode.FT_TRANSFER_PORT, port=port))
+                for i in range(count):
+                    c_socket, c_addr = ft_socket.accept()
+                    c_socket.setMetrics(self.__metrics)
+                    c_sockets.append(c_socket)
+                return c_sockets
             except OSError:
-                return None
+                for c_socket in c_sockets:
+                    c_socket.close()
+                self._countError("ft")
+                return []
 
-    def sendfile(self, conn: HTcpSocket, path: str, filename: str):
+    def sendfile(self, conn: HTcpSocket, path: str, filename: str, resume: bool = False):
+        """发送一个文件, resume为True时从对端已有的部分续传"""
         c_socket = self._get_ft_transfer_conn(conn)
         if c_socket is None:
             return
@@ -69,17 +337,22 @@ class __HTcpServer:
                 print(e)
                 return
             try:
-                c_socket.sendFile(fin, filename)
+                c_socket.sendFile(fin, filename, resume=resume, codec=conn.compression())
             finally:
                 fin.close()
 
-    def recvfile(self, conn: HTcpSocket) -> str:
+    def recvfile(self, conn: HTcpSocket, sink: Optional[RecvSink] = None) -> str:
+        """接收一个文件, sink为None时保存到默认下载目录
+
+        Returns:
+            str: sink.close()的返回值(默认为保存路径), 失败时返回空字符串
+        """
         c_socket = self._get_ft_transfer_conn(conn)
         if c_socket is None:
-            return
+            return ""
         with c_socket:
             try:
-                down_path = c_socket.recvFile()
+                down_path = c_socket.recvFile(sink)
                 return down_path
             except OSError:
                 return ""
@@ -106,7 +379,7 @@ class __HTcpServer:
                     print(e)
                     continue
                 try:
-                    c_socket.sendFile(fin, filename)
+                    c_socket.sendFile(fin, filename, codec=conn.compression())
                     count_sent += 1
                 except OSError:
                     return count_sent
@@ -131,11 +404,225 @@ class __HTcpServer:
             except OSError:
                 return down_path_list
 
-    def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMessageReceivedCallback):
+    def sendfilesStriped(self, conn: HTcpSocket, paths: list[str], filenames: list[str], stripes: int = 4) -> int:
+        """经由stripes个传输连接并行发送多个文件, 大文件切分为多个片段并行发送
+
+        Returns:
+            int: 完整发送的文件数
+        """
+        if len(paths) != len(filenames):
+            return 0
+        c_sockets = self._get_ft_transfer_conns(conn, stripes)
+        if not c_sockets:
+            return 0
+        try:
+            return sendStriped(c_sockets, paths, filenames)
+        finally:
+            for c_socket in c_sockets:
+                c_socket.close()
+
+    def recvfilesStriped(self, conn: HTcpSocket, stripes: int = 4) -> list[str]:
+        """经由stripes个传输连接并行接收多个文件
+
+        Returns:
+            list[str]: 完整接收的文件路径
+        """
+        c_sockets = self._get_ft_transfer_conns(conn, stripes)
+        if not c_sockets:
+            return []
+        try:
+            return recvStriped(c_sockets)
+        finally:
+            for c_socket in c_sockets:
+                c_socket.close()
+
+    def streamfile(self, conn: HTcpSocket, path: str, filename: str) -> int:
+        """在主连接上以文件流的形式发送一个文件(不阻塞)
+
+        文件被切分为数据块, 与普通数据包交错发送, 同一连接上可以同时进行多个文件流。
+        对端以 OnFileReceivedCallback 接收。
+
+        Returns:
+            int: 流ID, 失败时返回0
+        """
+        try:
+            fin = open(path, 'rb')
+        except OSError as e:  # file error
+            print(e)
+            return 0
+        with self.__fs_lock:
+            sender = self.__fs_senders.get(conn)
+            if sender is None:
+                sender = self.__fs_senders[conn] = FileStreamSender(conn)
+        try:
+            return sender.send(fin, filename)
+        except (OSError, RuntimeError):
+            fin.close()
+            return 0
+
+    def __onFileStreamMsg(self, conn: HTcpSocket, msg: Message):
+        with self.__fs_lock:
+            receiver = self.__fs_receivers.get(conn)
+            if receiver is None:
+                receiver = self.__fs_receivers[conn] = FileStreamReceiver()
+        try:
+            down_path = receiver.handle(msg)
+        except OSError as e:  # file error
+            print(e)
+            return
+        if down_path and self.__onFileReceivedCallback:
+            self.__onFileReceivedCallback(conn, down_path)
+
+    def setOnFileReceivedCallback(self, callback: OnFileReceivedCallback):
+        self.__onFileReceivedCallback = callback
+
+    def connections(self) -> list[HTcpSocket]:
+        """当前的全部连接"""
+        with self.__pubsub_lock:
+            return list(self.__conns)
+
+    def set_slow_consumer_policy(self, policy: SlowConsumerPolicy, limit: int = 1024 * 1024):
+        """设置broadcast()/publish()对慢连接的处理方式
+
+        Args:
+            policy (SlowConsumerPolicy): 处理方式
+            limit (int): 发送队列中待发送的字节数超过该值时视为慢连接
+        """
+        self.__slow_consumer_policy = policy
+        self.__slow_consumer_limit = limit
+
+    def subscribe(self, conn: HTcpSocket, topic: str):
+        """使conn订阅topic, 连接断开时自动取消"""
+        with self.__pubsub_lock:
+            if conn not in self.__conns:
+                return
+            self.__topics.setdefault(topic, set()).add(conn)
+            self.__subscriptions.setdefault(conn, set()).add(topic)
+
+    def unsubscribe(self, conn: HTcpSocket, topic: Optional[str] = None):
+        """取消conn对topic的订阅, topic为None时取消其全部订阅"""
+        with self.__pubsub_lock:
+            topics = self.__subscriptions.get(conn)
+            if not topics:
+                return
+            for t in ([topic] if topic is not None else list(topics)):
+                topics.discard(t)
+                subscribers = self.__topics.get(t)
+                if subscribers is not None:
+                    subscribers.discard(conn)
+                    if not subscribers:
+                        del self.__topics[t]
+            if not topics:
+                del self.__subscriptions[conn]
+
+    def subscribers(self, topic: str) -> list[HTcpSocket]:
+        with self.__pubsub_lock:
+            return list(self.__topics.get(topic, ()))
+
+    def broadcast(self, msg: Message, conns: Optional[Iterable[HTcpSocket]] = None) -> int:
+        """向多个连接发送同一个数据包
+
+        数据包对每种压缩算法只编码一次。经由发送队列发送的连接不会阻塞, 发送队列过长的连接按
+        set_slow_consumer_policy()的设置处理; 没有发送队列的连接(HTcpThreadingServer)以阻塞方式发送。
+
+        Args:
+            msg (Message): 数据包
+            conns (Optional[Iterable[HTcpSocket]]): 目标连接, 为None时为全部连接
+
+        Returns:
+            int: 已发送或排队的连接数
+        """
+        if conns is None:
+            conns = self.connections()
+        return self.__deliver(conns, msg, None)
+
+    def publish(self, topic: str, msg: Message) -> int:
+        """向订阅了topic的全部连接发送数据包, 规则同broadcast()
+
+        Returns:
+            int: 已发送或排队的连接数
+        """
+        return self.__deliver(self.subscribers(topic), msg, topic)
+
+    def __deliver(self, conns: Iterable[HTcpSocket], msg: Message, topic: Optional[str]) -> int:
+        encoded: dict[int, list] = {}  # 压缩算法 -> 编码结果
+        count = 0
+        for conn in conns:
+            codec = conn.compression()
+            buffers = encoded.get(codec)
+            if buffers is None:
+                buffers = encoded[codec] = msg.toBuffers(codec)
+            if self.__offer(conn, buffers, topic):
+                count += 1
+        return count
+
+    def __offer(self, conn: HTcpSocket, buffers: list, topic: Optional[str]) -> bool:
+        queue = conn.sendQueue()
+        try:
+            if queue is None:
+                conn.sendBuffers(buffers)
+                return True
+            if queue.size() > self.__slow_consumer_limit:
+                match self.__slow_consumer_policy:
+                    case SlowConsumerPolicy.DISCONNECT:
+                        print("slow consumer disconnected: {}".format(self.__conns.get(conn)))
+                        self._countError("slow_consumer")
+                        self.closeconn(conn)
+                        return False
+                    case SlowConsumerPolicy.CONFLATE:
+                        with self.__pubsub_lock:
+                            if conn not in self.__conns:
+                                return False
+                            self.__conflated.setdefault(conn, {})[topic] = buffers
+                        return True
+                    case _:
+                        self._countError("slow_consumer")
+                        return False
+            if self.__conflated:
+                with self.__pubsub_lock:
+                    conflated = self.__conflated.pop(conn, None)
+                if conflated:  # 先补发较早被合并的其他主题, 同一主题的旧数据被这次的取代
+                    conflated.pop(topic, None)
+                    for pending in conflated.values():
+                        conn.sendBuffers(pending)
+            conn.sendBuffers(buffers)
+            return True
+        except OSError:  # 连接已断开, 由I/O线程处理
+            return False
+
+    def _onSendDrained(self, conn: HTcpSocket):
+        """发送队列有数据发出后由server调用, 补发被合并的数据包"""
+        if not self.__conflated:
+            return
+        queue = conn.sendQueue()
+        if queue is None or queue.size() > self.__slow_consumer_limit:
+            return
+        with self.__pubsub_lock:
+            conflated = self.__conflated.pop(conn, None)
+        if conflated:
+            for pending in conflated.values():
+                conn.sendBuffers(pending)
+
+    def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMessageReceivedCallback, pooled: bool = False):
+        """设置按操作码分发的回调
+
+        Args:
+            opcode (int): 操作码
+            callback (OnMsgRecvByOpCodeCallback): 回调
+            pooled (bool): 是否在工作线程池中执行(需要server支持并已设置线程池), 否则在I/O线程中直接执行
+        """
         self.__onMsgRecvByOpCodeCallbackDict[opcode] = callback
+        if pooled:
+            self.__pooledOpCodes.add(opcode)
+        else:
+            self.__pooledOpCodes.discard(opcode)
 
     def popOnMsgRecvByOpCodeCallback(self, opcode: int):
         self.__onMsgRecvByOpCodeCallbackDict.pop(opcode)
+        self.__pooledOpCodes.discard(opcode)
+
+    def _isPooledOpCode(self, opcode: int) -> bool:
+        return opcode in self.__pooledOpCodes
 
     def setOnMessageReceivedCallback(self, callback: OnMessageReceivedCallback):
         self.__onMessageReceivedCallback = callback
@@ -147,117 +634,648 @@ class __HTcpServer:
         self.__onDisconnectedCallback = callback
 
     def _onMessageReceived(self, conn: HTcpSocket, msg: Message):
+        profiler = self.__profiler
+        if profiler is not None and profiler.tracing():
+            with profiler.span("dispatch", opcode=msg.opcode()):
+                self.__measure(conn, msg)
+        else:
+            self.__measure(conn, msg)
+
+    def __measure(self, conn: HTcpSocket, msg: Message):
+        metrics = self.__metrics
+        if metrics is None:
+            self.__handle(conn, msg)
+            return
+        start = time.perf_counter_ns()
+        try:
+            self.__handle(conn, msg)
+        except Exception:
+            metrics.inc("errors.handler")
+            raise
+        finally:
+            metrics.observe("handler_us", (time.perf_counter_ns() - start) // 1000, msg.opcode())
+
+    def __handle(self, conn: HTcpSocket, msg: Message):
+        if isFileStreamMsg(msg):
+            self.__onFileStreamMsg(conn, msg)
+            return
+        requestid = msg.requestid()
+        if requestid is not None:  # 回调中经由conn发送的回复会带上相同的请求ID
+            conn.setReplyId(requestid)
+            try:
+                self.__dispatch(conn, msg)
+            finally:
+                conn.setReplyId(None)
+        else:
+            self.__dispatch(conn, msg)
+
+    def __onCompressionMsg(self, conn: HTcpSocket, msg: Message):
+        codec = Codec.choose(msg.get("codecs"), self.__compression_codecs)
+        conn.sendMsg(Message.JsonMsg(BuiltInOpCode.COMPRESSION, codec=codec))
+        conn.setCompression(codec)
+
+    def __dispatch(self, conn: HTcpSocket, msg: Message):
         opcode = msg.opcode()
+        if opcode == BuiltInOpCode.COMPRESSION:
+            self.__onCompressionMsg(conn, msg)
+            return
+        if opcode == BuiltInOpCode.HEARTBEAT:  # 活动时间已在接收时更新
+            if msg.statuscode() == 0:
+                conn.sendMsg(Message.HeaderOnlyMsg(BuiltInOpCode.HEARTBEAT, 1))
+            return
+        if opcode == BuiltInOpCode.STATS and self.__metrics is not None:
+            conn.sendMsg(Message.JsonMsg(BuiltInOpCode.STATS, 0, self.__metrics.snapshot()))
+            return
         callback = self.__onMsgRecvByOpCodeCallbackDict.get(opcode)
         if callback is not None:
-            finished = callback(conn, msg)
+            finished = self.__call(callback, conn, msg)
             if finished:
                 return
         if self.__onMessageReceivedCallback:
-            self.__onMessageReceivedCallback(conn, msg)
+            self.__call(self.__onMessageReceivedCallback, conn, msg)
+
+    def __call(self, callback: Callable, conn: HTcpSocket, msg: Message):
+        profiler = self.__profiler
+        if profiler is not None and profiler.tracing():
+            with profiler.span(getattr(callback, "__qualname__", repr(callback)), "callback", opcode=msg.opcode()):
+                return callback(conn, msg)
+        return callback(conn, msg)
 
     def _onConnected(self, conn: HTcpSocket, addr):
+        conn.setMetrics(self.__metrics)
+        conn.setProfiler(self.__profiler)
+        if self.__rate_limits or self.__max_inflight is not None:
+            limiter = ConnectionLimiter(dict(self.__rate_limits), self.__max_inflight, self.__inflight_action,
+                                        self._PACED_READ)
+            self.__limiters[conn] = limiter
+            conn.setHeaderFilter(lambda header: self.__filterHeader(conn, limiter, header))
+        with self.__pubsub_lock:
+            self.__conns[conn] = addr
         if self.__onConnectedCallback:
             self.__onConnectedCallback(conn, addr)
 
     def _onDisconnected(self, conn: HTcpSocket, addr):
+        """清理连接的状态并调用断开回调, 同一连接只处理一次, 之后的调用直接返回"""
+        self._releaseSlot(conn)
+        with self.__pubsub_lock:
+            if conn not in self.__conns:
+                return
+            del self.__conns[conn]
+            self.__conflated.pop(conn, None)
+        self.unsubscribe(conn)
+        self.__limiters.pop(conn, None)
+        with self.__fs_lock:
+            sender = self.__fs_senders.pop(conn, None)
+            receiver = self.__fs_receivers.pop(conn, None)
+        if sender is not None:
+            sender.abort()
+        if receiver is not None:
+            receiver.close()
         if self.__onDisconnectedCallback:
             self.__onDisconnectedCallback(conn, addr)
 
 
 class HTcpSelectorServer(__HTcpServer):
     """以selector实现并发的HTcpServer"""
+    _PACED_READ = True
 
     class __HServerSelector:
         def __init__(self, hserver: "HTcpSelectorServer"):
             self.hserver: "HTcpSelectorServer" = hserver
             self.server_socket = HTcpSocket()
-            self.msgs: dict[HTcpSocket, Message] = {}
+            self.conns: dict[HTcpSocket, tuple] = {}
+            self.paused: set[HTcpSocket] = set()  # 发送队列超过高水位而暂停读取的连接
+            self.tasks: dict[HTcpSocket, deque[Message]] = {}  # 各连接在线程池中排队的数据包
+            self.tasks_lock = threading.Lock()
+            self.pending: set[HTcpSocket] = set()  # 需要I/O线程重新检查的连接
+            self.pending_lock = threading.Lock()
+            self.waker_r, self.waker_w = socket.socketpair()
+            self.loop_thread: Optional[int] = None
             self.running = False
-
-        def start(self, addr, backlog=10):
+            self.selector: Optional[selectors.BaseSelector] = None
+            self.stopped = threading.Event()
+            self.wheel = TimerWheel()
+            self.new_timers: list[Timer] = []  # 其他线程中创建, 等待I/O线程加入时间轮的定时器
+            self.idle_timers: dict[HTcpSocket, Timer] = {}  # 各连接下一次检查空闲的定时器
+            self.activity: dict[HTcpSocket, float] = {}  # 各连接最后一次收到数据的时刻
+            self.pinged: dict[HTcpSocket, float] = {}  # 各连接最后一次发送心跳的时刻
+            self.queued: dict[HTcpSocket, int] = {}  # 各连接上次检查时发送队列中的字节数(不为0的)
+            self.queued_total = 0
+            self.accept_paused = False
+            self.throttle_timers: dict[HTcpSocket, Timer] = {}  # 因限速(DELAY)暂停读取的连接 -> 恢复读取的定时器
+            self.deferred: dict[HTcpSocket, deque[tuple[Message, float]]] = {}  # 因限速推迟的(数据包, 可以处理的时刻)
+            self.eof: set[HTcpSocket] = set()  # 对端已关闭, 处理完推迟的数据包后再关闭的连接
+
+        def start(self, addr, backlog=128):
+            if self.hserver._reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_socket.bind(addr)
             self.server_socket.setblocking(False)
             self.server_socket.listen(backlog)
 
             self.selector = selectors.DefaultSelector()
             self.selector.register(self.server_socket, selectors.EVENT_READ, self.callback_accept)
+            self.waker_r.setblocking(False)
+            self.waker_w.setblocking(False)
+            self.selector.register(self.waker_r, selectors.EVENT_READ, self.callback_wakeup)
+            self.loop_thread = threading.get_ident()
+            self.add_new_timers()
 
             print("server start at {}".format(addr))
             self.running = True
             self.run()
 
         def run(self):
-            while self.running:
-                events = self.selector.select()
-                for key, mask in events:
-                    callback = key.data
-                    callback(key.fileobj)
+            try:
+                while self.running:
+                    events = self.selector.select(self.wheel.timeout())
+                    for key, mask in events:
+                        if not self.running:
+                            break
+                        callback = key.data
+                        callback(key.fileobj, mask)
+                    if self.running and len(self.wheel):
+                        self.wheel.advance()
+            finally:
+                self.close()
 
         def stop(self):
+            """停止事件循环; 在其他线程中调用时唤醒I/O线程, 由其关闭全部套接字"""
             self.running = False
-            fobj_list = []
-            for fd, key in self.selector.get_map().items():
-                fobj_list.append(key.fileobj)
-            for fobj in fobj_list:
-                self.selector.unregister(fobj)
-                fobj.close()
-            self.selector.close()
-
-        def callback_accept(self, server_socket: HTcpSocket):
-            conn, addr = server_socket.accept()
-            print("connected: {}".format(addr))
-            conn.setblocking(False)
-            self.msgs[conn] = None
-            self.selector.register(conn, selectors.EVENT_READ, self.callback_read)
-            self.hserver._onConnected(conn, addr)
+            if self.loop_thread is None or threading.get_ident() == self.loop_thread:
+                if self.loop_thread is None:
+                    self.close()
+                return
+            try:
+                self.waker_w.send(b"\0")
+            except OSError:  # 已经关闭
+                return
+            self.stopped.wait(5)
+
+        def close(self):
+            self.server_socket.close()  # 暂停接受连接时不在selector中
+            if self.selector is None:  # 未启动
+                self.waker_r.close()
+            else:
+                fobj_list = []
+                for fd, key in self.selector.get_map().items():
+                    fobj_list.append(key.fileobj)
+                for fobj in fobj_list:
+                    self.selector.unregister(fobj)
+                    fobj.close()
+                self.selector.close()
+            self.waker_w.close()
+            self.stopped.set()
+
+        def callback_accept(self, server_socket: HTcpSocket, mask):
+            """一次唤醒中接受监听队列中的全部连接(最多backlog个, 以免长时间占用I/O线程)"""
+            if self.hserver._shouldPauseAccept(self.queued_total):
+                self.pause_accept()
+                return
+            for i in range(max(self.hserver._backlog, 1)):
+                try:
+                    conn, addr = server_socket.accept()
+                except (BlockingIOError, InterruptedError):  # 已接受完
+                    return
+                except OSError as e:  # 如EMFILE, 连接仍留在监听队列中, 稍后再试
+                    print(e)
+                    self.pause_accept()
+                    return
+                stale = self.selector.get_map().get(conn.fileno())
+                if stale is not None:  # 在工作线程中关闭的连接尚未被移除, 其文件描述符已被新连接复用
+                    print("connection closed (worker): {}".format(self.conns.get(stale.fileobj)))
+                    self.remove(stale.fileobj)
+                if not self.hserver._admit(conn, addr):
+                    conn.close()
+                    continue
+                print("connected: {}".format(addr))
+                conn.setblocking(False)
+                conn.setSendQueue(SendQueue(conn, self.on_send_pending))
+                self.conns[conn] = addr
+                self.selector.register(conn, selectors.EVENT_READ, self.callback_io)
+                self.watch_idle(conn)
+                self.hserver._onConnected(conn, addr)
+
+        def pause_accept(self):
+            """暂停接受连接, 新连接留在监听队列中, 之后定时检查是否恢复"""
+            if self.accept_paused:
+                return
+            self.accept_paused = True
+            self.selector.unregister(self.server_socket)
+            print("accept paused")
+            self.wheel.schedule(0.1, self.resume_accept)
+
+        def resume_accept(self):
+            if not self.running or not self.accept_paused:
+                return
+            if self.hserver._shouldPauseAccept(self.queued_total):
+                self.wheel.schedule(0.1, self.resume_accept)
+                return
+            self.accept_paused = False
+            self.selector.register(self.server_socket, selectors.EVENT_READ, self.callback_accept)
+            print("accept resumed")
 
-        def callback_read(self, conn: HTcpSocket):
+        def callback_io(self, conn: HTcpSocket, mask):
             if not conn.isValid():
                 # 主动关闭连接后会进入以下代码段
                 print("not a socket")
                 self.remove(conn)
                 return
-            addr = conn.getpeername()
+            addr = self.conns[conn]
+            if mask & selectors.EVENT_WRITE:
+                if not self.callback_write(conn, addr):
+                    return
+            if mask & selectors.EVENT_READ:
+                if not self.callback_read(conn, addr):
+                    return
+            self.update(conn)
+
+        def callback_read(self, conn: HTcpSocket, addr) -> bool:
+            profiler = self.hserver.profiler()
+            if profiler is not None and profiler.sample():
+                with profiler.span("read", fd=conn.fileno()):
+                    return self.read(conn, addr)
+            return self.read(conn, addr)
+
+        def read(self, conn: HTcpSocket, addr) -> bool:
+            if conn in self.activity:
+                self.activity[conn] = time.monotonic()
             try:
-                msg = conn.recvMsg()  # receive msg
+                msgs, closed = conn.recvMsgs()  # receive all available msgs
             except ConnectionResetError:
                 print("connection reset: {}".format(addr))
-                msg = None
-            if msg and msg.isValid():
-                self.msgs[conn] = msg
-                self.selector.modify(conn, selectors.EVENT_WRITE, self.callback_write)
-            else:  # empty msg or error
+                self.hserver._countError("conn_reset")
+                msgs, closed = [], True
+            except ValueError as e:  # 无法解码的数据包, 只关闭该连接
+                print("decode error from {}: {}".format(addr, e))
+                self.hserver._countError("decode")
+                msgs, closed = [], True
+            limiter = self.hserver._limiter(conn)
+            if limiter is not None and msgs:  # 按限速逐个放行, 未到时刻的数据包推迟到throttled()安排的定时器中处理
+                self.deferred.setdefault(conn, deque()).extend((msg, limiter.releaseAt()) for msg in msgs)
+                self.dispatch_deferred(conn)
+            else:
+                for msg in msgs:  # 解码后立即分发
+                    if not conn.isValid():  # may be disconnected in messageHandle
+                        break
+                    if msg.isValid():
+                        self.dispatch(conn, msg)
+            if closed and conn in self.deferred and conn.isValid():  # 推迟的数据包处理完后再关闭
+                self.eof.add(conn)
+                return True
+            return self.check_closed(conn, addr, closed)
+
+        def check_closed(self, conn: HTcpSocket, addr, closed: bool) -> bool:
+            """连接已被主动关闭或对端已关闭时移除该连接并返回False"""
+            if not conn.isValid():
+                # 主动关闭连接后会进入以下代码段
+                print("connection closed (read): {}".format(addr))
                 self.remove(conn)
+                return False
+            if closed:  # empty msg or error
                 print("connection closed (read): {}".format(addr))
-                self.hserver._onDisconnected(conn, addr)  # disconnect callback
+                self.remove(conn)
+                conn.close()
+                return False
+            return True
+
+        def dispatch_deferred(self, conn: HTcpSocket):
+            """按顺序分发conn推迟的数据包, 直到遇到还未到处理时刻的数据包"""
+            backlog = self.deferred.get(conn)
+            while backlog:
+                if not conn.isValid():  # may be disconnected in messageHandle
+                    return
+                msg, release = backlog[0]
+                if release > time.monotonic():
+                    return
+                backlog.popleft()
+                if msg.isValid():
+                    self.dispatch(conn, msg)
+            self.deferred.pop(conn, None)
+
+        def callback_write(self, conn: HTcpSocket, addr) -> bool:
+            try:
+                conn.sendQueue().flush()
+                self.hserver._onSendDrained(conn)
+            except OSError:
+                print("connection reset: {}".format(addr))
+                self.hserver._countError("conn_reset")
+                self.remove(conn)
+                conn.close()
+                return False
+            return True
 
-        def callback_write(self, conn: HTcpSocket):
-            addr = conn.getpeername()
-            msg = self.msgs[conn]
-            if msg:
-                self.hserver._onMessageReceived(conn, msg)
-                self.msgs[conn] = None
-            if conn.isValid():  # may be disconnected in messageHandle
-                self.selector.modify(conn, selectors.EVENT_READ, self.callback_read)
+        def callback_wakeup(self, waker: socket.socket, mask):
+            try:
+                while waker.recv(1024):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
+            with self.pending_lock:
+                pending = self.pending
+                self.pending = set()
+            self.add_new_timers()
+            for conn in pending:
+                if conn not in self.conns:
+                    continue
+                if conn.isValid():
+                    self.update(conn)
+                else:
+                    # 在工作线程中主动关闭连接后会进入以下代码段
+                    print("connection closed (worker): {}".format(self.conns[conn]))
+                    self.remove(conn)
+
+        def notify(self, conn: HTcpSocket):
+            """从其他线程请求I/O线程重新检查conn"""
+            with self.pending_lock:
+                self.pending.add(conn)
+            self.wakeup()
+
+        def wakeup(self):
+            try:
+                self.waker_w.send(b"\0")
+            except (BlockingIOError, InterruptedError):  # 唤醒数据未读, I/O线程已经会被唤醒
+                pass
+            except OSError:  # server已关闭
+                pass
+
+        def on_send_pending(self, conn: HTcpSocket):
+            if threading.get_ident() == self.loop_thread:
+                self.update(conn)
             else:
-                # 主动关闭连接后会进入以下代码段
-                self.remove(conn)
-                print("connection closed (write): {}".format(addr))
-        
+                self.notify(conn)
+
+        def dispatch(self, conn: HTcpSocket, msg: Message):
+            """分发一个数据包
+
+            设置了线程池时, 标记为pooled的操作码在线程池中执行。
+            同一连接已有数据包在线程池中排队时, 之后的数据包都排在其后, 以保证处理顺序。
+            """
+            executor = self.hserver.worker_pool()
+            if executor is not None:
+                with self.tasks_lock:
+                    tasks = self.tasks.get(conn)
+                    if tasks is not None:
+                        tasks.append(msg)
+                        return
+                    if self.hserver._isPooledOpCode(msg.opcode()):
+                        self.tasks[conn] = deque((msg,))
+                        executor.submit(self.run_tasks, conn)
+                        return
+            try:
+                self.hserver._onMessageReceived(conn, msg)
+            except Exception:  # 回调中的异常只影响该数据包, 不能中断I/O线程
+                traceback.print_exc()
+            finally:
+                self.hserver._onMessageDone(conn)  # 之后的update()会检查是否恢复读取
+
+        def run_tasks(self, conn: HTcpSocket):
+            """在工作线程中依次处理一个连接排队的数据包"""
+            while True:
+                with self.tasks_lock:
+                    tasks = self.tasks[conn]
+                    if not tasks or not conn.isValid():
+                        del self.tasks[conn]
+                        break
+                    msg = tasks.popleft()
+                try:
+                    profiler = self.hserver.profiler()
+                    if profiler is not None and profiler.sample():
+                        with profiler.span("task", fd=conn.fileno()):
+                            self.hserver._onMessageReceived(conn, msg)
+                    else:
+                        self.hserver._onMessageReceived(conn, msg)
+                except Exception:
+                    traceback.print_exc()
+                if self.hserver._onMessageDone(conn):  # 因处理中的数据包过多而暂停的读取可以恢复了
+                    self.notify(conn)
+            if not conn.isValid():  # may be disconnected in messageHandle
+                self.notify(conn)
+
+        def update(self, conn: HTcpSocket):
+            """根据待处理的数据包、发送队列和限速重新计算关注的事件
+
+            发送队列超过高水位时暂停读取, 回落到高水位的一半以下后恢复。
+            """
+            if conn not in self.conns or not conn.isValid():
+                return
+            queued = conn.sendQueue().size()
+            last = self.queued.get(conn, 0)
+            if queued != last:
+                self.queued_total += queued - last
+                if queued:
+                    self.queued[conn] = queued
+                else:
+                    del self.queued[conn]
+            high_water = self.hserver.send_high_water()
+            if conn in self.paused:
+                if queued <= high_water // 2:
+                    self.paused.discard(conn)
+            elif queued > high_water:
+                self.paused.add(conn)
+            events = 0 if conn in self.paused or self.throttled(conn) else selectors.EVENT_READ
+            if queued or conn.sendQueue().error() is not None:  # 发送失败的连接由callback_write关闭
+                events |= selectors.EVENT_WRITE
+            if self.selector.get_key(conn).events != events:
+                self.selector.modify(conn, events, self.callback_io)
+
         def remove(self, conn: HTcpSocket):
+            """移除一个连接并清理其状态, 包括server中该连接的状态(_onDisconnected, 已处理过时不会重复调用)"""
             self.selector.unregister(conn)
-            del self.msgs[conn]
+            addr = self.conns.pop(conn)
+            self.paused.discard(conn)
+            timer = self.idle_timers.pop(conn, None)
+            if timer is not None:
+                self.wheel.cancel(timer)
+            self.activity.pop(conn, None)
+            self.pinged.pop(conn, None)
+            self.queued_total -= self.queued.pop(conn, 0)
+            timer = self.throttle_timers.pop(conn, None)
+            if timer is not None:
+                self.wheel.cancel(timer)
+            self.deferred.pop(conn, None)
+            self.eof.discard(conn)
+            self.hserver._onDisconnected(conn, addr)  # disconnect callback
+
+        def throttled(self, conn: HTcpSocket) -> bool:
+            """是否因限速或处理中的数据包过多(DELAY)而暂停读取conn, 需要时安排恢复读取的定时器"""
+            limiter = self.hserver._limiter(conn)
+            if limiter is None:
+                return False
+            if limiter.held():  # 处理完数据包的工作线程会通知恢复
+                return True
+            backlog = self.deferred.get(conn)
+            if backlog:  # 有推迟的数据包时不再读取, 由定时器处理完后恢复
+                wait = max(backlog[0][1] - time.monotonic(), 0.0)
+            else:
+                wait = limiter.resumeAt() - time.monotonic()
+                if wait <= 0:
+                    return False
+            if conn not in self.throttle_timers:
+                self.throttle_timers[conn] = self.wheel.schedule(wait, self.resume_read, conn)
+            return True
+
+        def resume_read(self, conn: HTcpSocket):
+            self.throttle_timers.pop(conn, None)
+            if conn not in self.conns:
+                return
+            self.dispatch_deferred(conn)
+            if not self.check_closed(conn, self.conns[conn], conn in self.eof and conn not in self.deferred):
+                return
+            self.update(conn)
+
+        def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+            timer = Timer(time.monotonic() + delay, callback, *args)
+            if threading.get_ident() == self.loop_thread:
+                self.wheel.add(timer)
+            else:
+                with self.pending_lock:
+                    self.new_timers.append(timer)
+                self.wakeup()
+            return timer
+
+        def add_new_timers(self):
+            with self.pending_lock:
+                timers = self.new_timers
+                self.new_timers = []
+            for timer in timers:
+                self.wheel.add(timer)
+
+        def watch_idle(self, conn: HTcpSocket):
+            """设置了空闲超时或心跳时, 为新连接安排空闲检查"""
+            delays = [delay for delay in (self.hserver.idle_timeout(), self.hserver.heartbeat_interval()) if delay]
+            if not delays:
+                return
+            self.activity[conn] = time.monotonic()
+            self.idle_timers[conn] = self.wheel.schedule(min(delays), self.check_idle, conn)
+
+        def check_idle(self, conn: HTcpSocket):
+            """关闭空闲超时的连接, 向空闲达到心跳间隔的连接发送ping, 并安排下一次检查"""
+            self.idle_timers.pop(conn, None)
+            if conn not in self.conns or not conn.isValid():
+                return
+            idle_timeout = self.hserver.idle_timeout()
+            interval = self.hserver.heartbeat_interval()
+            now = time.monotonic()
+            last = self.activity.get(conn, now)
+            if idle_timeout and now - last >= idle_timeout:
+                addr = self.conns[conn]
+                print("connection idle timeout: {}".format(addr))
+                self.hserver._countError("idle_timeout")
+                self.remove(conn)
+                conn.close()
+                return
+            deadlines = []
+            if idle_timeout:
+                deadlines.append(last + idle_timeout)
+            if interval:
+                pinged = max(last, self.pinged.get(conn, last))
+                if now - pinged >= interval:
+                    try:
+                        conn.sendMsg(Message.HeaderOnlyMsg(BuiltInOpCode.HEARTBEAT, 0))
+                    except OSError:  # 连接已断开, 由读事件处理
+                        pass
+                    self.pinged[conn] = pinged = now
+                deadlines.append(pinged + interval)
+            if deadlines:
+                self.idle_timers[conn] = self.wheel.schedule(max(0.0, min(deadlines) - now), self.check_idle, conn)
 
     def __init__(self, addr):
         super().__init__(addr)
         self.__selector = self.__HServerSelector(self)
+        self.__send_high_water = 4 * 1024 * 1024
+        self.__worker_pool: Optional[ThreadPoolExecutor] = None
+        self.__idle_timeout: Optional[float] = None
+        self.__heartbeat_interval: Optional[float] = None
+        self.__pause_queued_bytes: Optional[int] = None
+        self.__pause_check: Optional[Callable[[], bool]] = None
+
+    def setWorkerPool(self, max_workers: int):
+        """设置执行回调的工作线程池
+
+        只有以 pooled=True 注册的操作码回调会在线程池中执行, 其余回调仍在I/O线程中直接执行。
+        同一连接的数据包始终按接收顺序处理。
+
+        Args:
+            max_workers (int): 最大线程数
+        """
+        if self.__worker_pool is not None:
+            self.__worker_pool.shutdown(wait=False)
+        self.__worker_pool = ThreadPoolExecutor(max_workers, thread_name_prefix="hserver-worker")
+
+    def worker_pool(self) -> Optional[ThreadPoolExecutor]:
+        return self.__worker_pool
+
+    def set_send_high_water(self, size: int):
+        """设置每个连接发送队列的高水位(字节)
+
+        超过高水位后暂停读取该连接的数据, 直到队列回落到高水位的一半以下。
+        """
+        self.__send_high_water = size
+
+    def send_high_water(self) -> int:
+        return self.__send_high_water
+
+    def set_idle_timeout(self, sec: Optional[float]):
+        """设置空闲超时, 超过sec秒没有收到任何数据的连接会被关闭(触发 onDisconnected), 为None时不限制
+
+        与set_heartbeat()一样, 对之后建立的连接生效。
+        """
+        self.__idle_timeout = sec
+
+    def idle_timeout(self) -> Optional[float]:
+        return self.__idle_timeout
+
+    def set_heartbeat(self, interval: Optional[float]):
+        """设置心跳间隔, 连接空闲interval秒后server发送 BuiltInOpCode.HEARTBEAT ping, 为None时不发送
+
+        client回复的pong会刷新空闲时间, 配合set_idle_timeout()可以及时发现已经失效的连接。
+        HTcpChannelClient、HTcpAsyncClient和流水线模式的HTcpReqResClient会自动回复pong;
+        一问一答模式的HTcpReqResClient只在request()等待回复期间、HTcpClientPool借出连接时和调用answerHeartbeats()时回复,
+        其间没有回复的连接仍会因set_idle_timeout()被关闭。
+        """
+        self.__heartbeat_interval = interval
+
+    def heartbeat_interval(self) -> Optional[float]:
+        return self.__heartbeat_interval
+
+    def set_accept_pause(self, queued_bytes: Optional[int] = None, check: Optional[Callable[[], bool]] = None):
+        """设置暂停接受新连接的条件, 暂停期间新连接留在监听队列中, 每0.1秒检查一次是否恢复
+
+        Args:
+            queued_bytes (Optional[int]): 全部连接的发送队列中待发送的字节数超过该值时暂停
+            check (Optional[Callable[[], bool]]): 在I/O线程中调用, 返回True时暂停(如检查内存占用)
+        """
+        self.__pause_queued_bytes = queued_bytes
+        self.__pause_check = check
+
+    def _shouldPauseAccept(self, queued_total: int) -> bool:
+        if self.__pause_queued_bytes is not None and queued_total > self.__pause_queued_bytes:
+            return True
+        return self.__pause_check is not None and self.__pause_check()
+
+    def callLater(self, delay: float, callback: Callable, *args) -> Timer:
+        """delay秒后在I/O线程中执行callback(*args), 可以在任意线程中调用
+
+        定时由时间轮驱动, 精度约为50毫秒。回调不应阻塞。
+
+        Returns:
+            Timer: 可以调用其cancel()取消
+        """
+        return self.__selector.call_later(delay, callback, *args)
 
     def startserver(self):
-        self.__selector.start(self._address)
+        self.__selector.start(self._address, self._backlog)
+
+    def _prepareworker(self):
+        self.__selector = self.__HServerSelector(self)
 
     def closeserver(self):
+        if self._closeworkers():
+            return
         self.__selector.stop()
+        if self.__worker_pool is not None:
+            self.__worker_pool.shutdown(wait=False)
 
     def closeconn(self, conn: HTcpSocket):
         """主动关闭一个连接
@@ -266,6 +1284,7 @@ class HTcpSelectorServer(__HTcpServer):
         """
         addr = conn.getpeername()
         conn.close()
+        self.__selector.notify(conn)  # 在其他线程中关闭时, 由I/O线程移除该连接
         self._onDisconnected(conn, addr)
 
 
@@ -285,21 +1304,46 @@ class HTcpThreadingServer(__HTcpServer):
             self.server.hserver._onConnected(self.request, self.client_address)
 
         def handle(self):
+            hserver = self.server.hserver
+            while True:
+                profiler = hserver.profiler()
+                if profiler is not None and profiler.sample():
+                    with profiler.span("read"):
+                        if not self.handle_one():
+                            break
+                elif not self.handle_one():
+                    break
+
+        def handle_one(self) -> bool:
+            """接收并处理一个数据包, 连接断开时返回False"""
             conn = self.request
             addr = self.client_address
-            while True:
+            try:
+                msg = conn.recvMsg()  # receive msg
+            except ConnectionResetError:
+                print("connection reset: {}".format(addr))
+                self.server.hserver._countError("conn_reset")
+                return False
+            except ValueError as e:  # 无法解码的数据包
+                print("decode error from {}: {}".format(addr, e))
+                self.server.hserver._countError("decode")
+                return False
+            except OSError:  # socket is closed
+                print("socket is closed")
+                return False
+            if msg and msg.isValid():
+                hserver = self.server.hserver
                 try:
-                    msg = conn.recvMsg()  # receive msg
-                except ConnectionResetError:
-                    print("connection reset: {}".format(addr))
-                    msg = None
-                except OSError:  # socket is closed
-                    print("socket is closed")
-                    return 
-                if msg and msg.isValid():
-                    self.server.hserver._onMessageReceived(conn, msg)
-                else:  # empty msg or error
-                    break
+                    hserver._onMessageReceived(conn, msg)
+                finally:
+                    hserver._onMessageDone(conn)
+                limiter = hserver._limiter(conn)
+                if limiter is not None:  # 超出限速(DELAY)时暂停读取, 由TCP流控使对端减速
+                    wait = limiter.resumeAt() - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                return True
+            return False  # empty msg or error
 
         def finish(self):
             print("connection closed: {}".format(self.client_address))
@@ -314,11 +1358,21 @@ class HTcpThreadingServer(__HTcpServer):
         def get_request(self):
             return self.socket.accept()
 
+        def verify_request(self, request: HTcpSocket, client_address) -> bool:
+            return self.hserver._admit(request, client_address)
+
+        def shutdown_request(self, request: HTcpSocket):
+            """每个被接受的连接最终都会经过这里, 包括处理线程启动失败或setup()出错时"""
+            self.hserver._releaseSlot(request)
+            super().shutdown_request(request)
+
     def __init__(self, server_address):
         super().__init__(server_address)
         self.__server = self.__HThreadingTCPServer(self, server_address, self.__HRequestHandler)
 
     def startserver(self):
+        self.__server.allow_reuse_port = self._reuse_port
+        self.__server.request_queue_size = self._backlog
         try:
             self.__server.server_bind()
             self.__server.server_activate()
@@ -328,7 +1382,12 @@ class HTcpThreadingServer(__HTcpServer):
         print("server start at {}".format(self.__server.server_address))
         self.__server.serve_forever()
 
+    def _prepareworker(self):
+        self.__server = self.__HThreadingTCPServer(self, self._address, self.__HRequestHandler)
+
     def closeserver(self):
+        if self._closeworkers():
+            return
         self.__server.shutdown()
 
     def closeconn(self, conn: HTcpSocket):
@@ -1,15 +1,197 @@
 # -*- coding: utf-8 -*-
-from typing import Optional, Union, BinaryIO
+from typing import Optional, Union, BinaryIO, Callable, Iterable
+from collections import deque
+import itertools
+import threading
+import copy
 import socket
 import os
+import io
+import stat
+import mmap
+import struct
+import time
 from .message import *
+from .metrics import Metrics
+from .profiler import Profiler
 
 
 class SocketConfig:
-    RECV_BUFFER_SIZE = 1024
-    FILE_BUFFER_SIZE = 2048
+    RECV_BUFFER_SIZE = 65536
+    FILE_BUFFER_SIZE = 262144
     DEFAULT_DOWNLOAD_PATH = "download/"
     FILENAME_ENCODING = "utf-8"
+    IOV_MAX = 1024  # 一次sendmsg调用最多传入的缓冲区数
+    PART_SYNC_SIZE = 4194304  # 接收文件时每写入这么多字节更新一次.part.have中记录的已接收字节数
+
+
+class FileHeaderFlag(IntFlag):
+    RESUME = 0x1  # 接收方先回报已有的字节数(8字节), 发送方从该位置续传
+    CODEC = 0x70  # 文件内容的压缩算法编号, 非0时内容以(4字节长度 + 数据块)的形式分块发送
+
+
+_FILE_HEADER_MAGIC = b"\0HF2"
+_FILE_HEADER_V2 = struct.Struct("<4sQQBH")  # 标识, 文件大小, 起始偏移, 标志, 文件名长度; 之后是文件名
+_CHUNK_STORED = 0x80000000  # 压缩传输中, 数据块长度的最高位表示该块未压缩
+_UNSOLICITED_OPCODES = frozenset((  # 不是对请求的回复的控制帧, 对端按操作码处理, 不附带回复ID
+    BuiltInOpCode.FT_TRANSFER_PORT, BuiltInOpCode.FT_STREAM_BEGIN, BuiltInOpCode.FT_STREAM_DATA,
+    BuiltInOpCode.FT_STREAM_END,
+))
+
+
+def preallocate(fileno: int, size: int):
+    """按文件大小预先分配磁盘空间"""
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fileno, 0, size)
+            return
+        except OSError:  # 文件系统不支持
+            pass
+    os.ftruncate(fileno, size)
+
+
+def _consume(views: deque[memoryview], sent: int):
+    """从views头部移除已发送的sent字节"""
+    while sent:
+        view = views[0]
+        if sent < len(view):
+            views[0] = view[sent:]
+            return
+        sent -= len(view)
+        views.popleft()
+
+
+def _sendSome(sock: socket.socket, views: deque[memoryview]) -> int:
+    """以一次系统调用发送views头部的若干缓冲区并将其移除, 返回发送的字节数
+
+    平台支持时使用sendmsg(writev), 否则只发送第一个缓冲区。
+    """
+    if hasattr(sock, "sendmsg"):
+        sent = sock.sendmsg(list(itertools.islice(views, SocketConfig.IOV_MAX)))
+    else:
+        sent = sock.send(views[0])
+    _consume(views, sent)
+    return sent
+
+
+def sendmsgAll(sock: socket.socket, buffers: Iterable[Union[bytes, bytearray, memoryview]]):
+    """阻塞地发送多个缓冲区, 效果等同于对其拼接结果调用sendall, 但不做拼接
+
+    Raises:
+        OSError: 套接字异常时抛出。
+    """
+    views = deque(view for view in map(memoryview, buffers) if len(view))
+    while views:
+        _sendSome(sock, views)
+
+
+class SendQueue:
+    """非阻塞套接字的发送队列
+
+    数据先尝试直接写入内核缓冲区, 写不下的部分按顺序暂存, 等套接字可写时由flush()继续发送。
+    可以在多个线程中同时使用。
+
+    put()中发生的套接字异常(如对端已关闭)不会抛给调用者, 而是记录下来并丢弃待发送的数据,
+    之后的put()直接丢弃数据, flush()抛出该异常, 由I/O线程关闭该连接。
+    """
+
+    def __init__(self, sock: socket.socket, on_pending: Optional[Callable[[socket.socket], None]] = None):
+        """
+        Args:
+            sock (socket.socket): 非阻塞套接字
+            on_pending (Callable[[socket.socket], None]): 队列中出现待发送数据时调用, 用于注册可写事件
+        """
+        self.__sock = sock
+        self.__on_pending = on_pending
+        self.__buffers: deque[memoryview] = deque()
+        self.__size = 0
+        self.__error: Optional[OSError] = None
+        self.__lock = threading.Lock()
+        self.__drained = threading.Condition(self.__lock)
+
+    def size(self) -> int:
+        """队列中待发送的字节数"""
+        return self.__size
+
+    def error(self) -> Optional[OSError]:
+        """发送时发生的套接字异常, 为None时队列正常"""
+        return self.__error
+
+    def waitBelow(self, size: int, timeout: Optional[float] = None) -> bool:
+        """等待队列中待发送的字节数不超过size, 用于生产者端的流量控制
+
+        Returns:
+            bool: 超时返回False
+        """
+        with self.__drained:
+            return self.__drained.wait_for(lambda: self.__size <= size, timeout)
+
+    def put(self, *buffers: Union[bytes, bytearray, memoryview]):
+        """按顺序发送一个或多个缓冲区(以sendmsg一并交给内核), 内核缓冲区已满时剩余部分放入队列
+
+        套接字异常不会抛出, 见类的说明。
+        """
+        views = deque(view for view in map(memoryview, buffers) if len(view))
+        with self.__lock:
+            if self.__error is not None:  # 连接已失效, 等待I/O线程关闭
+                return
+            if self.__buffers:  # 前面还有数据未发送, 直接排队以保证顺序
+                self.__extend(views)
+                return
+            self.__write(views)
+            if self.__error is None:
+                if not views:
+                    return
+                self.__extend(views)
+        if self.__on_pending is not None:  # 有数据待发送或发生了异常, 都需要I/O线程处理
+            self.__on_pending(self.__sock)
+
+    def flush(self) -> bool:
+        """在套接字可写时调用, 尽可能多地发送队列中的数据
+
+        Raises:
+            OSError: 套接字异常时抛出。
+
+        Returns:
+            bool: 队列是否已清空
+        """
+        with self.__lock:
+            try:
+                sent = self.__write(self.__buffers) if self.__error is None else 0
+                if self.__error is not None:
+                    raise self.__error
+                self.__size -= sent
+                return not self.__buffers
+            finally:
+                self.__drained.notify_all()
+
+    def __write(self, views: deque[memoryview]) -> int:
+        """发送views中的数据直到发完或内核缓冲区已满, 返回发送的字节数
+
+        发生套接字异常时记录到self.__error, 并清空views和队列。
+        """
+        total = 0
+        while views:
+            expected = sum(len(view) for view in itertools.islice(views, SocketConfig.IOV_MAX))
+            try:
+                sent = _sendSome(self.__sock, views)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.__error = e
+                views.clear()
+                self.__buffers.clear()
+                self.__size = 0
+                self.__drained.notify_all()
+                break
+            total += sent
+            if sent < expected:  # 内核缓冲区已满
+                break
+        return total
+
+    def __extend(self, views: deque[memoryview]):
+        self.__buffers.extend(views)
+        self.__size += sum(len(view) for view in views)
 
 
 class _HSocket(socket.socket):
@@ -23,6 +205,14 @@ class _HSocket(socket.socket):
 class HTcpSocket(_HSocket):
     def __init__(self, family=socket.AF_INET, fileno=None):
         super().__init__(family, socket.SOCK_STREAM, fileno=fileno)
+        self.__decoder = MessageDecoder()
+        self.__recv_buf: Optional[memoryview] = None
+        self.__send_queue: Optional[SendQueue] = None
+        self.__send_lock = threading.Lock()
+        self.__reply_ids: dict[int, int] = {}  # 线程ID -> 该线程正在处理的请求的ID
+        self.__codec = Codec.NONE  # 协商得到的压缩算法
+        self.__metrics: Optional[Metrics] = None
+        self.__profiler: Optional[Profiler] = None
 
     def accept(self) -> tuple["HTcpSocket", tuple[str, int]]:
         # Paraphrased from socket.socket.accept()
@@ -32,103 +222,576 @@ class HTcpSocket(_HSocket):
             sock.setblocking(True)
         return sock, addr
 
+    def setSendQueue(self, queue: Optional[SendQueue]):
+        """设置发送队列, 之后sendMsg将经由该队列发送"""
+        self.__send_queue = queue
+
+    def sendQueue(self) -> Optional[SendQueue]:
+        return self.__send_queue
+
+    def setCompression(self, codec: int):
+        """设置发送时使用的压缩算法(需与对端协商), Codec.NONE为不压缩
+
+        只有正文不小于 MessageConfig.COMPRESS_THRESHOLD 的数据包会被压缩, 接收时总是自动解压。
+        """
+        self.__codec = codec
+
+    def compression(self) -> int:
+        return self.__codec
+
+    def setMetrics(self, metrics: Optional[Metrics]):
+        """设置记录收发数据包数、字节数和文件传输的指标注册表, 为None时不记录"""
+        self.__metrics = metrics
+
+    def metrics(self) -> Optional[Metrics]:
+        return self.__metrics
+
+    def setProfiler(self, profiler: Optional[Profiler]):
+        """设置剖析器, 在其选中的操作内记录recv/decode/encode/send区间"""
+        self.__profiler = profiler
+
+    def setHeaderFilter(self, header_filter: Optional[Callable[[Header], bool]]):
+        """设置接收时的报头过滤器, 返回False的数据包被跳过, 其正文不会被保存或解码, 为None时不过滤"""
+        self.__decoder.setHeaderFilter(header_filter)
+
+    def setReplyId(self, requestid: Optional[int]):
+        """设置当前线程正在处理的请求ID
+
+        之后当前线程经由该套接字发送的不带请求ID的数据包都会附带这个ID(文件传输的控制帧除外), 为None时取消。
+        """
+        if requestid is None:
+            self.__reply_ids.pop(threading.get_ident(), None)
+        else:
+            self.__reply_ids[threading.get_ident()] = requestid
+
     def sendMsg(self, msg: Message):
         """发送一个数据包
 
+        报头和正文以sendmsg一并发送, 不做拼接。设置了发送队列时不会阻塞, 未能立即发送的数据留在队列中。
+
+        Raises:
+            OSError: 套接字异常时抛出。
+        """
+        profiler = self.__profiler
+        if profiler is not None and profiler.tracing():
+            with profiler.span("encode", opcode=msg.opcode()):
+                buffers = self.__toBuffers(msg)
+        else:
+            buffers = self.__toBuffers(msg)
+        self.sendBuffers(buffers)
+
+    def sendMsgs(self, msgs: Iterable[Message]):
+        """发送多个数据包, 尽可能以一次系统调用发出
+
         Raises:
             OSError: 套接字异常时抛出。
         """
-        self.sendall(msg.toBytes())
+        buffers = []
+        count = 0
+        for msg in msgs:
+            buffers.extend(self.__toBuffers(msg))
+            count += 1
+        self.sendBuffers(buffers, count)
+
+    def __toBuffers(self, msg: Message) -> list[Union[bytes, bytearray, memoryview]]:
+        if self.__reply_ids and msg.requestid() is None and msg.opcode() not in _UNSOLICITED_OPCODES:
+            requestid = self.__reply_ids.get(threading.get_ident())
+            if requestid is not None:  # 回复时带上请求ID
+                msg = copy.copy(msg)
+                msg.setRequestId(requestid)
+        return msg.toBuffers(self.__codec)
+
+    def sendBuffers(self, buffers: list[Union[bytes, bytearray, memoryview]], msg_count: int = 1):
+        """发送已编码的数据(如Message.toBuffers()的结果), 不附加请求ID也不压缩
+
+        Raises:
+            OSError: 套接字异常时抛出。
+
+        Args:
+            buffers (list): 已编码的数据
+            msg_count (int): buffers中的数据包数, 仅用于统计
+        """
+        profiler = self.__profiler
+        if profiler is not None and profiler.tracing():
+            with profiler.span("send", msgs=msg_count):
+                self.__send(buffers)
+        else:
+            self.__send(buffers)
+        metrics = self.__metrics
+        if metrics is not None:
+            metrics.inc("msgs_out", msg_count)
+            metrics.inc("bytes_out", sum(map(len, buffers)))
+
+    def __send(self, buffers: list[Union[bytes, bytearray, memoryview]]):
+        if self.__send_queue is not None:
+            self.__send_queue.put(*buffers)
+        else:
+            with self.__send_lock:
+                sendmsgAll(self, buffers)
 
     def recvMsg(self) -> Message:
         """尝试接收一个数据包
 
+        数据直接读入解码器预分配的缓冲区, 超时中断后再次调用会从断点继续接收。
+
         Raises:
             TimeoutError: 阻塞模式下等待超时时抛出。
             OSError: 套接字异常时抛出。
+            ValueError: 数据包正文无法解压(数据损坏、未知的压缩算法或解压后过大)时抛出, 之后应关闭连接。
 
         Returns:
             Message: 收到空报文时返回空Message
         """
-        data = b""
-        header = Header.fromBytes(self.recv(Header.HEADER_LENGTH))
-        if header:
-            size = header.length
-            while len(data) < size:  # 未接收完
-                recv_size = min(size - len(data), SocketConfig.RECV_BUFFER_SIZE)
-                recv_data = self.recv(recv_size)
-                data += recv_data
-            if data:
-                return Message.HeaderContent(header, data.decode(MessageConfig.ENCODING))
-            else:
-                return Message.HeaderContent(header, "")
-        else:
-            return Message()
+        decoder = self.__decoder
+        metrics = self.__metrics
+        recv_into, advance = self.recv_into, decoder.advance
+        profiler = self.__profiler
+        if profiler is not None and profiler.tracing():
+            recv_into, advance = profiler.wrap("recv", recv_into), profiler.wrap("decode", advance)
+        while True:
+            nbytes = recv_into(decoder.buffer())
+            if nbytes == 0:  # 对端关闭
+                decoder.reset()
+                return Message()
+            if metrics is not None:
+                metrics.inc("bytes_in", nbytes)
+            msg = advance(nbytes)
+            if msg is not None:
+                if metrics is not None:
+                    metrics.inc("msgs_in")
+                return msg
+
+    def recvMsgs(self, single: bool = False) -> tuple[list[Message], bool]:
+        """非阻塞模式下接收当前可读的全部数据包
+
+        小数据包经由接收缓冲区批量读取后解码, 剩余正文较大时则直接读入解码器的缓冲区。
+        未接收完的数据包保留在解码器中, 下次调用时继续。
+
+        Args:
+            single (bool): 只调用一次recv, 用于阻塞模式的套接字在select()报告可读之后一次取走已到达的数据
+
+        Raises:
+            OSError: 套接字异常时抛出。
+            ValueError: 数据包正文无法解压时抛出, 之后应关闭连接。
 
-    def sendFile(self, file: BinaryIO, filename: str):
+        Returns:
+            tuple[list[Message], bool]: 完整的数据包列表，对端是否已关闭
+        """
+        decoder = self.__decoder
+        if self.__recv_buf is None:
+            self.__recv_buf = memoryview(bytearray(SocketConfig.RECV_BUFFER_SIZE))
+        recv_buf = self.__recv_buf
+        recv_into, advance, feed = self.recv_into, decoder.advance, decoder.feed
+        profiler = self.__profiler
+        if profiler is not None and profiler.tracing():
+            recv_into = profiler.wrap("recv", recv_into)
+            advance, feed = profiler.wrap("decode", advance), profiler.wrap("decode", feed)
+        msgs = []
+        total = 0
+        try:
+            while True:
+                try:
+                    if decoder.remaining() >= len(recv_buf):  # 大块正文直接读入
+                        buf = decoder.buffer()
+                        nbytes = recv_into(buf)
+                        if nbytes:
+                            msg = advance(nbytes)
+                            if msg is not None:
+                                msgs.append(msg)
+                    else:
+                        buf = recv_buf
+                        nbytes = recv_into(buf)
+                        if nbytes:
+                            msgs.extend(feed(buf[:nbytes]))
+                except (BlockingIOError, InterruptedError):  # 已读空
+                    return msgs, False
+                total += nbytes
+                if nbytes == 0:  # 对端关闭
+                    decoder.reset()
+                    return msgs, True
+                if single or nbytes < len(buf):  # 内核缓冲区已读空, 省去一次返回EAGAIN的调用
+                    return msgs, False
+        finally:
+            if self.__metrics is not None and total:
+                self.__metrics.inc("bytes_in", total)
+                self.__metrics.inc("msgs_in", len(msgs))
+
+    def sendFile(self, file: BinaryIO, filename: str, offset: int = 0, resume: bool = False,
+                 codec: int = Codec.NONE):
         """发送一个文件
 
+        真实文件经由os.sendfile在内核中直接发送, 其他文件对象按块读取后发送。
+        指定codec时按块压缩后发送, 压缩后未变小的块原样发送。
+
         Raises:
             OSError: 套接字异常或文件读取异常时抛出。
 
         Args:
             file (BinaryIO): 可读的文件对象
             filename (str): 文件名
+            offset (int): 从文件的该位置开始发送
+            resume (bool): 先由接收方回报已有的字节数, 从该位置续传
+            codec (int): 压缩算法编号, 需为对端支持的算法
         """
         # get file size
         file.seek(0, os.SEEK_END)
         filesize = file.tell()
         file.seek(0, os.SEEK_SET)
         # file header
-        self.sendall(filename.encode(SocketConfig.FILENAME_ENCODING))  # filename
-        self.sendall(b'\0')  # name end
-        self.sendall(filesize.to_bytes(4, 'little', signed=False))  # filesize
+        flags = FileHeaderFlag.RESUME if resume else 0
+        flags |= (codec << 4) & FileHeaderFlag.CODEC
+        filename_b = filename.encode(SocketConfig.FILENAME_ENCODING)
+        self.sendall(_FILE_HEADER_V2.pack(_FILE_HEADER_MAGIC, filesize, offset, flags, len(filename_b)) + filename_b)
+        start = offset
+        if resume:
+            have_b = self.__recvExactly(8)
+            if have_b is None:
+                raise ConnectionError("connection closed before resume offset was received")
+            start = max(offset, int.from_bytes(have_b, 'little', signed=False))
         # file content
-        while True:
-            data = file.read(SocketConfig.FILE_BUFFER_SIZE)
+        count = filesize - start
+        if count <= 0:
+            return
+        begin = time.perf_counter()
+        try:
+            if codec:
+                self.__sendCompressed(file, start, count, codec)
+            elif self.__canSendfile(file):
+                self.sendfile(file, start, count)
+            else:
+                self.__sendChunks(file, start, count)
+        except OSError:
+            if self.__metrics is not None:
+                self.__metrics.inc("errors.ft")
+            raise
+        if self.__metrics is not None:
+            self.__metrics.transfer("send", count, time.perf_counter() - begin)
+
+    def __sendChunks(self, file: BinaryIO, start: int, count: int):
+        file.seek(start)
+        while count > 0:
+            data = file.read(min(count, SocketConfig.FILE_BUFFER_SIZE))
             if not data:
                 break
             self.sendall(data)
+            count -= len(data)
+
+    def __sendCompressed(self, file: BinaryIO, start: int, count: int, codec: int):
+        file.seek(start)
+        while count > 0:
+            data = file.read(min(count, SocketConfig.FILE_BUFFER_SIZE))
+            if not data:
+                break
+            compressed = Codec.compress(codec, data)
+            if len(compressed) < len(data):
+                sendmsgAll(self, (len(compressed).to_bytes(4, 'little', signed=False), compressed))
+            else:
+                sendmsgAll(self, ((len(data) | _CHUNK_STORED).to_bytes(4, 'little', signed=False), data))
+            count -= len(data)
 
-    def recvFile(self) -> str:
+    def __canSendfile(self, file: BinaryIO) -> bool:
+        """是否可以使用os.sendfile发送该文件"""
+        if not hasattr(os, "sendfile") or self.gettimeout() == 0:
+            return False
+        try:
+            return stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+        except (AttributeError, OSError, io.UnsupportedOperation):  # 不是真实文件
+            return False
+
+    def recvFile(self, sink: Optional["RecvSink"] = None, use_mmap: bool = False) -> str:
         """尝试接收一个文件
 
+        数据交给sink处理, 默认(None)时为 PathSink, 保存到 SocketConfig.DEFAULT_DOWNLOAD_PATH 。
+        sink提供缓冲区时直接接收到缓冲区中, 否则以recv_into读入大块缓冲区后交给sink写入。
+        压缩发送的文件解压后交给sink写入。
+
         Raises:
             TimeoutError: 阻塞模式下等待超时时抛出。
             OSError: 套接字异常或文件写入异常时抛出。
+            ValueError: 报头无法识别或使用了未注册的压缩算法时抛出。
+
+        Args:
+            sink (RecvSink): 数据去向
+            use_mmap (bool): sink为None时, 是否直接接收到文件的内存映射中
 
         Returns:
-            str: 成功接收的文件路径，若接收失败则返回空字符串。
+            str: 成功时返回sink的结果(PathSink为文件路径，其他为文件名)，若接收失败则返回空字符串。
         """
-        # filename
-        filename_b: bytes = b""
+        first = self.recv(1)
+        if not first:  # empty data
+            return ""
+        if first == _FILE_HEADER_MAGIC[:1]:
+            header_b = self.__recvExactly(_FILE_HEADER_V2.size - 1)
+            if header_b is None:
+                return ""
+            magic, filesize, offset, flags, name_length = _FILE_HEADER_V2.unpack(first + header_b)
+            if magic != _FILE_HEADER_MAGIC:
+                raise ValueError("unknown file header")
+            filename_b = self.__recvExactly(name_length)
+        else:  # 旧版报头: 以'\\0'结尾的文件名, 4字节文件大小
+            filename_b = self.__recvUntilNul(first)
+            filesize_b = self.__recvExactly(4) if filename_b is not None else None
+            if filesize_b is None:
+                return ""
+            filesize = int.from_bytes(filesize_b, 'little', signed=False)
+            offset, flags = 0, 0
+        if filename_b is None:
+            return ""
+        filename = filename_b.decode(SocketConfig.FILENAME_ENCODING)
+        codec = (flags & FileHeaderFlag.CODEC) >> 4
+        if codec and codec not in Codec.available():
+            raise ValueError("unknown codec {}".format(codec))
+        if sink is None:
+            sink = PathSink(use_mmap=use_mmap)
+        resume = bool(flags & FileHeaderFlag.RESUME)
+        have = sink.open(filename, filesize, resume) if filename else 0
+        start = offset
+        if resume:  # 回报已有的字节数
+            self.sendall(have.to_bytes(8, 'little', signed=False))
+            start = max(offset, have)
+        if not filename:
+            return ""
+        # file content
+        count = max(filesize - start, 0)
+        received = 0
+        begin = time.perf_counter()
+        try:
+            buf = sink.buffer(start, count) if not codec else None
+            if codec:
+                received = self.__recvCompressed(sink, start, count, codec)
+            elif buf is not None:
+                with buf:
+                    received = self.__recvInto(buf, count)
+            else:
+                received = self.__recvToSink(sink, start, count)
+        finally:
+            result = sink.close(received == count, start + received)
+            if self.__metrics is not None:
+                if received == count:
+                    self.__metrics.transfer("recv", count, time.perf_counter() - begin)
+                else:
+                    self.__metrics.inc("errors.ft")
+        return result if received == count else ""
+
+    def __recvUntilNul(self, prefix: bytes) -> Optional[bytes]:
+        """逐字节接收到'\\0'为止, 对端提前关闭时返回None"""
+        data = prefix
         while True:
             char = self.recv(1)
             if not char:  # empty data
-                return ""
+                return None
             elif char != b'\0':
-                filename_b += char
+                data += char
             else:
+                return data
+
+    def __recvExactly(self, size: int) -> Optional[bytearray]:
+        """接收恰好size字节, 对端提前关闭时返回None"""
+        buf = bytearray(size)
+        if self.__recvInto(memoryview(buf), size) < size:
+            return None
+        return buf
+
+    def __recvInto(self, view: memoryview, size: int) -> int:
+        """向view接收size字节, 返回实际接收的字节数(对端提前关闭时小于size)"""
+        total_recv_size = 0
+        while total_recv_size < size:
+            nbytes = self.recv_into(view[total_recv_size:size])
+            if nbytes == 0:
                 break
-        filename = filename_b.decode(SocketConfig.FILENAME_ENCODING)
-        # filesize
-        filesize_b = self.recv(4)
-        filesize = int.from_bytes(filesize_b, 'little', signed=False)
-        # file content
-        if filename and filesize > 0:
-            if not os.path.exists(SocketConfig.DEFAULT_DOWNLOAD_PATH):
-                os.makedirs(SocketConfig.DEFAULT_DOWNLOAD_PATH)
-            down_path = os.path.join(SocketConfig.DEFAULT_DOWNLOAD_PATH, filename)
-            total_recv_size = 0
-            with open(down_path, 'wb') as fp:
-                while total_recv_size < filesize:
-                    recv_size = min(filesize - total_recv_size, SocketConfig.RECV_BUFFER_SIZE)
-                    data = self.recv(recv_size)
-                    fp.write(data)
-                    total_recv_size += len(data)
-            return down_path
+            total_recv_size += nbytes
+        return total_recv_size
+
+    def __recvCompressed(self, sink: "RecvSink", start: int, size: int, codec: int) -> int:
+        """接收分块压缩的数据, 解压后的size字节交给sink, 返回实际得到的字节数(对端提前关闭时小于size)"""
+        total_size = 0
+        while total_size < size:
+            length_b = self.__recvExactly(4)
+            if length_b is None:
+                break
+            length = int.from_bytes(length_b, 'little', signed=False)
+            chunk = self.__recvExactly(length & ~_CHUNK_STORED)
+            if chunk is None:
+                break
+            data = chunk if length & _CHUNK_STORED else Codec.decompress(codec, chunk)
+            sink.write(memoryview(data), start + total_size)
+            total_size += len(data)
+        return total_size
+
+    def __recvToSink(self, sink: "RecvSink", start: int, size: int) -> int:
+        """经由可复用的缓冲区接收size字节并交给sink, 返回实际接收的字节数(对端提前关闭时小于size)"""
+        buf = memoryview(bytearray(min(size, SocketConfig.FILE_BUFFER_SIZE)))
+        total_recv_size = 0
+        while total_recv_size < size:
+            nbytes = self.recv_into(buf[:min(size - total_recv_size, len(buf))])
+            if nbytes == 0:
+                break
+            sink.write(buf[:nbytes], start + total_recv_size)
+            total_recv_size += nbytes
+        return total_recv_size
+
+
+class RecvSink:
+    """HTcpSocket.recvFile 接收到的数据的去向"""
+
+    def open(self, filename: str, filesize: int, resume: bool) -> int:
+        """开始接收一个文件
+
+        Returns:
+            int: 已有的字节数, 续传时从该位置继续; 不支持续传时返回0
+        """
+        self._filename = filename
+        return 0
+
+    def buffer(self, start: int, count: int) -> Optional[memoryview]:
+        """返回可以直接接收数据的缓冲区(对应文件中[start, start + count)的部分), 不支持时返回None"""
+        return None
+
+    def write(self, data: memoryview, position: int):
+        """写入文件中position处的数据, data只在调用期间有效"""
+        ...
+
+    def close(self, completed: bool, size: int) -> str:
+        """结束接收
+
+        Args:
+            completed (bool): 是否完整接收
+            size (int): 未完整接收时, 从文件开头起已连续写入的字节数
+
+        Returns:
+            str: 接收结果, 默认为文件名
+        """
+        return self._filename
+
+
+class PathSink(RecvSink):
+    """保存为文件
+
+    数据先写入"<路径>.part", 接收完整后再重命名; 中断后留下的.part文件可用于续传。
+    .part文件预先分配为完整大小, 其长度不代表已接收的字节数, 已从开头连续写入的字节数另外记录在"<路径>.part.have"中,
+    接收中途进程退出时最多损失最后 SocketConfig.PART_SYNC_SIZE 字节; 没有该记录的.part文件从头接收。
+    """
+
+    def __init__(self, path_factory: Optional[Callable[[str], str]] = None, use_mmap: bool = False):
+        """
+        Args:
+            path_factory (Callable[[str], str]): 由文件名得到保存路径, 默认保存到 SocketConfig.DEFAULT_DOWNLOAD_PATH
+            use_mmap (bool): 非续传时是否直接接收到文件的内存映射中
+        """
+        self.__path_factory = path_factory
+        self.__use_mmap = use_mmap
+        self.__path = ""
+        self.__fp: Optional[BinaryIO] = None
+        self.__mm: Optional[mmap.mmap] = None
+        self.__filesize = 0
+        self.__resume = False
+        self.__written = 0  # 从开头起已连续写入的字节数
+        self.__synced = 0  # 已记录到.part.have中的字节数
+
+    def open(self, filename: str, filesize: int, resume: bool) -> int:
+        if self.__path_factory is not None:
+            self.__path = self.__path_factory(filename)
         else:
+            self.__path = os.path.join(SocketConfig.DEFAULT_DOWNLOAD_PATH, filename)
+        dirname = os.path.dirname(self.__path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        part_path = self.__path + ".part"
+        have = self.__readHave() if resume and os.path.exists(part_path) else None
+        if have is not None:
+            have = min(have, filesize)
+            self.__fp = open(part_path, 'r+b')
+        else:
+            have = 0
+            self.__writeHave(0)  # 先于预分配记录, 以免留下长度完整但没有记录的.part文件
+            self.__fp = open(part_path, 'w+b')
+            preallocate(self.__fp.fileno(), filesize)
+        self.__filesize = filesize
+        self.__resume = resume
+        self.__written = self.__synced = have
+        return have
+
+    def __readHave(self) -> Optional[int]:
+        """读取.part.have中记录的已接收字节数, 没有记录或记录无效时返回None"""
+        try:
+            with open(self.__path + ".part.have", 'rb') as fp:
+                data = fp.read(8)
+        except OSError:
+            return None
+        return int.from_bytes(data, 'little', signed=False) if len(data) == 8 else None
+
+    def __writeHave(self, size: int):
+        with open(self.__path + ".part.have", 'wb') as fp:
+            fp.write(size.to_bytes(8, 'little', signed=False))
+        self.__synced = size
+
+    def buffer(self, start: int, count: int) -> Optional[memoryview]:
+        if not self.__use_mmap or self.__resume or self.__filesize == 0:
+            return None
+        self.__mm = mmap.mmap(self.__fp.fileno(), self.__filesize)
+        return memoryview(self.__mm)[start:start + count]
+
+    def write(self, data: memoryview, position: int):
+        if self.__fp.tell() != position:
+            self.__fp.seek(position)
+        self.__fp.write(data)
+        if position == self.__written:
+            self.__written += len(data)
+            if self.__written - self.__synced >= SocketConfig.PART_SYNC_SIZE:
+                self.__fp.flush()  # 数据交给系统后才记录, 记录的字节数不会超过文件中实际写入的部分
+                self.__writeHave(self.__written)
+
+    def close(self, completed: bool, size: int) -> str:
+        if self.__mm is not None:
+            self.__mm.close()
+            self.__mm = None
+        if not completed:  # 截掉未接收的部分, 以便之后续传
+            self.__fp.truncate(size)
+        self.__fp.close()
+        if not completed:
+            self.__writeHave(size)
             return ""
+        os.replace(self.__path + ".part", self.__path)
+        try:
+            os.remove(self.__path + ".part.have")
+        except OSError:
+            pass
+        return self.__path
+
+
+class FileObjSink(RecvSink):
+    """写入一个可写的文件对象(不会关闭该对象)"""
+
+    def __init__(self, fp: BinaryIO):
+        self.__fp = fp
+
+    def write(self, data: memoryview, position: int):
+        self.__fp.write(data)
+
+
+class CallbackSink(RecvSink):
+    """每收到一块数据调用一次callback, 适合直接交给解析器或计算哈希"""
+
+    def __init__(self, callback: Callable[[memoryview], None]):
+        self.__callback = callback
+
+    def write(self, data: memoryview, position: int):
+        self.__callback(data)
+
+
+class BufferSink(RecvSink):
+    """直接接收到调用方提供的缓冲区(bytearray, mmap等)中, 缓冲区需不小于文件大小"""
+
+    def __init__(self, buffer):
+        self.__buffer = buffer
+
+    def open(self, filename: str, filesize: int, resume: bool) -> int:
+        if len(self.__buffer) < filesize:
+            raise ValueError("buffer is smaller than the file")
+        return super().open(filename, filesize, resume)
+
+    def buffer(self, start: int, count: int) -> Optional[memoryview]:
+        return memoryview(self.__buffer)[start:start + count]
 
 
 class HUdpSocket(_HSocket):
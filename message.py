@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
-from typing import Optional, Union, Any, Self
-from enum import IntEnum
+from typing import Optional, Union, Any, Self, Callable
+from enum import IntEnum, IntFlag
 import json
+import zlib
+import struct
 
 
 class ContentType(IntEnum):
@@ -13,51 +15,185 @@ class ContentType(IntEnum):
     BINARY = 0x5  # 二进制串
 
 
+class BuiltInOpCode(IntEnum):
+    FT_TRANSFER_PORT = 60020  # 文件传输端口 {"port": port, "stripes": 并行传输的连接数(可选)}
+    FT_STREAM_BEGIN = 60021  # 在主连接上开始一个文件流, 状态码为流ID {"filename": 文件名, "filesize": 文件大小}
+    FT_STREAM_DATA = 60022  # 文件流数据块, 状态码为流ID, 正文为文件数据
+    FT_STREAM_END = 60023  # 文件流结束, 状态码为流ID {"ok": 是否完整发送}
+    FT_STRIPE_RANGE = 60024  # 并行传输中一个文件片段的头部, 之后紧跟片段数据 {"index", "filename", "filesize", "offset", "length"}
+    FT_STRIPE_END = 60025  # 并行传输中一个传输连接的数据已发送完毕
+    COMPRESSION = 60030  # 压缩协商, 请求 {"codecs": 支持的压缩算法编号列表}, 回复 {"codec": 选定的编号, 0为不压缩}
+    STATS = 60040  # 指标查询, 请求正文为空, 回复为 Metrics.snapshot() 的JSON
+    HEARTBEAT = 60050  # 心跳, 状态码0为ping, 收到ping的一方回复状态码为1的pong
+    REJECTED = 60060  # server拒绝了连接或数据包, 状态码为原因(RejectReason); 拒绝数据包时带有原数据包的请求ID
+    FT_SEND_FILES_HEADER = 62000  # 多文件传输时头部信息 {"file_count": 文件数}
+
+
+class RejectReason(IntEnum):
+    """BuiltInOpCode.REJECTED的状态码"""
+    CONNECTIONS_FULL = 1  # 连接数已满, 随后关闭连接
+    RATE_LIMITED = 2  # 超出限速
+    TOO_MANY_INFLIGHT = 3  # 处理中的数据包过多
+
+
+class HeaderFlag(IntFlag):
+    """报文内容码的高4位用作报头标志"""
+    REQUEST_ID = 0x8000  # 报头后附带4字节请求ID
+    CODEC = 0x7000  # 正文的压缩算法编号(0为未压缩)
+
+
+def _zlibDecompress(data: Union[bytes, bytearray, memoryview]) -> bytes:
+    """解压至多 MessageConfig.MAX_DECOMPRESSED_SIZE + 1 字节, 超出的部分不会被展开"""
+    decompressor = zlib.decompressobj()
+    return decompressor.decompress(data, MessageConfig.MAX_DECOMPRESSED_SIZE + 1)
+
+
+class Codec:
+    """压缩算法注册表, 编号1~7, 写入报文内容码的HeaderFlag.CODEC位"""
+    NONE = 0
+    ZLIB = 1
+
+    __codecs: dict[int, tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+        ZLIB: (lambda data: zlib.compress(data, 1), _zlibDecompress),
+    }
+
+    @classmethod
+    def register(cls, codec: int, compress: Callable[[bytes], bytes], decompress: Callable[[bytes], bytes]):
+        """注册(或替换)一个压缩算法
+
+        Raises:
+            ValueError: 编号不在1~7之间时抛出。
+        """
+        if not 1 <= codec <= 7:
+            raise ValueError("codec id must be in 1..7")
+        cls.__codecs[codec] = (compress, decompress)
+
+    @classmethod
+    def available(cls) -> list[int]:
+        """已注册的压缩算法编号"""
+        return sorted(cls.__codecs)
+
+    @classmethod
+    def choose(cls, offered: list[int], allowed: Optional[list[int]] = None) -> int:
+        """压缩协商: 按对端的偏好顺序选出第一个双方都支持的算法, 没有时返回Codec.NONE
+
+        Args:
+            offered (list[int]): 对端支持的算法编号
+            allowed (Optional[list[int]]): 本端允许使用的算法编号, 为None时允许所有已注册的算法
+        """
+        for codec in offered or []:
+            if codec in cls.__codecs and (allowed is None or codec in allowed):
+                return codec
+        return cls.NONE
+
+    @classmethod
+    def compress(cls, codec: int, data: Union[bytes, bytearray, memoryview]) -> bytes:
+        """以指定的算法压缩
+
+        Raises:
+            ValueError: 压缩算法未注册时抛出。
+        """
+        if codec not in cls.__codecs:
+            raise ValueError("unknown codec {}".format(codec))
+        return cls.__codecs[codec][0](data)
+
+    @classmethod
+    def decompress(cls, codec: int, data: Union[bytes, bytearray, memoryview]) -> bytes:
+        """以指定的算法解压
+
+        Raises:
+            ValueError: 压缩算法未注册、数据损坏或解压后超过 MessageConfig.MAX_DECOMPRESSED_SIZE 时抛出。
+        """
+        if codec not in cls.__codecs:
+            raise ValueError("unknown codec {}".format(codec))
+        try:
+            data = cls.__codecs[codec][1](data)
+        except ValueError:
+            raise
+        except Exception as e:  # 如zlib.error
+            raise ValueError("corrupt compressed data: {}".format(e)) from e
+        if len(data) > MessageConfig.MAX_DECOMPRESSED_SIZE:
+            raise ValueError("decompressed size exceeds {}".format(MessageConfig.MAX_DECOMPRESSED_SIZE))
+        return data
+
+
+
 class MessageConfig:
     ENCODING = "UTF-8"
+    COMPRESS_THRESHOLD = 1024  # 正文不小于该长度时才压缩
+    MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024  # 解压后正文的长度上限, 防止小数据包展开成极大的数据
+    JSON_DUMPS: Callable[[Any], Union[str, bytes]] = json.dumps  # 可替换为更快的实现(如orjson.dumps)
+    JSON_LOADS: Callable[[Union[str, bytes]], Any] = json.loads
 
 
 class Header:
     HEADER_LENGTH = 10
+    REQUEST_ID_LENGTH = 4
+    CONTENTTYPE_MASK = 0x0FFF
+    FLAGS_MASK = 0xF000
+    STRUCT = struct.Struct("<HHHI")  # 内容码, 操作码, 状态码, 报文长度
+    STRUCT_WITH_ID = struct.Struct("<HHHII")  # 同上, 之后是请求ID
+    REQUEST_ID_STRUCT = struct.Struct("<I")
+
+    __slots__ = ("contenttype", "opcode", "statuscode", "length", "requestid", "codec")
 
-    def __init__(self, contenttype, opcode, statuscode, length):
+    def __init__(self, contenttype, opcode, statuscode, length, requestid: Optional[int] = None, codec: int = 0):
         self.contenttype: ContentType = contenttype  # 报文内容码
         self.opcode: int = opcode  # 操作码
         self.statuscode: int = statuscode  # 状态码
-        self.length: int = length  # 报文长度
+        self.length: int = length  # 报文长度(压缩后)
+        self.requestid: Optional[int] = requestid  # 请求ID(可选)
+        self.codec: int = codec  # 正文的压缩算法编号
+
+    def extensionLength(self) -> int:
+        """报头扩展部分的长度"""
+        return 0 if self.requestid is None else self.REQUEST_ID_LENGTH
 
     def toBytes(self) -> bytes:
         """转换为二进制流"""
-        header = b""
-        header += self.contenttype.to_bytes(2, 'little', signed=False)  # 报文内容码
-        header += self.opcode.to_bytes(2, 'little', signed=False)  # 操作码
-        header += self.statuscode.to_bytes(2, 'little', signed=False)  # 状态码
-        header += self.length.to_bytes(4, 'little', signed=False)  # 报文长度
-        return header
+        contenttype = self.contenttype | ((self.codec << 12) & _CODEC_FLAG)
+        if self.requestid is None:
+            return self.STRUCT.pack(contenttype, self.opcode, self.statuscode, self.length)
+        return self.STRUCT_WITH_ID.pack(contenttype | _REQUEST_ID_FLAG, self.opcode, self.statuscode, self.length,
+                                        self.requestid)
 
     @classmethod
     def fromBytes(cls, data: bytes) -> Optional["Header"]:
         """二进制流转换为Header
 
+        只解析固定长度部分, 若带有扩展部分(extensionLength() > 0)需再调用readExtension()。
         如果转换失败返回None。
         """
         if len(data) != cls.HEADER_LENGTH:
             return None
-        contenttype = int.from_bytes(data[0:2], 'little', signed=False)  # 报文内容码
-        opcode = int.from_bytes(data[2:4], 'little', signed=False)  # 操作码
-        statuscode = int().from_bytes(data[4:6], 'little', signed=False)  # 响应码
-        length = int().from_bytes(data[6:10], 'little', signed=False)  # 文本内容起始位置
-        return cls(contenttype, opcode, statuscode, length)
+        contenttype, opcode, statuscode, length = cls.STRUCT.unpack(data)
+        requestid = 0 if contenttype & _REQUEST_ID_FLAG else None  # 待readExtension()填充
+        return cls(contenttype & cls.CONTENTTYPE_MASK, opcode, statuscode, length, requestid,
+                   (contenttype & _CODEC_FLAG) >> 12)
+
+    def readExtension(self, data: bytes):
+        """解析报头扩展部分"""
+        if self.requestid is not None:
+            self.requestid = self.REQUEST_ID_STRUCT.unpack_from(data)[0]
+
+
+_REQUEST_ID_FLAG = int(HeaderFlag.REQUEST_ID)
+_CODEC_FLAG = int(HeaderFlag.CODEC)
+_DISCARD = memoryview(bytearray(65536))  # 跳过的正文读入此处后丢弃, 内容无用, 可以被各解码器共用
 
 
 class Message:
+    __slots__ = ("__contenttype", "__opcode", "__statuscode", "__content", "__json", "__body", "__requestid")
+
     def __init__(self, contenttype: ContentType = ContentType.NONE, opcode: int = 0, statuscode: int = 0,
                  content: Union[str, bytes] = ""):
         self.__contenttype: int = contenttype  # 报文内容码
         self.__opcode: int = opcode  # 操作码
         self.__statuscode: int = statuscode  # 响应码
-        self.__content: Union[str, bytes] = ""
-        self.__json: dict = {}
+        self.__content: Union[str, bytes, None] = ""  # 为None时待由__body解码
+        self.__json: Optional[dict] = None  # 解析后的json, 首次get()时才解析
+        self.__body: Union[bytes, bytearray, memoryview, None] = None  # 编码后的正文, 正文改变时清除
+        self.__requestid: Optional[int] = None  # 请求ID
 
         if content:
             match self.__contenttype:
@@ -67,8 +203,7 @@ class Message:
                     self.__content = content
                 case ContentType.JSONOBJRCT if isinstance(content, str):
                     self.__content = content
-                    self.__json = json.loads(content)
-                case ContentType.BINARY if isinstance(content, bytes):
+                case ContentType.BINARY if isinstance(content, (bytes, bytearray, memoryview)):
                     self.__content = content
                 case _:
                     raise ValueError("content does not match ContentType")
@@ -79,6 +214,25 @@ class Message:
         if header is None:
             return Message()
         msg = Message(header.contenttype, header.opcode, header.statuscode, content)
+        msg.__requestid = header.requestid
+        return msg
+
+    @classmethod
+    def HeaderBody(cls, header: Header, body: Union[bytes, bytearray, memoryview]) -> Self:
+        """由Header和收到的(已解压的)正文组成Message
+
+        文本和json正文保留原始字节, 用到时才解码; 原样转发时不需要重新编码。
+        """
+        msg = Message(header.contenttype, header.opcode, header.statuscode)
+        match header.contenttype:
+            case ContentType.BINARY:
+                msg.__content = body
+            case ContentType.PLAINTEXT | ContentType.JSONOBJRCT if body:
+                msg.__content = None
+                msg.__body = body
+            case _:
+                return cls.HeaderContent(header, str(body, MessageConfig.ENCODING))
+        msg.__requestid = header.requestid
         return msg
 
     @classmethod
@@ -101,19 +255,19 @@ class Message:
         Args:
             opcode (int): 操作码.
             statuscode (int): 状态码.
-            dict_ (dict): 转换为json的字典.
+            dict_ (dict): 转换为json的字典, 之后对其的修改需经由set()才会生效.
             **kw: 自动转换为json字段.
         """
         msg = Message(ContentType.JSONOBJRCT, opcode, statuscode)
-        if dict_ is not None:
-            msg.__json = dict_
+        msg.__json = dict_ if dict_ is not None else {}
+        msg.__content = None
         for key in kw.keys():
             if kw[key] is not None:
                 msg.__json[key] = kw[key]
         return msg
 
     @classmethod
-    def BinaryMsg(cls, opcode: int = 0, statuscode: int = 0, content: bytes = b"") -> Self:
+    def BinaryMsg(cls, opcode: int = 0, statuscode: int = 0, content: Union[bytes, memoryview] = b"") -> Self:
         """正文为二进制(自定义解析方式)的Message"""
         msg = Message(ContentType.BINARY, opcode, statuscode)
         msg.__content = content
@@ -132,13 +286,39 @@ class Message:
         Returns:
             Any: json值
         """
-        ret = self.__json.get(key)
+        ret = self.__loadJson().get(key)
         return ret
 
-    def content(self) -> Union[str, bytes]:
+    def set(self, key: str, value: Any):
+        """当正文为JSONOBJRCT类型时设置json值, 之前缓存的编码结果随之失效"""
+        self.__loadJson()[key] = value
+        self.__content = None
+        self.__body = None
+
+    def content(self) -> Union[str, bytes, memoryview]:
         """直接获取正文"""
+        if self.__content is None:
+            if self.__body is None:  # json在set()后尚未编码
+                self.__body = self.__encodeJson()
+            self.__content = str(self.__body, MessageConfig.ENCODING)
         return self.__content
 
+    def __loadJson(self) -> dict:
+        if self.__json is None:
+            if self.__content is None:
+                self.__json = MessageConfig.JSON_LOADS(self.__body)
+            elif self.__content:
+                self.__json = MessageConfig.JSON_LOADS(self.__content)
+            else:
+                self.__json = {}
+        return self.__json
+
+    def __encodeJson(self) -> Union[bytes, bytearray, memoryview]:
+        if self.__json is None and self.__content:  # 未解析过, 原样使用原始文本
+            return self.__content.encode(MessageConfig.ENCODING)
+        data = MessageConfig.JSON_DUMPS(self.__loadJson())
+        return data if isinstance(data, bytes) else data.encode(MessageConfig.ENCODING)
+
     def contenttype(self) -> int:
         """获取内容码"""
         return self.__contenttype
@@ -151,26 +331,100 @@ class Message:
         """获取状态码"""
         return self.__statuscode
 
-    def toBytes(self) -> bytes:
+    def requestid(self) -> Optional[int]:
+        """获取请求ID, 没有时返回None"""
+        return self.__requestid
+
+    def setRequestId(self, requestid: Optional[int]):
+        """设置请求ID(0 ~ 2^32-1), 为None时不附带请求ID"""
+        self.__requestid = requestid
+
+    def toBytes(self, codec: int = Codec.NONE) -> bytes:
         """转换为二进制流
 
+        Args:
+            codec (int): 正文长度不小于MessageConfig.COMPRESS_THRESHOLD时使用的压缩算法, 压缩后未变小则不压缩
+
+        Raises:
+            ValueError: 当正文内容与类型不匹配时抛出。
+        """
+        return b"".join(self.toBuffers(codec))
+
+    def toBuffers(self, codec: int = Codec.NONE) -> list[Union[bytes, bytearray, memoryview]]:
+        """转换为报头和正文两段缓冲区(正文为空时只有报头), 正文不被拷贝, 可以直接交给socket.sendmsg
+
+        Args:
+            codec (int): 正文长度不小于MessageConfig.COMPRESS_THRESHOLD时使用的压缩算法, 压缩后未变小则不压缩
+
         Raises:
             ValueError: 当正文内容与类型不匹配时抛出。
         """
         match self.__contenttype:
             case ContentType.HEADERONLY:
                 content = b""
+            case ContentType.PLAINTEXT | ContentType.JSONOBJRCT if self.__body is not None:
+                content = self.__body
             case ContentType.PLAINTEXT if isinstance(self.__content, str):
-                content = self.__content.encode(MessageConfig.ENCODING)
-            case ContentType.JSONOBJRCT if isinstance(self.__content, str):
-                content = json.dumps(self.__json).encode(MessageConfig.ENCODING)
-            case ContentType.BINARY if isinstance(self.__content, bytes):
+                content = self.__body = self.__content.encode(MessageConfig.ENCODING)
+            case ContentType.JSONOBJRCT if self.__content is None or isinstance(self.__content, str):
+                content = self.__body = self.__encodeJson()
+            case ContentType.BINARY if isinstance(self.__content, (bytes, bytearray, memoryview)):
                 content = self.__content
             case _:
                 raise ValueError("content does not match ContentType")
+        if codec and len(content) >= MessageConfig.COMPRESS_THRESHOLD:
+            compressed = Codec.compress(codec, content)
+            if len(compressed) < len(content):
+                content = compressed
+            else:
+                codec = Codec.NONE
+        else:
+            codec = Codec.NONE
         length = len(content)  # 数据包长度(不包含报头)
-        header = Header(self.__contenttype, self.__opcode, self.__statuscode, length)
-        return header.toBytes() + content
+        header = Header(self.__contenttype, self.__opcode, self.__statuscode, length, self.__requestid, codec)
+        if length == 0:
+            return [header.toBytes()]
+        return [header.toBytes(), content]
+
+    @classmethod
+    def decodeMany(cls, buffer: Union[bytes, bytearray, memoryview],
+                   header_filter: Optional[Callable[[Header], bool]] = None) -> tuple[list["Message"], int]:
+        """从一段缓冲区中一次解析出所有完整的数据包
+
+        正文会被拷贝, 返回后缓冲区可以复用。
+        header_filter对每个完整的数据包调用一次, 返回False时跳过该数据包, 正文不被拷贝或解压。
+
+        Returns:
+            tuple[list[Message], int]: 数据包列表，已解析的字节数(末尾不完整的数据包不计入)
+        """
+        view = memoryview(buffer)
+        end = len(view)
+        unpack_from = Header.STRUCT.unpack_from
+        unpack_id_from = Header.REQUEST_ID_STRUCT.unpack_from
+        header_length = Header.HEADER_LENGTH
+        msgs = []
+        pos = 0
+        while end - pos >= header_length:
+            contenttype, opcode, statuscode, length = unpack_from(view, pos)
+            body_start = pos + header_length
+            requestid = None
+            if contenttype & _REQUEST_ID_FLAG:
+                if end - body_start < Header.REQUEST_ID_LENGTH:
+                    break
+                requestid = unpack_id_from(view, body_start)[0]
+                body_start += Header.REQUEST_ID_LENGTH
+            body_end = body_start + length
+            if body_end > end:
+                break
+            codec = (contenttype & _CODEC_FLAG) >> 12
+            header = Header(contenttype & Header.CONTENTTYPE_MASK, opcode, statuscode, length, requestid, codec)
+            pos = body_end
+            if header_filter is not None and not header_filter(header):
+                continue
+            body = view[body_start:body_end]
+            body = Codec.decompress(codec, body) if codec else body.tobytes()
+            msgs.append(Message.HeaderBody(header, body))
+        return msgs, pos
 
     @classmethod
     def fromBytes(cls, data: bytes) -> Self:
@@ -179,15 +433,138 @@ class Message:
         header = Header.fromBytes(data[0:Header.HEADER_LENGTH])
         if header is None:
             return Message()
-        if header.contenttype == ContentType.BINARY:
-            msg = Message.HeaderContent(header, data[Header.HEADER_LENGTH:])
-        else:
-            msg = Message.HeaderContent(header, data[Header.HEADER_LENGTH:].decode(MessageConfig.ENCODING))
-        return msg
+        body_start = Header.HEADER_LENGTH + header.extensionLength()
+        header.readExtension(data[Header.HEADER_LENGTH:body_start])
+        body = data[body_start:]
+        if header.codec:
+            body = Codec.decompress(header.codec, body)
+        return Message.HeaderBody(header, body)
 
     def __str__(self):
         return (f"pro:{self.__contenttype}  op:{self.__opcode}  sta:{self.__statuscode}\n"
-                f"content:\n{self.__content}")
+                f"content:\n{self.content()}")
 
     def __repr__(self):
         return str(self)
+
+
+class MessageDecoder:
+    """增量式数据包解码器
+
+    报头和正文都读入预分配的缓冲区, 可以处理报头或正文在任意位置被截断的情况。
+    BINARY正文以memoryview的形式交给Message, 不做额外拷贝; 压缩过的正文在这里解压。
+
+    设置了报头过滤器时, 每个数据包的报头接收完毕后先交给过滤器, 被拒绝的数据包的正文只读取不保存, 也不解码。
+
+    用法:
+        nbytes = sock.recv_into(decoder.buffer())
+        msg = decoder.advance(nbytes)  # 凑齐一个数据包时返回Message, 否则返回None
+    """
+
+    def __init__(self):
+        self.__header_buf = bytearray(Header.HEADER_LENGTH + Header.REQUEST_ID_LENGTH)
+        self.__header: Optional[Header] = None
+        self.__view = memoryview(self.__header_buf)[:Header.HEADER_LENGTH]
+        self.__pos = 0
+        self.__in_body = False
+        self.__skipping = 0  # 正在跳过的正文还剩的字节数(含当前缓冲区)
+        self.__header_filter: Optional[Callable[[Header], bool]] = None
+
+    def setHeaderFilter(self, header_filter: Optional[Callable[[Header], bool]]):
+        """设置报头过滤器, 对每个数据包调用一次, 返回False时跳过该数据包; 为None时不过滤"""
+        self.__header_filter = header_filter
+
+    def reset(self):
+        """丢弃当前未完成的数据包"""
+        self.__header = None
+        self.__view = memoryview(self.__header_buf)[:Header.HEADER_LENGTH]
+        self.__pos = 0
+        self.__in_body = False
+        self.__skipping = 0
+
+    def pending(self) -> bool:
+        """是否有接收到一半的数据包"""
+        return self.__header is not None or self.__pos > 0 or self.__skipping > 0
+
+    def remaining(self) -> int:
+        """当前阶段(报头或正文)还需要的字节数"""
+        return len(self.__view) - self.__pos
+
+    def buffer(self) -> memoryview:
+        """当前待填充的缓冲区, 可以直接传给recv_into"""
+        return self.__view[self.__pos:]
+
+    def advance(self, nbytes: int) -> Optional[Message]:
+        """向buffer()写入了nbytes字节后调用
+
+        Returns:
+            Optional[Message]: 凑齐一个数据包时返回该数据包, 否则返回None
+        """
+        self.__pos += nbytes
+        if self.__pos < len(self.__view):
+            return None
+        if self.__skipping:
+            self.__skipping -= len(self.__view)
+            if self.__skipping:
+                self.__view = _DISCARD[:self.__skipping]
+                self.__pos = 0
+            else:
+                self.reset()
+            return None
+        if not self.__in_body:
+            header = self.__header
+            if header is None:  # 报头固定部分接收完毕
+                header = Header.fromBytes(self.__header_buf[:Header.HEADER_LENGTH])
+                ext_length = header.extensionLength()
+                if ext_length > 0:  # 继续接收报头扩展部分
+                    self.__header = header
+                    self.__view = memoryview(self.__header_buf)[:Header.HEADER_LENGTH + ext_length]
+                    return None
+            else:  # 报头扩展部分接收完毕
+                header.readExtension(self.__header_buf[Header.HEADER_LENGTH:])
+            if self.__header_filter is not None and not self.__header_filter(header):
+                self.reset()
+                if header.length > 0:
+                    self.__skipping = header.length
+                    self.__view = _DISCARD[:header.length]
+                return None
+            if header.length > 0:
+                self.__header = header
+                self.__in_body = True
+                self.__view = memoryview(bytearray(header.length))
+                self.__pos = 0
+                return None
+            self.reset()
+            return Message.HeaderContent(header, "")
+        header = self.__header
+        body = self.__view
+        self.reset()
+        if header.codec:
+            body = memoryview(Codec.decompress(header.codec, body))
+        if header.contenttype == ContentType.BINARY:
+            return Message.HeaderBody(header, body)
+        return Message.HeaderBody(header, body.obj)
+
+    def feed(self, data: Union[bytes, bytearray, memoryview]) -> list[Message]:
+        """送入一段任意长度的数据, 返回其中所有完整的数据包
+
+        没有接收到一半的数据包时, 完整的数据包由Message.decodeMany()直接解析, 只有末尾不完整的部分被拷入解码器。
+        """
+        msgs = []
+        data = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            if not self.pending():
+                batch, consumed = Message.decodeMany(data[offset:], self.__header_filter)
+                msgs.extend(batch)
+                offset += consumed
+                if offset >= len(data):
+                    break
+            buf = self.buffer()
+            n = min(len(buf), len(data) - offset)
+            buf[:n] = data[offset:offset + n]
+            offset += n
+            msg = self.advance(n)
+            if msg is not None:
+                msgs.append(msg)
+        return msgs
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from typing import Callable, Optional, Union
+
+_BUCKETS = 64  # 直方图的桶数, 第i个桶记录 bit_length() == i 的值, 即 [2^(i-1), 2^i)
+_SUM = _BUCKETS  # 直方图列表中累计值的位置
+_QUANTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+
+
+class _Shard:
+    """一个线程独占的计数, 只由该线程写入"""
+    __slots__ = ("thread", "counters", "histograms")
+
+    def __init__(self, thread: Optional[threading.Thread]):
+        self.thread = thread
+        self.counters: dict[str, int] = {}
+        self.histograms: dict[tuple[str, str], list[int]] = {}  # (名称, 标签) -> 各桶的计数 + 累计值
+
+    def merge(self, other: "_Shard"):
+        for name, value in other.counters.copy().items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for key, hist in other.histograms.copy().items():
+            merged = self.histograms.get(key)
+            if merged is None:
+                merged = self.histograms[key] = [0] * (_BUCKETS + 1)
+            for i, value in enumerate(list(hist)):
+                merged[i] += value
+
+
+def _bound(index: int) -> int:
+    """第index个桶的上界(含)"""
+    return (1 << index) - 1
+
+
+def _summarize(hist: list[int]) -> dict:
+    count = sum(hist[:_BUCKETS])
+    summary = {"count": count, "sum": hist[_SUM], "mean": round(hist[_SUM] / count, 1) if count else 0}
+    for key, q in _QUANTILES:
+        target = q * count
+        seen = 0
+        for i in range(_BUCKETS):
+            seen += hist[i]
+            if seen >= target and seen:
+                summary[key] = _bound(i)
+                break
+        else:
+            summary[key] = 0
+    top = max((i for i in range(_BUCKETS) if hist[i]), default=0)
+    summary["max"] = _bound(top)
+    summary["buckets"] = {str(_bound(i)): hist[i] for i in range(_BUCKETS) if hist[i]}
+    return summary
+
+
+class Metrics:
+    """指标注册表
+
+    计数器和直方图按线程分片: 每个线程只写自己的分片, 写入时不加锁; snapshot()读取时合并全部分片。
+    直方图以2的幂分桶, 记录非负整数(如微秒), 分位数为所在桶的上界, 误差在2倍以内。
+    仪表(gauge)是snapshot()时才调用的函数, 不占用写入路径。
+
+    server和client使用的指标:
+        msgs_in / msgs_out / bytes_in / bytes_out: 收发的数据包数和字节数(不含文件传输)
+        ft.files_send / ft.bytes_send / ft.files_recv / ft.bytes_recv: 完成的文件传输
+        errors.*: 各类错误的次数
+        ratelimit.drop / ratelimit.delay / ratelimit.reject: 超出限速或处理中的数据包数上限而被处理的数据包
+        handler_us[操作码]: 回调的处理时间(微秒)
+        ft_kib_per_sec[send|recv]: 每个文件的传输速度
+        connections, send_queue_bytes: server的连接数和发送队列中待发送的字节数(仪表)
+    """
+
+    def __init__(self):
+        self.__local = threading.local()
+        self.__shards: list[_Shard] = []
+        self.__retired = _Shard(None)  # 已结束线程的分片合并于此
+        self.__lock = threading.Lock()
+        self.__gauges: dict[str, Callable[[], Union[int, float]]] = {}
+        self.__created = time.time()
+
+    def __shard(self) -> _Shard:
+        try:
+            return self.__local.shard
+        except AttributeError:
+            pass
+        shard = self.__local.shard = _Shard(threading.current_thread())
+        with self.__lock:
+            alive = []
+            for other in self.__shards:  # 顺便回收已结束线程的分片, 避免每连接一个线程时分片无限增长
+                if other.thread.is_alive():
+                    alive.append(other)
+                else:
+                    self.__retired.merge(other)
+            alive.append(shard)
+            self.__shards = alive
+        return shard
+
+    def inc(self, name: str, value: int = 1):
+        """计数器name增加value"""
+        counters = self.__shard().counters
+        counters[name] = counters.get(name, 0) + value
+
+    def observe(self, name: str, value: int, label: Union[str, int] = ""):
+        """向直方图name(按label区分)记录一个非负整数"""
+        histograms = self.__shard().histograms
+        key = (name, label)
+        hist = histograms.get(key)
+        if hist is None:
+            hist = histograms[key] = [0] * (_BUCKETS + 1)
+        hist[min(value.bit_length(), _BUCKETS - 1)] += 1
+        hist[_SUM] += value
+
+    def transfer(self, direction: str, nbytes: int, seconds: float):
+        """记录一次完成的文件传输, direction为"send"或"recv\""""
+        self.inc("ft.files_" + direction)
+        self.inc("ft.bytes_" + direction, nbytes)
+        if seconds > 0:
+            self.observe("ft_kib_per_sec", int(nbytes / 1024 / seconds), direction)
+
+    def setGauge(self, name: str, func: Optional[Callable[[], Union[int, float]]]):
+        """设置仪表name的取值函数, 为None时移除"""
+        if func is None:
+            self.__gauges.pop(name, None)
+        else:
+            self.__gauges[name] = func
+
+    def snapshot(self) -> dict:
+        """合并全部分片, 返回可以JSON序列化的当前值
+
+        Returns:
+            dict: {"uptime": 秒, "counters": {名称: 值}, "gauges": {名称: 值},
+                   "histograms": {名称: {标签: {"count", "sum", "mean", "p50", "p90", "p99", "p999", "max",
+                   "buckets": {上界: 计数}}}}}
+        """
+        total = _Shard(None)
+        with self.__lock:
+            shards = [self.__retired, *self.__shards]
+        for shard in shards:
+            total.merge(shard)
+        gauges = {}
+        for name, func in list(self.__gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception:  # 取值时对象可能已关闭
+                continue
+        histograms: dict[str, dict[str, dict]] = {}
+        for (name, label), hist in sorted(total.histograms.items(), key=lambda item: str(item[0])):
+            histograms.setdefault(name, {})[str(label)] = _summarize(hist)
+        return {
+            "uptime": round(time.time() - self.__created, 3),
+            "counters": dict(sorted(total.counters.items())),
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    def reset(self):
+        """清零全部计数器和直方图
+
+        与写入并发时, 正在进行的个别写入可能丢失。
+        """
+        with self.__lock:
+            self.__retired = _Shard(None)
+            for shard in self.__shards:
+                shard.counters = {}
+                shard.histograms = {}
+            self.__created = time.time()
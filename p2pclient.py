@@ -68,6 +68,10 @@ class HTcpP2PClient:
                 self._onDisconnected()
                 self.close()
                 break
+            except OSError:
+                if self.isclosed():  # close()关闭了套接字
+                    break
+                raise
             else:
                 self._messageHandle(msg)
 
@@ -124,6 +128,10 @@ class HUdpP2PClient():
                     continue
             except TimeoutError:
                 continue
+            except OSError:
+                if not self.__running:  # close()关闭了套接字
+                    break
+                raise
             else:
                 self._messageHandle(msg)
 
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional, Union, TextIO
+
+
+class Profiler:
+    """运行时按需开启的剖析器
+
+    开启后按采样率选中一部分操作(如一次读事件或一个数据包), 记录其中各阶段的耗时区间:
+        read: 一次读事件(selector)或一个数据包(阻塞读取, 含等待数据的时间)
+        task: 工作线程池中处理的一个数据包
+        recv / decode: 套接字读取和解码
+        dispatch: 一个数据包的处理, 其中的回调以回调函数名记录
+        encode / send: 编码和发送
+    区间只在被选中的操作内部记录, 因此嵌套关系完整, 可以导出为Chrome trace(chrome://tracing, Perfetto)查看。
+    开启cprofile时, 被选中的回调同时在cProfile下执行; 进程中只有一个cProfile剖析器(Python 3.12起不能同时启用多个),
+    同一时刻只剖析一个回调, 与其重叠的其他线程的回调只记录区间。
+
+    未开启时, 各处的检查只有一次方法调用的开销。
+    """
+
+    def __init__(self, max_events: int = 200000):
+        """
+        Args:
+            max_events (int): 最多保留的区间数, 超过后丢弃新的区间
+        """
+        self.__max_events = max_events
+        self.__active = False
+        self.__deadline: Optional[float] = None
+        self.__sample_rate = 1.0
+        self.__cprofile = False
+        self.__events: list[tuple] = []  # (名称, 类别, 开始ns, 耗时ns, 线程ID, 参数)
+        self.__dropped = 0
+        self.__threads: dict[int, str] = {}
+        self.__profile: Optional[cProfile.Profile] = None
+        self.__profile_lock = threading.Lock()  # 持有者的回调正在cProfile下执行
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__origin = time.perf_counter_ns()
+
+    def start(self, duration: Optional[float] = None, sample_rate: float = 1.0, cprofile: bool = False):
+        """开始剖析, 之前的记录会被清空
+
+        Args:
+            duration (Optional[float]): 持续秒数, 到时自动停止; None时一直持续到stop()
+            sample_rate (float): 采样率(0~1), 每次操作以该概率被选中
+            cprofile (bool): 是否同时以cProfile剖析被选中的回调
+        """
+        with self.__lock:
+            self.__events = []
+            self.__dropped = 0
+            self.__threads = {}
+            self.__profile = cProfile.Profile() if cprofile else None
+            self.__local = threading.local()
+            self.__sample_rate = sample_rate
+            self.__cprofile = cprofile
+            self.__deadline = None if duration is None else time.monotonic() + duration
+            self.__active = True
+
+    def stop(self):
+        """停止剖析, 已记录的区间保留到下次start()"""
+        self.__active = False
+
+    def active(self) -> bool:
+        if self.__active and self.__deadline is not None and time.monotonic() >= self.__deadline:
+            self.__active = False
+        return self.__active
+
+    def sample(self) -> bool:
+        """是否记录即将开始的一次操作: 剖析已开启且按采样率选中"""
+        if not self.__active:
+            return False
+        if self.__deadline is not None and time.monotonic() >= self.__deadline:
+            self.__active = False
+            return False
+        return self.__sample_rate >= 1.0 or random.random() < self.__sample_rate
+
+    def tracing(self) -> bool:
+        """当前线程是否处于被选中的操作之内"""
+        return self.__active and getattr(self.__local, "depth", 0) > 0
+
+    @contextmanager
+    def span(self, name: str, cat: str = "stage", **args):
+        """记录一个区间; cat为"callback"且开启了cprofile时, 区间内的代码在cProfile下执行"""
+        local = self.__local
+        depth = getattr(local, "depth", 0)
+        profile = self.__enableProfile() if cat == "callback" and self.__cprofile else None
+        local.depth = depth + 1
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            local.depth = depth
+            if profile is not None:
+                profile.disable()
+                self.__profile_lock.release()
+            self.__add(name, cat, start, end - start, args)
+
+    def wrap(self, name: str, func: Callable, cat: str = "stage") -> Callable:
+        """返回一个把每次调用记录为一个区间的func, 用于在被选中的操作内替换热路径上的函数"""
+        add = self.__add
+
+        def traced(*args):
+            start = time.perf_counter_ns()
+            try:
+                return func(*args)
+            finally:
+                add(name, cat, start, time.perf_counter_ns() - start, {})
+        return traced
+
+    def __enableProfile(self) -> Optional[cProfile.Profile]:
+        """启用cProfile并返回, 已有回调(包括外层的回调)正在剖析或启用失败时返回None"""
+        profile = self.__profile
+        if profile is None or not self.__profile_lock.acquire(blocking=False):
+            return None
+        try:
+            profile.enable()
+        except ValueError:  # 已有其他剖析器在运行(如外部启动的cProfile)
+            self.__profile_lock.release()
+            return None
+        return profile
+
+    def __add(self, name: str, cat: str, start: int, duration: int, args: dict):
+        if len(self.__events) >= self.__max_events:
+            self.__dropped += 1
+            return
+        tid = threading.get_ident()
+        if tid not in self.__threads:
+            self.__threads[tid] = threading.current_thread().name
+        self.__events.append((name, cat, start, duration, tid, args))
+
+    def events(self) -> list[tuple]:
+        """已记录的区间 (名称, 类别, 开始ns, 耗时ns, 线程ID, 参数)"""
+        return list(self.__events)
+
+    def dropped(self) -> int:
+        return self.__dropped
+
+    def summary(self) -> dict:
+        """按区间名称汇总
+
+        Returns:
+            dict: {名称: {"count", "total_us", "mean_us", "max_us"}}, 按总耗时从大到小排列
+        """
+        totals: dict[str, list[int]] = {}
+        for name, cat, start, duration, tid, args in self.events():
+            total = totals.setdefault(name, [0, 0, 0])
+            total[0] += 1
+            total[1] += duration
+            total[2] = max(total[2], duration)
+        return {
+            name: {"count": count, "total_us": total // 1000, "mean_us": round(total / count / 1000, 1),
+                   "max_us": longest // 1000}
+            for name, (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1])
+        }
+
+    def cprofileStats(self) -> Optional[pstats.Stats]:
+        """cProfile的结果, 没有开启cprofile或没有数据时返回None"""
+        profile = self.__profile
+        if profile is None or not profile.getstats():
+            return None
+        return pstats.Stats(profile)
+
+    def exportChromeTrace(self, file: Union[str, TextIO]):
+        """导出为Chrome trace event格式的JSON
+
+        Args:
+            file (Union[str, TextIO]): 文件路径或可写的文本文件对象
+        """
+        pid = os.getpid()
+        trace_events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in list(self.__threads.items())
+        ]
+        for name, cat, start, duration, tid, args in self.events():
+            event = {"name": name, "cat": cat, "ph": "X", "pid": pid, "tid": tid,
+                     "ts": (start - self.__origin) / 1000, "dur": duration / 1000}
+            if args:
+                event["args"] = args
+            trace_events.append(event)
+        trace = {"traceEvents": trace_events, "displayTimeUnit": "ms", "otherData": {"dropped": self.__dropped}}
+        if isinstance(file, str):
+            with open(file, "w", encoding="utf-8") as fp:
+                json.dump(trace, fp, default=str)
+        else:
+            json.dump(trace, file, default=str)
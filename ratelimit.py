@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Optional
+from .message import Header, ContentType, RejectReason
+
+
+class RateLimitAction(IntEnum):
+    """超出限速或处理中的数据包数上限时的处理方式"""
+    DROP = 0  # 丢弃, 正文不会被保存或解码
+    DELAY = 1  # 照常处理, 之后暂停读取该连接直到重新满足限制, 由TCP流控使对端减速
+    REJECT = 2  # 丢弃并回复 BuiltInOpCode.REJECTED, 带有原数据包的请求ID
+
+
+class TokenBucket:
+    """令牌桶, 每秒补充rate个令牌, 最多积累capacity个"""
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def wait(self, count: float, now: float) -> float:
+        """还需要等待多少秒才能取出count个令牌, 0为现在即可
+
+        count超过capacity时按capacity计算(取出后余量为负), 以免大数据包永远无法通过。
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        need = min(count, self.capacity) - self.tokens
+        return need / self.rate if need > 0 else 0.0
+
+    def take(self, count: float) -> float:
+        """取出count个令牌, 余量可以为负
+
+        Returns:
+            float: 余量恢复为非负还需要的秒数
+        """
+        self.tokens -= count
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimit:
+    """一组限速设置, 消息数和字节数各对应一个令牌桶"""
+    __slots__ = ("msgs_per_sec", "bytes_per_sec", "burst", "action")
+
+    def __init__(self, msgs_per_sec: Optional[float], bytes_per_sec: Optional[float], burst: float,
+                 action: RateLimitAction):
+        """
+        Args:
+            msgs_per_sec (Optional[float]): 每秒的数据包数, None为不限制
+            bytes_per_sec (Optional[float]): 每秒的字节数(含报头), None为不限制
+            burst (float): 允许的突发量, 以秒计, 令牌桶的容量为每秒的限额乘以该值
+            action (RateLimitAction): 超出时的处理方式
+        """
+        self.msgs_per_sec = msgs_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.burst = burst
+        self.action = action
+
+    def buckets(self) -> tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        """为一个连接创建(消息数, 字节数)令牌桶"""
+        return (None if self.msgs_per_sec is None else
+                TokenBucket(self.msgs_per_sec, max(self.msgs_per_sec * self.burst, 1)),
+                None if self.bytes_per_sec is None else
+                TokenBucket(self.bytes_per_sec, max(self.bytes_per_sec * self.burst, 1)))
+
+
+class ConnectionLimiter:
+    """一个连接的限速和处理中数据包数的状态
+
+    check()在接收数据的线程中对每个报头调用, done()在处理完一个被接受的数据包后调用(可以在任意线程中)。
+    一次读取中解码出多个数据包时, 可以开启pace, 由releaseAt()按接收顺序给出每个被接受的数据包可以处理的时刻。
+    """
+
+    def __init__(self, limits: dict[Optional[int], RateLimit], max_inflight: Optional[int] = None,
+                 inflight_action: RateLimitAction = RateLimitAction.REJECT, pace: bool = False):
+        """
+        Args:
+            limits (dict[Optional[int], RateLimit]): 操作码 -> 该操作码的限速, 键为None的是整个连接的限速
+            max_inflight (Optional[int]): 已接收但未处理完的数据包数上限, None为不限制
+            inflight_action (RateLimitAction): 达到上限时的处理方式
+            pace (bool): 是否记录每个被接受的数据包可以处理的时刻, 开启后需要对每个被接受的数据包调用一次releaseAt()
+        """
+        self.__limits = limits
+        self.__buckets: dict[Optional[int], tuple] = {}  # 操作码 -> (限速, 消息数令牌桶, 字节数令牌桶)
+        self.__max_inflight = max_inflight
+        self.__inflight_action = inflight_action
+        self.__inflight = 0
+        self.__lock = threading.Lock()
+        self.__resume_at = 0.0  # 因DELAY而暂停读取到此时刻(time.monotonic())
+        self.__releases: Optional[deque[float]] = deque() if pace else None  # 被接受的数据包各自可以处理的时刻
+
+    def check(self, header: Header) -> Optional[tuple[RateLimitAction, RejectReason]]:
+        """检查一个报头已接收完的数据包
+
+        Returns:
+            Optional[tuple[RateLimitAction, RejectReason]]: 未超出限制时返回None, 否则返回处理方式和原因;
+            处理方式为DELAY时数据包仍被接受, 之后由resumeAt()/held()决定暂停读取多久
+        """
+        verdict = self.__check(header)
+        if self.__releases is not None and (verdict is None or verdict[0] == RateLimitAction.DELAY):
+            self.__releases.append(self.__resume_at)
+        return verdict
+
+    def __check(self, header: Header) -> Optional[tuple[RateLimitAction, RejectReason]]:
+        if self.__max_inflight is None or header.contenttype <= ContentType.ERROR_:  # 空包和错误包不会被处理
+            return self.__rate(header)
+        with self.__lock:
+            full = self.__inflight >= self.__max_inflight
+            if full and self.__inflight_action != RateLimitAction.DELAY:
+                return self.__inflight_action, RejectReason.TOO_MANY_INFLIGHT
+            verdict = self.__rate(header)
+            if verdict is not None and verdict[0] != RateLimitAction.DELAY:
+                return verdict
+            self.__inflight += 1
+            if full:
+                return RateLimitAction.DELAY, RejectReason.TOO_MANY_INFLIGHT
+            return verdict
+
+    def __rate(self, header: Header) -> Optional[tuple[RateLimitAction, RejectReason]]:
+        buckets = [self.__bucketsOf(key) for key in (None, header.opcode) if key in self.__limits]
+        if not buckets:
+            return None
+        now = time.monotonic()
+        size = Header.HEADER_LENGTH + header.extensionLength() + header.length
+        for limit, msgs, nbytes in buckets:  # 先检查全部令牌桶, 不通过时不扣除
+            waits = (msgs is not None and msgs.wait(1, now)) or (nbytes is not None and nbytes.wait(size, now))
+            if waits and limit.action != RateLimitAction.DELAY:
+                return limit.action, RejectReason.RATE_LIMITED
+        delay = 0.0
+        for limit, msgs, nbytes in buckets:
+            if msgs is not None:
+                delay = max(delay, msgs.take(1))
+            if nbytes is not None:
+                delay = max(delay, nbytes.take(size))
+        if not delay:
+            return None
+        self.__resume_at = max(self.__resume_at, now + delay)
+        return RateLimitAction.DELAY, RejectReason.RATE_LIMITED
+
+    def __bucketsOf(self, key: Optional[int]) -> tuple:
+        buckets = self.__buckets.get(key)
+        if buckets is None:
+            limit = self.__limits[key]
+            buckets = self.__buckets[key] = (limit, *limit.buckets())
+        return buckets
+
+    def done(self) -> bool:
+        """一个被接受的数据包处理完毕
+
+        Returns:
+            bool: 是否因此解除了held()的暂停
+        """
+        if self.__max_inflight is None:
+            return False
+        with self.__lock:
+            self.__inflight -= 1
+            return (self.__inflight_action == RateLimitAction.DELAY
+                    and self.__inflight == self.__max_inflight - 1)
+
+    def releaseAt(self) -> float:
+        """开启pace时, 按接收顺序取出下一个被接受的数据包可以处理的时刻(time.monotonic()), 已过去时可以立即处理"""
+        return self.__releases.popleft() if self.__releases else 0.0
+
+    def resumeAt(self) -> float:
+        """因限速(DELAY)暂停读取直到该时刻(time.monotonic()), 已过去时不需要暂停"""
+        return self.__resume_at
+
+    def held(self) -> bool:
+        """是否因处理中的数据包达到上限(DELAY)而需要暂停读取, 直到done()返回True"""
+        return (self.__max_inflight is not None and self.__inflight_action == RateLimitAction.DELAY
+                and self.__inflight >= self.__max_inflight)
+
+    def inflight(self) -> int:
+        """已接受但未处理完的数据包数(设置了上限时才统计)"""
+        return self.__inflight
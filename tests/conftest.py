@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import socket
+import threading
+import time
+import pytest
+from ..hserver import HTcpSelectorServer, HTcpThreadingServer
+from ..hclient import HTcpReqResClient
+from ..hasync import HTcpAsyncServer
+from ..hsocket import HTcpSocket
+
+SERVER_CLASSES = (HTcpSelectorServer, HTcpThreadingServer)
+
+
+def freePort() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def waitFor(predicate, timeout: float = 5.0) -> bool:
+    """轮询直到predicate()为真, 超时返回False"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def waitListening(port: int, timeout: float = 5.0):
+    def connectable():
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return True
+        except OSError:
+            return False
+    assert waitFor(connectable, timeout), "server did not start"
+
+
+def socketPair() -> tuple[HTcpSocket, HTcpSocket]:
+    """一对已连接的阻塞HTcpSocket"""
+    a, b = socket.socketpair()
+    return HTcpSocket(a.family, fileno=a.detach()), HTcpSocket(b.family, fileno=b.detach())
+
+
+def connectClient(port: int, timeout: float = 5.0) -> HTcpReqResClient:
+    client = HTcpReqResClient()
+    client.settimeout(timeout)
+    client.connect(("127.0.0.1", port))
+    return client
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """下载目录(SocketConfig.DEFAULT_DOWNLOAD_PATH)是相对路径, 每个测试在自己的临时目录中运行"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def serve():
+    """serve(server) 在后台线程中启动server并等待其开始监听, 测试结束时关闭
+
+    第一次探测连接会被server当作普通连接接受后立即关闭。
+    """
+    servers = []
+
+    def start(server, port: int):
+        threading.Thread(target=server.startserver, daemon=True).start()
+        servers.append(server)
+        waitListening(port)
+        return server
+    yield start
+    for server in servers:
+        server.closeserver()
+
+
+@pytest.fixture(params=SERVER_CLASSES, ids=lambda cls: cls.__name__)
+def server_cls(request):
+    return request.param
+
+
+@pytest.fixture
+def echo_server(server_cls, serve):
+    """操作码1原样回复的server, 返回(server, 端口)"""
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    serve(server, port)
+    return server, port
+
+
+@pytest.fixture
+def async_server():
+    """返回start(setup): 创建HTcpAsyncServer, 调用setup(server)注册回调后在后台事件循环中启动, 返回(server, 端口, loop)"""
+    loops = []
+
+    def start(setup=None):
+        port = freePort()
+        server = HTcpAsyncServer(("127.0.0.1", port))
+        if setup is not None:
+            setup(server)
+        loop = asyncio.new_event_loop()
+        loops.append((loop, server))
+        threading.Thread(target=loop.run_until_complete, args=(server.startserver(),), daemon=True).start()
+        waitListening(port)
+        return server, port, loop
+    yield start
+    for loop, server in loops:
+        loop.call_soon_threadsafe(server.closeserver)
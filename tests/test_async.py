@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from ..hasync import *
+
+
+def _runClient(port: int, msgs: list[Message], count: int, timeout: float = 5.0) -> list[Message]:
+    """用HTcpAsyncClient发送msgs并收集count个回复"""
+    async def run():
+        got = []
+        done = asyncio.Event()
+
+        def onMessage(msg):
+            got.append(msg)
+            if len(got) >= count:
+                done.set()
+        client = HTcpAsyncClient()
+        client.setOnMessageReceivedCallback(onMessage)
+        await client.connect(("127.0.0.1", port))
+        try:
+            for msg in msgs:
+                client.sendmsg(msg)
+            await asyncio.wait_for(done.wait(), timeout)
+        finally:
+            client.close()
+        return got
+    return asyncio.run(run())
+
+
+def test_async_server_and_client_round_trip(async_server):
+    async def echo(conn, msg):
+        await asyncio.sleep(0)
+        conn.sendMsg(msg)
+        return True
+    server, port, loop = async_server(lambda s: s.setOnMsgRecvByOpCodeCallback(1, echo))
+    replies = _runClient(port, [Message.PlainTextMsg(1, 0, str(i)) for i in range(100)], 100)
+    assert [msg.content() for msg in replies] == [str(i) for i in range(100)]  # 协程回调按顺序执行
+
+
+def test_async_handler_exception_does_not_stop_the_connection(async_server):
+    def setup(server):
+        def fail(conn, msg):
+            raise RuntimeError("handler failed")
+
+        async def failAsync(conn, msg):
+            raise RuntimeError("handler failed")
+        server.setOnMsgRecvByOpCodeCallback(2, fail)
+        server.setOnMsgRecvByOpCodeCallback(3, failAsync)
+        server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    server, port, loop = async_server(setup)
+    msgs = [Message.HeaderOnlyMsg(2), Message.HeaderOnlyMsg(3), Message.PlainTextMsg(1, 0, "after")]
+    replies = _runClient(port, msgs, 1)
+    assert replies[0].content() == "after"
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from ..benchmarks.scenarios import SCENARIOS, BenchConfig, runAll
+from ..benchmarks.stats import compareResults
+
+
+def _tinyConfig() -> BenchConfig:
+    config = BenchConfig(quick=True, duration=0.05)
+    config.payloads = [64]
+    config.content_types = ["binary"]
+    config.connections = [1]
+    config.depths = [1, 4]
+    config.file_size = 256 * 1024
+    return config
+
+
+def test_every_scenario_runs_on_loopback():
+    results = runAll(_tinyConfig())
+    assert {result["scenario"] for result in results} == set(SCENARIOS)
+    assert not [result for result in results if "failed" in result]
+    for result in results:
+        assert result["errors"] == 0
+        if result["scenario"] == "file_transfer":
+            assert result["mb_per_sec"] > 0
+        else:
+            assert result["messages"] > 0 and result["latency_us"]
+
+
+def test_compare_reports_regressions_beyond_the_threshold():
+    case = {"scenario": "tcp_reqres", "server": "selector", "client": "HTcpReqResClient", "payload": 64}
+    old = {"results": [{**case, "msgs_per_sec": 1000.0, "cpu_us_per_msg": 10.0}]}
+    new = {"results": [{**case, "msgs_per_sec": 850.0, "cpu_us_per_msg": 10.5}]}
+    changes, regressions = compareResults(old, new, threshold=0.1)
+    assert regressions == 1  # 吞吐量下降15%, CPU增加5%不计
+    assert {change["metric"]: change["regressed"] for change in changes} == {"msgs_per_sec": True,
+                                                                           "cpu_us_per_msg": False}
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import pytest
+from ..hserver import *
+from ..hclient import *
+from .conftest import freePort, connectClient
+
+
+def _reply(conn, msg):
+    conn.sendMsg(Message.PlainTextMsg(1, 0, msg.content()))  # 新建的回复不带请求ID, 由server补上
+    return True
+
+
+def _checkPipelined(port: int):
+    client = connectClient(port)
+    try:
+        futures = [client.submit(Message.PlainTextMsg(1, 0, str(i)), timeout=5) for i in range(200)]
+        assert [f.result(5).content() for f in futures] == [str(i) for i in range(200)]
+    finally:
+        client.close()
+
+
+def test_pipelined_submit_matches_replies_by_request_id(server_cls, serve):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(1, _reply)
+    serve(server, port)
+    _checkPipelined(port)
+
+
+def test_pipelined_submit_against_the_async_server(async_server):
+    server, port, loop = async_server(lambda s: s.setOnMsgRecvByOpCodeCallback(1, _reply))
+    _checkPipelined(port)
+
+
+def test_concurrent_first_submits_start_one_receive_thread(echo_server):
+    server, port = echo_server
+    client = connectClient(port)
+    try:
+        before = set(threading.enumerate())  # 之前测试的接收线程可能仍在退出中
+        barrier = threading.Barrier(8)
+        futures = []
+
+        def submit(i):
+            barrier.wait()
+            futures.append(client.submit(Message.PlainTextMsg(1, 0, str(i)), timeout=5))
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        assert sorted(f.result(5).content() for f in futures) == [str(i) for i in range(8)]
+        assert sum("__recv_handle" in th.name for th in set(threading.enumerate()) - before) == 1
+    finally:
+        client.close()
+
+
+def test_submit_times_out_without_a_reply(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(2, lambda conn, msg: True)  # 不回复
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        with pytest.raises(TimeoutError):
+            client.submit(Message.HeaderOnlyMsg(2), timeout=0.2).result(5)
+    finally:
+        client.close()
+
+
+def test_pool_reuses_connections_and_replaces_broken_ones(echo_server):
+    server, port = echo_server
+    pool = HTcpClientPool(("127.0.0.1", port), max_size=2, timeout=5)
+    try:
+        for i in range(20):
+            assert pool.request(Message.PlainTextMsg(1, 0, str(i))).content() == str(i)
+        assert pool.size() == 1  # 串行请求只用一个连接
+        with pool.connection() as client:
+            client.close()  # 归还一个已关闭的连接
+        assert pool.size() == 0
+        with pytest.raises(RuntimeError):
+            with pool.connection():
+                raise RuntimeError("request failed")  # 出错时连接被丢弃
+        assert pool.size() == 0
+        assert pool.request(Message.PlainTextMsg(1, 0, "again")).content() == "again"
+    finally:
+        pool.close()
+
+
+def test_pool_blocks_at_max_size_and_times_out(echo_server):
+    server, port = echo_server
+    pool = HTcpClientPool(("127.0.0.1", port), max_size=1, timeout=5)
+    try:
+        client = pool.acquire()
+        with pytest.raises(TimeoutError):
+            pool.acquire(timeout=0.1)
+        threading.Timer(0.1, pool.release, args=(client,)).start()
+        assert pool.acquire(timeout=5) is client  # 归还后唤醒等待者
+        pool.release(client)
+    finally:
+        pool.close()
+
+
+def test_pooled_connections_survive_server_heartbeats(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.set_heartbeat(0.2)
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    serve(server, port)
+    pool = HTcpClientPool(("127.0.0.1", port), max_size=2, timeout=5)
+    try:
+        assert pool.request(Message.PlainTextMsg(1, 0, "first")).content() == "first"
+        time.sleep(0.7)  # 空闲期间server发来心跳
+        assert pool.request(Message.PlainTextMsg(1, 0, "second")).content() == "second"
+        assert pool.size() == 1  # 回复过心跳的连接仍然可用, 没有被替换
+    finally:
+        pool.close()
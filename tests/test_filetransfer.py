@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+import threading
+import pytest
+from ..hserver import *
+from ..hclient import *
+from ..filestream import _planStripes
+from .conftest import freePort, waitFor, connectClient, socketPair
+
+
+def _makeFile(path: str, size: int) -> bytes:
+    data = os.urandom(size)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    return data
+
+
+def _transfer(send, recv):
+    """在一对连接上由后台线程执行send(sock), 当前线程执行recv(sock)并返回其结果"""
+    a, b = socketPair()
+    with a, b:
+        errors = []
+
+        def run():
+            try:
+                send(a)
+            except OSError as e:
+                errors.append(e)
+            finally:
+                a.close()
+        sender = threading.Thread(target=run)
+        sender.start()
+        try:
+            return recv(b)
+        finally:
+            sender.join()
+            assert not errors
+
+
+def test_server_sends_a_regular_file_with_sendfile(server_cls, serve, workdir, monkeypatch):
+    data = _makeFile("src.bin", 3 * 1024 * 1024 + 7)
+    calls = []
+    sendfile = HTcpSocket.sendfile
+    monkeypatch.setattr(HTcpSocket, "sendfile", lambda self, *args: (calls.append(args), sendfile(self, *args))[1])
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(10, lambda conn, msg: (server.sendfile(conn, "src.bin", "dst.bin"), True)[1])
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        client.sendmsg(Message.HeaderOnlyMsg(10))
+        path = client.recvfile()
+    finally:
+        client.close()
+    assert os.path.basename(path) == "dst.bin"
+    with open(path, 'rb') as fp:
+        assert fp.read() == data
+    assert calls  # 真实文件由内核直接发送
+
+
+def test_file_objects_fall_back_to_chunks_and_mmap_receive(workdir):
+    data = os.urandom(1024 * 1024 + 3)
+    path = _transfer(lambda sock: sock.sendFile(io.BytesIO(data), "mm.bin"),
+                     lambda sock: sock.recvFile(use_mmap=True))
+    with open(path, 'rb') as fp:
+        assert fp.read() == data
+    assert not os.path.exists(path + ".part")
+
+
+def test_server_streams_files_on_the_main_connection_during_requests(server_cls, serve, workdir):
+    os.makedirs("src")
+    files = {name: _makeFile(os.path.join("src", name), size) for name, size in (("a.bin", 300000), ("b.bin", 1000))}
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+
+    def start(conn, msg):
+        for name in files:  # 两个文件流同时进行
+            assert server.streamfile(conn, os.path.join("src", name), name)
+        conn.sendMsg(Message.PlainTextMsg(11, 0, "started"))
+        return True
+    server.setOnMsgRecvByOpCodeCallback(11, start)
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    serve(server, port)
+    client = connectClient(port)
+    received = []
+    client.setOnFileReceivedCallback(received.append)
+    try:
+        assert client.request(Message.HeaderOnlyMsg(11)).content() == "started"
+        for i in range(1000):  # 文件流数据块与回复交错到达
+            if len(received) == len(files):
+                break
+            assert client.request(Message.PlainTextMsg(1, 0, str(i))).content() == str(i)
+    finally:
+        client.close()
+    assert sorted(os.path.basename(path) for path in received) == sorted(files)
+    for path in received:
+        with open(path, 'rb') as fp:
+            assert fp.read() == files[os.path.basename(path)]
+
+
+def test_client_streams_a_file_to_the_server(server_cls, serve, workdir):
+    data = _makeFile("up.bin", 200000)
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    received = []
+    done = threading.Event()
+    server.setOnFileReceivedCallback(lambda conn, path: (received.append(path), done.set()))
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        assert client.streamfile("up.bin", "stored.bin")
+        assert done.wait(5)
+    finally:
+        client.close()
+    assert os.path.basename(received[0]) == "stored.bin"
+    with open(received[0], 'rb') as fp:
+        assert fp.read() == data
+
+
+def test_striped_upload_splits_large_files_across_connections(server_cls, serve, workdir, monkeypatch):
+    monkeypatch.setattr(StripedTransferConfig, "SPLIT_THRESHOLD", 256 * 1024)
+    os.makedirs("src")
+    sizes = {"big.bin": 2 * 1024 * 1024 + 5, "small.bin": 1000, "empty.bin": 0}
+    files = {name: _makeFile(os.path.join("src", name), size) for name, size in sizes.items()}
+    plan = _planStripes(list(sizes.values()), 3)
+    assert all(any(index == 0 for index, _, _ in stripe) for stripe in plan)  # 大文件的片段分布在每个连接上
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    received = []
+    server.setOnMsgRecvByOpCodeCallback(12, lambda conn, msg: (received.extend(server.recvfilesStriped(conn, 3)), True)[1])
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        client.sendmsg(Message.HeaderOnlyMsg(12))
+        names = list(files)
+        assert client.sendfilesStriped([os.path.join("src", name) for name in names], names) == len(names)
+    finally:
+        client.close()
+    assert waitFor(lambda: len(received) == len(files))
+    for path in received:
+        with open(path, 'rb') as fp:
+            assert fp.read() == files[os.path.basename(path)]
+
+
+def test_striped_download(server_cls, serve, workdir):
+    os.makedirs("src")
+    files = {name: _makeFile(os.path.join("src", name), size) for name, size in (("x.bin", 500000), ("y.bin", 70000))}
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    names = list(files)
+    server.setOnMsgRecvByOpCodeCallback(12, lambda conn, msg: (server.sendfilesStriped(
+        conn, [os.path.join("src", name) for name in names], names, stripes=2), True)[1])
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        client.sendmsg(Message.HeaderOnlyMsg(12))
+        received = client.recvfilesStriped()
+    finally:
+        client.close()
+    assert sorted(os.path.basename(path) for path in received) == sorted(names)
+    for path in received:
+        with open(path, 'rb') as fp:
+            assert fp.read() == files[os.path.basename(path)]
+
+
+class _TruncatedFile(io.BytesIO):
+    """读取到limit字节后返回空数据, 模拟传输中途断开"""
+
+    def __init__(self, data: bytes, limit: int):
+        super().__init__(data)
+        self.limit = limit
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.limit - self.tell() if size < 0 else min(size, self.limit - self.tell())
+        return super().read(max(size, 0))
+
+
+class _TrackedFile(io.BytesIO):
+    """记录第一次读取的位置"""
+    first_read = None
+
+    def read(self, size: int = -1) -> bytes:
+        if self.first_read is None:
+            self.first_read = self.tell()
+        return super().read(size)
+
+
+class _SizeSink(CallbackSink):
+    def __init__(self):
+        self.chunks = []
+        self.filesize = None
+        super().__init__(lambda data: self.chunks.append(bytes(data)))
+
+    def open(self, filename: str, filesize: int, resume: bool) -> int:
+        self.filesize = filesize
+        return super().open(filename, filesize, resume)
+
+
+def test_v2_header_carries_64_bit_sizes_and_start_offsets(workdir):
+    size = 5 * 1024 ** 3 + 10  # 超过4 GiB
+    with open("sparse.bin", 'wb') as fp:
+        fp.seek(size - 10)
+        fp.write(b"0123456789")
+    sink = _SizeSink()
+
+    def send(sock):
+        with open("sparse.bin", 'rb') as fp:
+            sock.sendFile(fp, "sparse.bin", offset=size - 10)
+    assert _transfer(send, lambda sock: sock.recvFile(sink)) == "sparse.bin"
+    assert sink.filesize == size
+    assert b"".join(sink.chunks) == b"0123456789"  # 只发送offset之后的部分
+
+
+def test_interrupted_transfer_resumes_from_the_received_bytes(workdir):
+    data = os.urandom(1024 * 1024)
+    assert _transfer(lambda sock: sock.sendFile(_TruncatedFile(data, 600000), "r.bin", resume=True),
+                     lambda sock: sock.recvFile()) == ""
+    part = os.path.join(SocketConfig.DEFAULT_DOWNLOAD_PATH, "r.bin.part")
+    assert os.path.getsize(part) == 600000 and os.path.exists(part + ".have")
+    source = _TrackedFile(data)
+    path = _transfer(lambda sock: sock.sendFile(source, "r.bin", resume=True), lambda sock: sock.recvFile())
+    assert source.first_read == 600000  # 只发送剩余部分
+    with open(path, 'rb') as fp:
+        assert fp.read() == data
+    assert not os.path.exists(part) and not os.path.exists(part + ".have")
+
+
+@pytest.mark.parametrize("have", [None, 100000])
+def test_resume_after_a_killed_receiver_trusts_only_the_recorded_count(workdir, have):
+    data = os.urandom(1024 * 1024)
+    os.makedirs(SocketConfig.DEFAULT_DOWNLOAD_PATH)
+    part = os.path.join(SocketConfig.DEFAULT_DOWNLOAD_PATH, "k.bin.part")
+    with open(part, 'wb') as fp:  # 预分配为完整大小的.part文件, 只有开头部分是收到的数据
+        fp.write(data[:have or 0])
+        fp.truncate(len(data))
+    if have is not None:
+        with open(part + ".have", 'wb') as fp:
+            fp.write(have.to_bytes(8, 'little'))
+    source = _TrackedFile(data)
+    path = _transfer(lambda sock: sock.sendFile(source, "k.bin", resume=True), lambda sock: sock.recvFile())
+    assert source.first_read == (have or 0)  # 没有记录时从头接收
+    with open(path, 'rb') as fp:
+        assert fp.read() == data
+
+
+def test_receive_into_file_objects_callbacks_buffers_and_custom_paths(workdir):
+    data = os.urandom(300000)
+
+    def send(sock):
+        sock.sendFile(io.BytesIO(data), "sink.bin")
+    out = io.BytesIO()
+    assert _transfer(send, lambda sock: sock.recvFile(FileObjSink(out))) == "sink.bin"
+    assert out.getvalue() == data
+    digest = hashlib.sha256()
+    assert _transfer(send, lambda sock: sock.recvFile(CallbackSink(digest.update))) == "sink.bin"
+    assert digest.digest() == hashlib.sha256(data).digest()  # 不落盘直接计算哈希
+    buf = bytearray(len(data) + 10)
+    assert _transfer(send, lambda sock: sock.recvFile(BufferSink(buf))) == "sink.bin"
+    assert bytes(buf[:len(data)]) == data
+    path = _transfer(send, lambda sock: sock.recvFile(PathSink(lambda name: os.path.join("custom", "x-" + name))))
+    assert path == os.path.join("custom", "x-sink.bin")
+    with open(path, 'rb') as fp:
+        assert fp.read() == data
+
+
+def test_buffer_sink_rejects_a_file_larger_than_the_buffer(workdir):
+    with pytest.raises(ValueError):
+        _transfer(lambda sock: sock.sendFile(io.BytesIO(b"x" * 100), "big.bin"),
+                  lambda sock: sock.recvFile(BufferSink(bytearray(10))))
+
+
+def test_compressed_file_transfer(workdir):
+    data = b"compressible line\n" * 100000 + os.urandom(100000)  # 可压缩和不可压缩的块都有
+    out = io.BytesIO()
+    assert _transfer(lambda sock: sock.sendFile(io.BytesIO(data), "z.bin", codec=Codec.ZLIB),
+                     lambda sock: sock.recvFile(FileObjSink(out))) == "z.bin"
+    assert out.getvalue() == data
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import time
+import pytest
+from ..hserver import *
+from ..hclient import *
+from .conftest import freePort, waitFor, connectClient
+
+
+def _echo(conn, msg):
+    conn.sendMsg(msg)
+    return True
+
+
+def _isRejected(sock: socket.socket, timeout: float = 0.3) -> bool:
+    """连接是否收到了连接数已满的拒绝帧, 超时没有数据视为已被接受"""
+    sock.settimeout(timeout)
+    try:
+        data = sock.recv(1024)
+    except TimeoutError:
+        return False
+    msgs = MessageDecoder().feed(data)
+    return bool(msgs) and (msgs[0].opcode(), msgs[0].statuscode()) == \
+        (BuiltInOpCode.REJECTED, RejectReason.CONNECTIONS_FULL)
+
+
+def test_max_connections_rejects_a_burst_and_frees_slots_on_close(server_cls, serve):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.set_max_connections(3)
+    server.setOnMsgRecvByOpCodeCallback(1, _echo)
+    serve(server, port)
+    for _ in range(2):  # 关闭后名额被释放, 第二轮同样接受3个
+        client = connectClient(port)  # 连接按顺序接受, 得到回复时serve()的探测连接也已被接受
+        client.request(Message.HeaderOnlyMsg(1))
+        client.close()
+        assert waitFor(lambda: not server.connections())  # 等待之前的连接都被移除
+        socks = [socket.create_connection(("127.0.0.1", port), timeout=5) for _ in range(10)]
+        try:
+            time.sleep(0.3)
+            assert sum(not _isRejected(sock) for sock in socks) == 3
+        finally:
+            for sock in socks:
+                sock.close()
+
+
+@pytest.mark.parametrize("pooled", [False, True], ids=["inline", "pooled"])
+def test_handler_closing_its_connection_releases_the_slot(serve, pooled):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.set_max_connections(2)
+    if pooled:
+        server.setWorkerPool(2)
+
+    def bye(conn, msg):
+        server.subscribe(conn, "t")
+        conn.sendMsg(Message.PlainTextMsg(2, 0, "bye"))
+        conn.close()
+        return True
+    server.setOnMsgRecvByOpCodeCallback(2, bye, pooled=pooled)
+    serve(server, port)
+    for _ in range(5):
+        client = connectClient(port)
+        try:
+            assert client.request(Message.PlainTextMsg(2, 0, "x")).content() == "bye"
+        finally:
+            client.close()
+    assert waitFor(lambda: not server.connections())
+    assert not server.subscribers("t")
+
+
+def test_accept_storm_is_drained_with_a_large_backlog(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.set_backlog(1024)
+    server.setOnMsgRecvByOpCodeCallback(1, _echo)
+    serve(server, port)
+    socks = [socket.create_connection(("127.0.0.1", port), timeout=5) for _ in range(100)]
+    try:
+        for i, sock in enumerate(socks):
+            sock.sendall(Message.PlainTextMsg(1, 0, str(i)).toBytes())
+        for i, sock in enumerate(socks):
+            msgs = []
+            decoder = MessageDecoder()
+            while not msgs:
+                data = sock.recv(1024)
+                assert data
+                msgs = decoder.feed(data)
+            assert msgs[0].content() == str(i)
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+def test_accept_pause_leaves_new_connections_queued(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    paused = threading.Event()
+    server.set_accept_pause(check=paused.is_set)
+    server.setOnMsgRecvByOpCodeCallback(1, _echo)
+    serve(server, port)
+    assert waitFor(lambda: not server.connections())
+    paused.set()
+    time.sleep(0.2)
+    client = connectClient(port)  # 连接留在监听队列中
+    try:
+        future = client.submit(Message.PlainTextMsg(1, 0, "queued"), timeout=5)
+        time.sleep(0.3)
+        assert not future.done() and not server.connections()
+        paused.clear()
+        assert future.result(5).content() == "queued"
+    finally:
+        client.close()
+
+
+def _flood(port: int, msgs: list[Message], shutdown: bool = False) -> socket.socket:
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    sock.sendall(b"".join(msg.toBytes() for msg in msgs))
+    if shutdown:
+        sock.shutdown(socket.SHUT_WR)
+    return sock
+
+
+def _counting(server, opcode: int, pooled: bool = False) -> list[tuple[float, Message]]:
+    handled = []
+    server.setOnMsgRecvByOpCodeCallback(opcode, lambda conn, msg: (handled.append((time.monotonic(), msg)), True)[1],
+                                        pooled=pooled)
+    return handled
+
+
+def test_rate_limit_drop_sheds_excess_messages_per_opcode(server_cls, serve):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.set_rate_limit(msgs_per_sec=10, action=RateLimitAction.DROP, opcode=2)
+    limited, free = _counting(server, 2), _counting(server, 1)
+    serve(server, port)
+    msgs = [Message.PlainTextMsg(op, 0, str(i)) for i in range(100) for op in (2, 1)]
+    with _flood(port, msgs):
+        assert waitFor(lambda: len(free) == 100)  # 其他操作码不受限制
+        time.sleep(0.1)
+    assert 5 <= len(limited) < 30
+    assert server.metrics().snapshot()["counters"]["ratelimit.drop"] == 100 - len(limited)
+
+
+def test_rate_limit_reject_replies_with_the_request_id(server_cls, serve):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.set_rate_limit(msgs_per_sec=10, action=RateLimitAction.REJECT)
+    server.setOnMsgRecvByOpCodeCallback(1, _echo)
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        replies = [f.result(5) for f in [client.submit(Message.PlainTextMsg(1, 0, str(i)), timeout=5) for i in range(50)]]
+    finally:
+        client.close()
+    rejected = [msg for msg in replies if msg.opcode() == BuiltInOpCode.REJECTED]
+    assert rejected and all(msg.statuscode() == RejectReason.RATE_LIMITED for msg in rejected)
+    assert len(replies) - len(rejected) < 20  # 令牌桶只允许约1秒的突发量
+
+
+def test_rate_limit_delay_paces_a_pipelined_batch(server_cls, serve):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.set_rate_limit(msgs_per_sec=50, action=RateLimitAction.DELAY)
+    handled = _counting(server, 2)
+    serve(server, port)
+    start = time.monotonic()
+    with _flood(port, [Message.PlainTextMsg(2, 0, str(i)) for i in range(100)], shutdown=True):  # 发送完立即关闭
+        assert waitFor(lambda: len(handled) == 100, 5)  # 推迟的数据包在对端关闭后也会被处理
+    times = [t - start for t, _ in handled]
+    assert [msg.content() for _, msg in handled] == [str(i) for i in range(100)]
+    assert 0.7 < times[-1] < 2.5  # 超出突发量的50个数据包按每秒50个处理
+    assert times[75] - times[50] > 0.3  # 均匀分布, 不是一次性处理
+
+
+@pytest.mark.parametrize("action", [RateLimitAction.REJECT, RateLimitAction.DELAY], ids=lambda action: action.name)
+def test_max_inflight_caps_queued_pool_work(serve, action):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.setWorkerPool(4)
+    server.set_max_inflight(2, action)
+
+    def slow(conn, msg):
+        time.sleep(0.05)  # 同一连接的数据包在线程池中排队
+        conn.sendMsg(msg)
+        return True
+    server.setOnMsgRecvByOpCodeCallback(1, slow, pooled=True)
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        replies = [f.result(5) for f in [client.submit(Message.PlainTextMsg(1, 0, str(i)), timeout=5) for i in range(10)]]
+    finally:
+        client.close()
+    rejected = [msg for msg in replies if msg.opcode() == BuiltInOpCode.REJECTED]
+    if action == RateLimitAction.REJECT:
+        assert rejected and all(msg.statuscode() == RejectReason.TOO_MANY_INFLIGHT for msg in rejected)
+    else:  # 暂停读取, 全部数据包最终都被处理
+        assert [msg.content() for msg in replies] == [str(i) for i in range(10)]
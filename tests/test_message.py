@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import threading
+from ..message import *
+from ..hsocket import HTcpSocket, SocketConfig, sendmsgAll
+from .conftest import socketPair
+
+
+def _frames() -> list[Message]:
+    msg = Message.JsonMsg(7, 1, a=1, b="x")
+    msg.setRequestId(42)
+    return [Message.PlainTextMsg(1, 0, "hello"), Message.HeaderOnlyMsg(2, 3), msg,
+            Message.BinaryMsg(4, 0, bytes(range(256)) * 4)]
+
+
+def _same(a: Message, b: Message) -> bool:
+    return (a.opcode(), a.statuscode(), a.contenttype(), a.requestid(), bytes(a.toBytes())) == \
+        (b.opcode(), b.statuscode(), b.contenttype(), b.requestid(), bytes(b.toBytes()))
+
+
+def test_decoder_reassembles_frames_split_at_every_byte():
+    frames = _frames()
+    data = b"".join(msg.toBytes() for msg in frames)
+    decoder = MessageDecoder()
+    got = []
+    for i in range(len(data)):  # 每次只送入一个字节
+        buf = decoder.buffer()
+        buf[:1] = data[i:i + 1]
+        msg = decoder.advance(1)
+        if msg is not None:
+            got.append(msg)
+    assert not decoder.pending()
+    assert len(got) == len(frames)
+    assert all(_same(a, b) for a, b in zip(got, frames))
+
+
+def test_decoder_feed_keeps_a_truncated_tail_for_the_next_call():
+    frames = _frames()
+    data = b"".join(msg.toBytes() for msg in frames)
+    decoder = MessageDecoder()
+    cut = len(data) - 10
+    first = decoder.feed(data[:cut])
+    assert decoder.pending()
+    rest = decoder.feed(data[cut:])
+    got = first + rest
+    assert [msg.opcode() for msg in got] == [msg.opcode() for msg in frames]
+    assert got[2].get("b") == "x" and got[2].requestid() == 42
+
+
+def test_recv_msg_round_trip_and_binary_body_is_not_copied():
+    a, b = socketPair()
+    with a, b:
+        frames = _frames()
+        sender = threading.Thread(target=lambda: [a.sendMsg(msg) for msg in frames])
+        sender.start()
+        got = [b.recvMsg() for _ in frames]
+        sender.join()
+        assert all(_same(x, y) for x, y in zip(got, frames))
+        assert isinstance(got[3].content(), memoryview)
+        a.close()
+        assert not b.recvMsg().isValid()  # 对端关闭时返回空Message
+
+
+def test_json_is_parsed_on_first_get_and_forwarded_without_reencoding(monkeypatch):
+    calls = {"loads": 0, "dumps": 0}
+
+    def counted(name, func):
+        def wrapper(arg):
+            calls[name] += 1
+            return func(arg)
+        return wrapper
+    monkeypatch.setattr(MessageConfig, "JSON_LOADS", counted("loads", MessageConfig.JSON_LOADS))
+    monkeypatch.setattr(MessageConfig, "JSON_DUMPS", counted("dumps", MessageConfig.JSON_DUMPS))
+    wire = Message.JsonMsg(5, 0, a=1, b=[1, 2]).toBytes()
+    assert calls["dumps"] == 1
+    msg = MessageDecoder().feed(wire)[0]
+    assert msg.opcode() == 5 and calls["loads"] == 0  # 只读取报头时不解析
+    assert msg.toBytes() == wire and calls["dumps"] == 1  # 原样转发时不重新编码
+    assert msg.get("a") == 1 and msg.get("b") == [1, 2]
+    assert calls["loads"] == 1
+    msg.set("a", 2)
+    assert MessageDecoder().feed(msg.toBytes())[0].get("a") == 2  # set()之后重新编码
+    msg.toBytes()
+    assert calls["dumps"] == 2  # 编码结果被缓存
+
+
+def test_json_codec_is_pluggable(monkeypatch):
+    monkeypatch.setattr(MessageConfig, "JSON_DUMPS", lambda obj: b'{"fixed": true}')  # 返回bytes的编码器
+    msg = MessageDecoder().feed(Message.JsonMsg(1, 0, a=1).toBytes())[0]
+    assert msg.get("fixed") is True and msg.get("a") is None
+
+
+def test_header_round_trip_with_and_without_request_id():
+    for requestid in (None, 0, 0xFFFFFFFF):
+        header = Header(ContentType.BINARY, 0xFFFF, 7, 123456, requestid, Codec.ZLIB)
+        data = header.toBytes()
+        assert len(data) == Header.HEADER_LENGTH + header.extensionLength()
+        parsed = Header.fromBytes(data[:Header.HEADER_LENGTH])
+        parsed.readExtension(data[Header.HEADER_LENGTH:])
+        assert (parsed.contenttype, parsed.opcode, parsed.statuscode, parsed.length, parsed.requestid, parsed.codec) == \
+            (ContentType.BINARY, 0xFFFF, 7, 123456, requestid, Codec.ZLIB)
+    assert Header.fromBytes(b"short") is None
+    assert not hasattr(header, "__dict__") and not hasattr(Message(), "__dict__")  # 使用__slots__
+
+
+def test_decode_many_parses_every_complete_frame_and_reports_consumed_bytes():
+    frames = _frames()
+    data = b"".join(msg.toBytes() for msg in frames)
+    msgs, consumed = Message.decodeMany(data + data[:12])  # 末尾是不完整的数据包
+    assert consumed == len(data)
+    assert all(_same(a, b) for a, b in zip(msgs, frames)) and len(msgs) == len(frames)
+    msgs, consumed = Message.decodeMany(data, header_filter=lambda header: header.opcode != 4)
+    assert consumed == len(data)
+    assert [msg.opcode() for msg in msgs] == [1, 2, 7]  # 被过滤的数据包被跳过
+    assert Message.fromBytes(frames[2].toBytes()).get("a") == 1
+
+
+def test_to_buffers_does_not_copy_the_body():
+    body = bytes(1 << 20)
+    header, content = Message.BinaryMsg(1, 0, body).toBuffers()
+    assert content is body and len(header) == Header.HEADER_LENGTH
+
+
+def test_send_msgs_batches_many_frames_into_few_syscalls(monkeypatch):
+    calls = []
+    sendmsg = HTcpSocket.sendmsg
+    monkeypatch.setattr(HTcpSocket, "sendmsg", lambda self, buffers, *args: (calls.append(len(buffers)), sendmsg(self, buffers, *args))[1])
+    frames = [Message.PlainTextMsg(1, 0, str(i)) for i in range(2000)] + [Message.BinaryMsg(2, 0, bytes(300000))]
+    a, b = socketPair()
+    with a, b:
+        sender = threading.Thread(target=a.sendMsgs, args=(frames,))  # 大数据包会写满内核缓冲区, 需要分多次发送
+        sender.start()
+        got = [b.recvMsg() for _ in frames]
+        sender.join()
+    assert [msg.content() for msg in got[:-1]] == [str(i) for i in range(2000)]
+    assert bytes(got[-1].content()) == bytes(300000)
+    assert len(calls) < 50 and max(calls) <= SocketConfig.IOV_MAX
+
+
+def test_sendmsg_all_handles_empty_and_partially_sent_buffers():
+    buffers = [os.urandom(n) for n in (0, 1, 7000, 0, 5, 20000)] * 300  # 缓冲区数超过IOV_MAX
+    expected = b"".join(buffers)
+    a, b = socket.socketpair()
+    with a, b:
+        sender = threading.Thread(target=sendmsgAll, args=(a, buffers))
+        sender.start()
+        received = bytearray()
+        while len(received) < len(expected):
+            received += b.recv(1 << 20)
+        sender.join()
+    assert bytes(received) == expected
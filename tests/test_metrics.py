@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import threading
+from ..metrics import Metrics
+from ..hserver import *
+from .conftest import freePort, connectClient
+
+
+def test_counters_and_histograms_merge_across_threads():
+    metrics = Metrics()
+
+    def work():
+        for value in range(1000):
+            metrics.inc("msgs_in")
+            metrics.observe("handler_us", value, 1)
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    metrics.inc("msgs_in")  # 已结束线程的分片也被计入
+    metrics.setGauge("connections", lambda: 3)
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["msgs_in"] == 4001
+    assert snapshot["gauges"]["connections"] == 3
+    hist = snapshot["histograms"]["handler_us"]["1"]
+    assert hist["count"] == 4000 and hist["sum"] == 4 * sum(range(1000))
+    assert 499 <= hist["p50"] <= 1023 and hist["max"] == 1023  # 分位数为所在2的幂桶的上界
+    metrics.reset()
+    assert not metrics.snapshot()["counters"]
+
+
+def test_server_reports_stats_to_clients(server_cls, serve):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        for i in range(20):
+            client.request(Message.PlainTextMsg(1, 0, str(i)))
+        stats = client.requestStats()
+    finally:
+        client.close()
+    assert stats["counters"]["msgs_in"] >= 20 and stats["counters"]["msgs_out"] >= 20
+    assert stats["counters"]["bytes_in"] > 0 and stats["gauges"]["connections"] >= 1
+    assert stats["histograms"]["handler_us"]["1"]["count"] == 20
+    client_stats = client.metrics().snapshot()
+    assert client_stats["histograms"]["request_us"]["1"]["count"] == 20
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+from ..profiler import Profiler
+from ..hserver import *
+from .conftest import freePort, connectClient
+
+
+def test_spans_nest_only_inside_sampled_operations():
+    profiler = Profiler()
+    assert not profiler.sample()
+    with profiler.span("outside"):  # 未开启时不在被选中的操作之内
+        assert not profiler.tracing()
+    profiler.start(sample_rate=0.0)
+    assert not profiler.sample()
+    profiler.start()
+    assert profiler.sample()
+    with profiler.span("read"):
+        assert profiler.tracing()
+        with profiler.span("decode"):
+            time.sleep(0.001)
+    summary = profiler.summary()
+    assert set(summary) == {"read", "decode"}  # start()清空了之前的记录
+    assert summary["read"]["total_us"] >= summary["decode"]["total_us"] >= 1000
+    profiler.stop()
+    assert not profiler.sample()
+    profiler.start(duration=0.01)
+    time.sleep(0.02)
+    assert not profiler.active()  # 时间窗口结束后自动停止
+
+
+def test_max_events_drops_new_spans():
+    profiler = Profiler(max_events=3)
+    profiler.start()
+    for _ in range(5):
+        with profiler.span("x"):
+            pass
+    assert len(profiler.events()) == 3 and profiler.dropped() == 2
+
+
+def test_cprofile_runs_only_one_callback_at_a_time():
+    profiler = Profiler()
+    profiler.start(cprofile=True)
+    inside = threading.Event()
+    release = threading.Event()
+
+    def busy():
+        with profiler.span("slow_callback", "callback"):
+            inside.set()
+            release.wait(5)
+            sum(range(10000))
+    th = threading.Thread(target=busy)
+    th.start()
+    assert inside.wait(5)
+    with profiler.span("other_callback", "callback"):  # 重叠的回调只记录区间, 不抛出
+        pass
+    release.set()
+    th.join()
+    stats = profiler.cprofileStats()
+    assert stats is not None
+    assert {"slow_callback", "other_callback"} <= set(profiler.summary())
+
+
+def test_server_profile_exports_a_chrome_trace(server_cls, serve, tmp_path):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+
+    def echo(conn, msg):
+        conn.sendMsg(msg)
+        return True
+    server.setOnMsgRecvByOpCodeCallback(1, echo)
+    serve(server, port)
+    server.profiler().start()
+    client = connectClient(port)
+    try:
+        for i in range(10):
+            client.request(Message.PlainTextMsg(1, 0, str(i)))
+    finally:
+        client.close()
+    server.profiler().stop()
+    names = set(server.profiler().summary())
+    assert {"dispatch", "send"} <= names and any("echo" in name for name in names)
+    path = str(tmp_path / "trace.json")
+    server.profiler().exportChromeTrace(path)
+    with open(path, encoding="utf-8") as fp:
+        trace = json.load(fp)
+    events = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+    assert events and all(event["dur"] >= 0 for event in events)
+    assert any(event["ph"] == "M" for event in trace["traceEvents"])  # 线程名
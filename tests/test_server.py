@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+import zlib
+import pytest
+from ..hserver import *
+from ..hclient import *
+from .conftest import freePort, waitFor, connectClient
+
+
+def _recvMsgs(sock: socket.socket, count: int) -> list[Message]:
+    decoder = MessageDecoder()
+    msgs = []
+    while len(msgs) < count:
+        data = sock.recv(65536)
+        assert data, "connection closed early"
+        msgs.extend(decoder.feed(data))
+    return msgs
+
+
+def test_pipelined_frames_in_one_write_are_all_answered_in_order(echo_server):
+    server, port = echo_server
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(b"".join(Message.PlainTextMsg(1, 0, str(i)).toBytes() for i in range(200)))
+        replies = _recvMsgs(sock, 200)
+    assert [msg.content() for msg in replies] == [str(i) for i in range(200)]
+
+
+def test_send_queue_keeps_order_when_the_kernel_buffer_is_full():
+    a, b = socket.socketpair()
+    with a, b:
+        a.setblocking(False)
+        pending = []
+        queue = SendQueue(a, pending.append)
+        chunks = [bytes([i]) * 100000 for i in range(20)]
+        for chunk in chunks:
+            queue.put(chunk)
+        assert pending and queue.size() > 0  # 内核缓冲区写满, 剩余部分排队
+        received = bytearray()
+        total = sum(map(len, chunks))
+        b.settimeout(5)
+        while len(received) < total:
+            received += b.recv(1 << 20)
+            queue.flush()
+        assert queue.size() == 0
+        assert bytes(received) == b"".join(chunks)
+
+
+def test_send_queue_records_peer_errors_instead_of_raising():
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    b.close()
+    queue = SendQueue(a)
+    queue.put(b"x" * 1000)  # 对端已关闭, 不应抛出
+    queue.put(b"y")
+    assert isinstance(queue.error(), OSError)
+    with pytest.raises(OSError):
+        queue.flush()
+    a.close()
+
+
+def test_selector_server_survives_a_peer_that_resets_before_its_reply(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    replied = threading.Event()
+
+    def slow(conn, msg):
+        time.sleep(0.2)  # 对端在回复之前重置连接
+        for _ in range(20):
+            conn.sendMsg(Message.BinaryMsg(2, 0, b"x" * 100000))
+        replied.set()
+        return True
+    server.setOnMsgRecvByOpCodeCallback(2, slow)
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    serve(server, port)
+    raw = socket.create_connection(("127.0.0.1", port))
+    raw.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))  # close时发送RST
+    raw.sendall(Message.HeaderOnlyMsg(2).toBytes())
+    time.sleep(0.05)
+    raw.close()
+    assert replied.wait(5)
+    client = connectClient(port)
+    try:
+        assert client.request(Message.PlainTextMsg(1, 0, "alive")).content() == "alive"
+    finally:
+        client.close()
+
+
+def test_slow_reader_gets_every_queued_reply(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.set_send_high_water(256 * 1024)
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    serve(server, port)
+    body = b"z" * 50000
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        data = b"".join(Message.BinaryMsg(1, 0, body).toBytes() for _ in range(100))
+        sender = threading.Thread(target=sock.sendall, args=(data,))  # server暂停读取时sendall会阻塞
+        sender.start()
+        time.sleep(0.3)  # 不读取, 让server的发送队列积压
+        replies = _recvMsgs(sock, 100)
+        sender.join()
+    assert all(bytes(msg.content()) == body for msg in replies)
+
+
+def test_request_reply_on_one_connection(echo_server):
+    server, port = echo_server
+    client = connectClient(port)
+    try:
+        for i in range(50):
+            assert client.request(Message.PlainTextMsg(1, 0, str(i))).content() == str(i)
+    finally:
+        client.close()
+
+
+def test_selector_does_not_reregister_connections_per_message(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        client.request(Message.PlainTextMsg(1, 0, "warmup"))
+        selector = server._HTcpSelectorServer__selector.selector
+        calls = []
+        modify = selector.modify
+        selector.modify = lambda *args: (calls.append(args), modify(*args))[1]
+        for i in range(100):
+            assert client.request(Message.PlainTextMsg(1, 0, str(i))).content() == str(i)
+        assert len(calls) < 10  # 小回复直接写入内核缓冲区, 不需要关注可写事件
+    finally:
+        client.close()
+
+
+def test_pooled_handlers_run_off_the_io_thread_and_keep_per_connection_order(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.setWorkerPool(4)
+    seen = []
+
+    def slow(conn, msg):
+        seen.append((threading.current_thread().name, msg.content()))
+        time.sleep(0.01)
+        conn.sendMsg(msg)
+        return True
+    server.setOnMsgRecvByOpCodeCallback(2, slow, pooled=True)
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    serve(server, port)
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(b"".join(Message.PlainTextMsg(2, 0, str(i)).toBytes() for i in range(20)))
+        other = connectClient(port)
+        try:  # 线程池中的慢回调不阻塞I/O线程处理其他连接
+            start = time.monotonic()
+            assert other.request(Message.PlainTextMsg(1, 0, "fast")).content() == "fast"
+            assert time.monotonic() - start < 0.15
+        finally:
+            other.close()
+        replies = _recvMsgs(sock, 20)
+    assert [msg.content() for msg in replies] == [str(i) for i in range(20)]
+    assert all(name.startswith("hserver-worker") for name, _ in seen)
+
+
+@pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"), reason="SO_REUSEPORT is not supported")
+def test_worker_processes_share_the_port_and_are_restarted(server_cls):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(Message.JsonMsg(1, 0, pid=os.getpid())), True)[1])
+    supervisor = threading.Thread(target=server.startworkers, args=(2,), daemon=True)
+    supervisor.start()
+
+    def workerPid() -> Optional[int]:
+        try:
+            client = connectClient(port, timeout=2)
+        except OSError:
+            return None
+        try:
+            reply = client.request(Message.HeaderOnlyMsg(1))
+            return reply.get("pid") if reply.isValid() and reply.contenttype() == ContentType.JSONOBJRCT else None
+        finally:
+            client.close()
+    try:
+        pids = set()
+        assert waitFor(lambda: workerPid() is not None, 10)
+        for _ in range(20):
+            pids.add(workerPid())
+        pids.discard(None)
+        assert pids and os.getpid() not in pids
+        os.kill(next(iter(pids)), signal.SIGKILL)
+        assert waitFor(lambda: workerPid() not in pids | {None}, 10)  # 监督进程启动了新的工作进程
+    finally:
+        server.closeserver()
+        supervisor.join(10)
+
+
+def _recvRaw(sock: socket.socket) -> tuple[Header, bytes]:
+    """接收一个数据包, 返回报头和未解压的正文"""
+    def recvExactly(size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            assert chunk, "connection closed early"
+            data += chunk
+        return data
+    header = Header.fromBytes(recvExactly(Header.HEADER_LENGTH))
+    header.readExtension(recvExactly(header.extensionLength()))
+    return header, recvExactly(header.length)
+
+
+def test_negotiated_compression_round_trip(server_cls, serve):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(Message.JsonMsg(1, 0, items=msg.get("items"))), True)[1])
+    serve(server, port)
+    client = connectClient(port)
+    try:
+        assert client.negotiateCompression() == Codec.ZLIB
+        items = [{"id": i, "name": "item"} for i in range(500)]
+        assert client.request(Message.JsonMsg(1, 0, items=items)).get("items") == items
+    finally:
+        client.close()
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:  # 检查线路上的数据确实被压缩
+        sock.sendall(Message.JsonMsg(BuiltInOpCode.COMPRESSION, codecs=[Codec.ZLIB]).toBytes())
+        header, body = _recvRaw(sock)
+        assert header.opcode == BuiltInOpCode.COMPRESSION
+        sock.sendall(Message.JsonMsg(1, 0, items=items).toBytes(Codec.ZLIB))
+        header, body = _recvRaw(sock)
+        assert header.codec == Codec.ZLIB and len(body) < len(Message.JsonMsg(1, 0, items=items).toBytes()) // 5
+        assert MessageConfig.JSON_LOADS(Codec.decompress(Codec.ZLIB, body))["items"] == items
+
+
+@pytest.mark.parametrize("body", [b"not zlib data" * 100, None], ids=["corrupt", "bomb"])
+def test_bad_compressed_frames_close_only_that_peer(server_cls, serve, monkeypatch, body):
+    monkeypatch.setattr(MessageConfig, "MAX_DECOMPRESSED_SIZE", 1024 * 1024)
+    if body is None:
+        body = zlib.compress(b"\0" * (4 * 1024 * 1024))  # 解压后超过上限
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(1, lambda conn, msg: (conn.sendMsg(msg), True)[1])
+    serve(server, port)
+    header = Header(ContentType.BINARY, 1, 0, len(body), codec=Codec.ZLIB)
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(header.toBytes() + body)
+        try:
+            assert sock.recv(1) == b""  # server关闭了该连接
+        except ConnectionResetError:
+            pass
+    client = connectClient(port)
+    try:
+        assert client.request(Message.PlainTextMsg(1, 0, "alive")).content() == "alive"
+    finally:
+        client.close()
+
+
+def _subscribed(server, port: int, topic: str, count: int) -> list[socket.socket]:
+    """建立count个订阅了topic的连接"""
+    socks = []
+    for _ in range(count):
+        sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+        sock.sendall(Message.PlainTextMsg(20, 0, topic).toBytes())
+        assert _recvMsgs(sock, 1)[0].opcode() == 20
+        socks.append(sock)
+    return socks
+
+
+def _pubsubServer(server_cls, serve):
+    port = freePort()
+    server = server_cls(("127.0.0.1", port))
+    server.setOnMsgRecvByOpCodeCallback(20, lambda conn, msg: (server.subscribe(conn, msg.content()),
+                                                               conn.sendMsg(Message.HeaderOnlyMsg(20)), True)[2])
+    serve(server, port)
+    return server, port
+
+
+def test_publish_and_broadcast_encode_once(server_cls, serve, monkeypatch):
+    server, port = _pubsubServer(server_cls, serve)
+    news = _subscribed(server, port, "news", 3)
+    other = _subscribed(server, port, "other", 1)
+    try:
+        encoded = []
+        toBuffers = Message.toBuffers
+        monkeypatch.setattr(Message, "toBuffers", lambda self, *args: (encoded.append(self), toBuffers(self, *args))[1])
+        assert server.publish("news", Message.PlainTextMsg(21, 0, "headline")) == 3
+        assert len(encoded) == 1  # 只编码一次
+        assert all(_recvMsgs(sock, 1)[0].content() == "headline" for sock in news)
+        assert server.broadcast(Message.PlainTextMsg(22, 0, "all")) == 4
+        assert all(_recvMsgs(sock, 1)[0].content() == "all" for sock in news + other)
+        news[0].close()
+        assert waitFor(lambda: len(server.subscribers("news")) == 2)  # 连接断开时自动取消订阅
+        server.unsubscribe(server.subscribers("news")[0])
+        assert len(server.subscribers("news")) == 1
+    finally:
+        for sock in news + other:
+            sock.close()
+
+
+@pytest.mark.parametrize("policy", list(SlowConsumerPolicy), ids=lambda policy: policy.name)
+def test_slow_consumer_policies(serve, policy):
+    server, port = _pubsubServer(HTcpSelectorServer, serve)
+    server.set_slow_consumer_policy(policy, limit=256 * 1024)
+    slow, = _subscribed(server, port, "ticks", 1)
+    with slow:
+        delivered = [server.publish("ticks", Message.BinaryMsg(23, i, bytes(64 * 1024))) for i in range(200)]
+        if policy != SlowConsumerPolicy.CONFLATE:  # 合并的数据包也算作已排队
+            assert 0 < sum(delivered) < 200  # 不读取的连接的发送队列很快超过上限
+        if policy == SlowConsumerPolicy.DISCONNECT:
+            assert waitFor(lambda: not server.subscribers("ticks"))
+            return
+        decoder = MessageDecoder()
+        got = []
+        slow.settimeout(0.5)
+        try:
+            while True:
+                data = slow.recv(1 << 20)
+                if not data:
+                    break
+                got.extend(msg.statuscode() for msg in decoder.feed(data))
+        except TimeoutError:
+            pass
+        assert len(got) < 200 and got == sorted(got)
+        if policy == SlowConsumerPolicy.CONFLATE:
+            assert got[-1] == 199  # 只保留了最新的一条
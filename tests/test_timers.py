@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import socket
+import time
+from ..timerwheel import TimerWheel
+from ..hserver import *
+from ..hclient import *
+from .conftest import freePort, waitFor
+
+
+def _runWheel(wheel: TimerWheel, seconds: float):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        time.sleep(wheel.timeout() or 0.001)
+        wheel.advance()
+
+
+def test_timer_wheel_fires_in_order_across_rounds_and_skips_cancelled():
+    wheel = TimerWheel(tick=0.01, slots=8)  # 一圈0.08秒, 之后的定时器需要转过多圈
+    assert wheel.timeout() is None
+    fired = []
+    for delay in (0.25, 0.02, 0.13):
+        wheel.schedule(delay, fired.append, delay)
+    cancelled = wheel.schedule(0.05, fired.append, "cancelled")
+    removed = wheel.schedule(0.05, fired.append, "removed")
+    cancelled.cancel()
+    wheel.cancel(removed)
+    assert len(wheel) == 4  # cancel()立即移除, Timer.cancel()到期时才跳过
+    start = time.monotonic()
+    _runWheel(wheel, 0.1)
+    assert fired == [0.02]
+    _runWheel(wheel, 0.25)
+    assert fired == [0.02, 0.13, 0.25] and len(wheel) == 0
+    assert time.monotonic() - start >= 0.25
+
+
+def test_timer_callback_exception_does_not_stop_the_wheel():
+    wheel = TimerWheel(tick=0.01)
+    fired = []
+    wheel.schedule(0.01, lambda: 1 / 0)
+    wheel.schedule(0.01, fired.append, "ok")
+    _runWheel(wheel, 0.05)
+    assert fired == ["ok"]
+
+
+def test_idle_connections_are_closed(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.set_idle_timeout(0.3)
+    serve(server, port)
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        start = time.monotonic()
+        assert sock.recv(1) == b""  # server在空闲超时后关闭连接
+        assert 0.2 < time.monotonic() - start < 2
+    assert waitFor(lambda: not server.connections())
+
+
+def test_heartbeats_keep_answering_clients_alive(serve):
+    port = freePort()
+    server = HTcpSelectorServer(("127.0.0.1", port))
+    server.set_heartbeat(0.1)
+    server.set_idle_timeout(0.3)
+    serve(server, port)
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:  # 收到ping但不回复
+        ping = MessageDecoder().feed(sock.recv(1024))[0]
+        assert (ping.opcode(), ping.statuscode()) == (BuiltInOpCode.HEARTBEAT, 0)
+        client = HTcpChannelClient()
+        client.connect(("127.0.0.1", port))
+        try:
+            time.sleep(1.0)
+            assert not client.isclosed()  # 自动回复pong的连接超过空闲超时仍然存活
+            assert len(server.connections()) == 1
+        finally:
+            client.close()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import math
+import time
+import traceback
+from typing import Callable, Optional
+
+
+class Timer:
+    """一个定时回调, 由TimerWheel在到期后的第一个刻度执行"""
+    __slots__ = ("deadline", "callback", "args", "rounds", "slot", "cancelled")
+
+    def __init__(self, deadline: float, callback: Callable, *args):
+        self.deadline = deadline  # time.monotonic()时刻
+        self.callback = callback
+        self.args = args
+        self.rounds = 0  # 还需要转过的圈数
+        self.slot = -1
+        self.cancelled = False
+
+    def cancel(self):
+        """取消定时, 可以在任意线程中调用"""
+        self.cancelled = True
+
+
+class TimerWheel:
+    """哈希时间轮
+
+    slots个槽每tick秒前进一格, 定时器按到期刻度放入对应的槽, 超过一圈的记录剩余圈数。
+    添加和取消都是O(1), 每个刻度只检查当前槽中的定时器, 适合大量连接各自的超时。
+    回调在到期后的第一个刻度执行, 精度为tick。
+
+    不是线程安全的, 应只在驱动它的线程(如selector的I/O线程)中调用, 其他线程使用Timer.cancel()取消。
+    """
+
+    def __init__(self, tick: float = 0.05, slots: int = 1024):
+        self.__tick = tick
+        self.__slots: list[set[Timer]] = [set() for _ in range(slots)]
+        self.__current = 0  # 下一个到期的槽
+        self.__next_tick = time.monotonic() + tick  # 该槽的到期时刻
+        self.__count = 0
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """delay秒后执行callback(*args)"""
+        timer = Timer(time.monotonic() + delay, callback, *args)
+        self.add(timer)
+        return timer
+
+    def add(self, timer: Timer):
+        """加入一个已创建的定时器(如在其他线程中创建后转交过来的)"""
+        if timer.cancelled:
+            return
+        if self.__count == 0:  # 空闲期间不推进刻度, 重新对齐
+            self.__next_tick = time.monotonic() + self.__tick
+        ticks = max(0, math.ceil((timer.deadline - self.__next_tick) / self.__tick))
+        timer.rounds, offset = divmod(ticks, len(self.__slots))
+        timer.slot = (self.__current + offset) % len(self.__slots)
+        self.__slots[timer.slot].add(timer)
+        self.__count += 1
+
+    def cancel(self, timer: Timer):
+        """取消并立即移除一个定时器"""
+        timer.cancel()
+        if timer.slot >= 0 and timer in self.__slots[timer.slot]:
+            self.__slots[timer.slot].discard(timer)
+            self.__count -= 1
+
+    def timeout(self) -> Optional[float]:
+        """距下一个刻度的秒数, 用作select的超时; 没有定时器时为None"""
+        if self.__count == 0:
+            return None
+        return max(0.0, self.__next_tick - time.monotonic())
+
+    def advance(self) -> int:
+        """推进到当前时刻, 执行到期的回调
+
+        Returns:
+            int: 执行的回调数
+        """
+        fired = 0
+        now = time.monotonic()
+        while self.__count and now >= self.__next_tick:
+            slot = self.__slots[self.__current]
+            # 先前进再执行, 回调中新加入的定时器不会落进正在处理的槽
+            self.__current = (self.__current + 1) % len(self.__slots)
+            self.__next_tick += self.__tick
+            if not slot:
+                continue
+            due = []
+            for timer in slot:
+                if timer.rounds == 0:
+                    due.append(timer)
+                else:
+                    timer.rounds -= 1
+            for timer in due:
+                slot.discard(timer)
+                self.__count -= 1
+                timer.slot = -1
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    traceback.print_exc()
+                fired += 1
+        return fired